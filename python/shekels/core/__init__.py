@@ -1,3 +1,7 @@
+import shekels.core.cache
 import shekels.core.config
 import shekels.core.data_tools
-import shekels.core.database  # noqa: F401
+import shekels.core.database
+import shekels.core.engine
+import shekels.core.planner
+import shekels.core.store  # noqa: F401
@@ -0,0 +1,201 @@
+from typing import Any, Callable, Dict, Hashable, List, Optional  # noqa: F401
+
+from collections import OrderedDict
+from threading import RLock
+import hashlib
+import json
+import sys
+
+from lunchbox.enforce import Enforce
+import numpy as np
+import pandas as pd
+# ------------------------------------------------------------------------------
+
+
+def get_size(item):
+    # type: (Any) -> int
+    '''
+    Approximates the size of a given item in bytes.
+    Recurses through dicts, lists, tuples and sets.
+
+    Args:
+        item (object): Item to be measured.
+
+    Returns:
+        int: Size in bytes.
+    '''
+    if isinstance(item, (pd.DataFrame, pd.Series)):
+        return int(item.memory_usage(deep=True).sum())
+    if isinstance(item, np.ndarray):
+        return int(item.nbytes)
+
+    size = sys.getsizeof(item)
+    if isinstance(item, dict):
+        for key, val in item.items():
+            size += get_size(key) + get_size(val)
+    elif isinstance(item, (list, tuple, set, frozenset)):
+        for val in item:
+            size += get_size(val)
+    return size
+
+
+def get_hash(item):
+    # type: (Any) -> str
+    '''
+    Creates a canonical hash of a given JSON-like item.
+    Dictionary keys are sorted, so key order does not affect the hash.
+
+    Args:
+        item (object): JSON-like item.
+
+    Returns:
+        str: SHA256 hex digest.
+    '''
+    item = json.dumps(item, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(item).hexdigest()
+
+
+class LRUCache:
+    '''
+    Thread safe least-recently-used cache, bounded by the total size of its
+    values in bytes.
+    '''
+    def __init__(self, max_bytes=256 * 1024**2, on_evict=None):
+        # type: (int, Optional[Callable[[Any], Any]]) -> None
+        '''
+        Constructs a LRUCache instance.
+
+        Args:
+            max_bytes (int, optional): Maximum total size of cached values.
+                Default: 256 MiB.
+            on_evict (function, optional): Function called with each value
+                which leaves the cache, through eviction, replacement,
+                rejection or clear. Default: None.
+
+        Raises:
+            EnforceError: If max_bytes is less than 0.
+        '''
+        msg = 'Max bytes must be greater or equal to {b}. {a} < {b}.'
+        Enforce(max_bytes, '>=', 0, message=msg)
+        # ----------------------------------------------------------------------
+
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()  # type: OrderedDict
+        self._lock = RLock()
+
+    def __contains__(self, key):
+        # type: (Hashable) -> bool
+        return key in self._items
+
+    def __len__(self):
+        # type: () -> int
+        return len(self._items)
+
+    def get(self, key, default=None):
+        # type: (Hashable, Any) -> Any
+        '''
+        Gets the value of given key and marks it as most recently used.
+
+        Args:
+            key (object): Cache key.
+            default (object, optional): Value returned if key is not cached.
+                Default: None.
+
+        Returns:
+            object: Cached value or default.
+        '''
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def set(self, key, value, size=None):
+        # type: (Hashable, Any, Optional[int]) -> LRUCache
+        '''
+        Caches given value under given key, evicting least recently used items
+        until cache is within its byte limit. Values larger than max_bytes are
+        not cached.
+
+        Args:
+            key (object): Cache key.
+            value (object): Value to be cached.
+            size (int, optional): Size of value in bytes. Default: None.
+                If None, size is computed with get_size.
+
+        Returns:
+            LRUCache: self.
+        '''
+        if size is None:
+            size = get_size(value)
+
+        removed = []  # type: List[Any]
+        with self._lock:
+            if key in self._items:
+                old, old_size = self._items.pop(key)
+                self.size -= old_size
+                if old is not value:
+                    removed.append(old)
+
+            if size > self.max_bytes:
+                removed.append(value)
+            else:
+                self._items[key] = (value, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (old, old_size) = self._items.popitem(last=False)
+                    self.size -= old_size
+                    self.evictions += 1
+                    removed.append(old)
+
+        self._evict(removed)
+        return self
+
+    def clear(self):
+        # type: () -> LRUCache
+        '''
+        Removes all items from cache. Does not reset stats.
+
+        Returns:
+            LRUCache: self.
+        '''
+        with self._lock:
+            removed = [x[0] for x in self._items.values()]
+            self._items.clear()
+            self.size = 0
+        self._evict(removed)
+        return self
+
+    def _evict(self, values):
+        # type: (List[Any]) -> None
+        '''
+        Calls on_evict with each given value, outside of cache lock.
+
+        Args:
+            values (list): Values which left the cache.
+        '''
+        if self.on_evict is not None:
+            for value in values:
+                self.on_evict(value)
+
+    @property
+    def stats(self):
+        # type: () -> Dict[str, int]
+        '''
+        dict: Cache statistics.
+        '''
+        return dict(
+            items=len(self._items),
+            size=self.size,
+            max_bytes=self.max_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
@@ -0,0 +1,120 @@
+import sys
+import unittest
+
+from lunchbox.enforce import EnforceError
+from pandas import DataFrame
+import numpy as np
+
+import shekels.core.cache as sch
+# ------------------------------------------------------------------------------
+
+
+class CacheTests(unittest.TestCase):
+    def test_get_size(self):
+        result = sch.get_size('foo')
+        self.assertEqual(result, sys.getsizeof('foo'))
+
+        result = sch.get_size({'foo': ['bar']})
+        self.assertGreater(result, sch.get_size(['bar']))
+
+        data = DataFrame([[1, 2], [3, 4]], columns=['a', 'b'])
+        result = sch.get_size(data)
+        self.assertEqual(result, data.memory_usage(deep=True).sum())
+
+        result = sch.get_size(np.zeros(10, dtype=np.float64))
+        self.assertEqual(result, 80)
+
+    def test_get_hash(self):
+        a = sch.get_hash({'foo': 1, 'bar': [1, 2]})
+        b = sch.get_hash({'bar': [1, 2], 'foo': 1})
+        self.assertEqual(a, b)
+
+        c = sch.get_hash({'bar': [2, 1], 'foo': 1})
+        self.assertNotEqual(a, c)
+
+    def test_lru_cache_init(self):
+        expected = 'Max bytes must be greater or equal to 0. -1 < 0.'
+        with self.assertRaisesRegex(EnforceError, expected):
+            sch.LRUCache(max_bytes=-1)
+
+    def test_lru_cache_get_set(self):
+        cache = sch.LRUCache(max_bytes=100)
+        self.assertIsNone(cache.get('foo'))
+        self.assertEqual(cache.get('foo', 'bar'), 'bar')
+        self.assertEqual(cache.misses, 2)
+
+        cache.set('foo', 'bar', size=10)
+        self.assertIn('foo', cache)
+        self.assertEqual(cache.get('foo'), 'bar')
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.size, 10)
+
+        # overwrite
+        cache.set('foo', 'baz', size=20)
+        self.assertEqual(cache.get('foo'), 'baz')
+        self.assertEqual(cache.size, 20)
+        self.assertEqual(len(cache), 1)
+
+    def test_lru_cache_eviction(self):
+        cache = sch.LRUCache(max_bytes=100)
+        cache.set('a', 1, size=40)
+        cache.set('b', 2, size=40)
+
+        # a becomes most recently used
+        cache.get('a')
+        cache.set('c', 3, size=40)
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.size, 80)
+
+        # too big
+        cache.set('d', 4, size=101)
+        self.assertNotIn('d', cache)
+        self.assertEqual(cache.size, 80)
+
+    def test_lru_cache_clear(self):
+        cache = sch.LRUCache()
+        cache.set('foo', 'bar')
+        cache.get('foo')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+        self.assertEqual(cache.hits, 1)
+
+    def test_lru_cache_on_evict(self):
+        evicted = []
+        cache = sch.LRUCache(max_bytes=100, on_evict=evicted.append)
+        cache.set('a', 'a', size=40)
+        cache.set('b', 'b', size=40)
+        cache.set('c', 'c', size=40)
+        self.assertEqual(evicted, ['a'])
+
+        # replacement
+        cache.set('b', 'b', size=50)
+        self.assertEqual(evicted, ['a'])
+        cache.set('b', 'x', size=50)
+        self.assertEqual(evicted, ['a', 'b'])
+
+        # rejection
+        cache.set('d', 'd', size=101)
+        self.assertEqual(evicted, ['a', 'b', 'd'])
+
+        cache.clear()
+        self.assertEqual(evicted, ['a', 'b', 'd', 'c', 'x'])
+
+    def test_lru_cache_stats(self):
+        cache = sch.LRUCache(max_bytes=100)
+        cache.set('foo', 'bar', size=10)
+        cache.get('foo')
+        cache.get('bar')
+        expected = dict(
+            items=1,
+            size=10,
+            max_bytes=100,
+            hits=1,
+            misses=1,
+            evictions=0,
+        )
+        self.assertEqual(cache.stats, expected)
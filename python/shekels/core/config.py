@@ -141,7 +141,8 @@ def is_plot_kind(item):
         ValidationError: If item is a plot kind.
     '''
     kinds = [
-        'area', 'bar', 'barh', 'line', 'lines', 'ratio', 'scatter', 'spread'
+        'area', 'bar', 'barh', 'histogram', 'line', 'lines', 'ratio', 'scatter',
+        'spread',
     ]
     if item not in kinds:
         msg = f'{item} is not a legal plot kind. Legal kinds: {kinds}.'
@@ -291,6 +292,8 @@ class FigureItem(Model):
         y_title (str): Title of plot y axis. Default: None.
         bins (int): Number of bins if histogram. Default: 50.
         bar_mode (str): How bars in bar graph are presented. Default: stack.
+        max_points (int): Maximum number of points per trace of area, line
+            and scatter plots. Default: None.
     '''
     kind = sty.StringType(default='bar', validators=[is_plot_kind])
     color_scheme = sty.DictType(
@@ -303,6 +306,7 @@ class FigureItem(Model):
     y_title = sty.StringType(default=None)
     bins = sty.IntType(default=50)
     bar_mode = sty.StringType(validators=[is_bar_mode], default='stack')
+    max_points = sty.IntType(default=None, min_value=4)
 
 
 class PlotItem(Model):
@@ -335,6 +339,24 @@ class Config(Model):
         color_scheme (dict): Color scheme.
         conform (lit[dict]): List of conform actions.
         plots (list[dict]): List of plots.
+        plot_executor (str): Pool used for rendering plots when warming
+            caches, thread or process. The app renders plots lazily, one
+            callback per plot, so this does not affect it. Default: thread.
+        plot_workers (int): Number of plot rendering workers used when
+            warming caches. Default: 4.
+        warm_cache (bool): Whether to warm caches in the background after
+            each update. Default: False.
+        pinned_queries (list[str]): Queries warmed in addition to
+            default_query. Default: [].
+        search_cache_size (int): Maximum size of search result cache in
+            bytes. Default: 64MB.
+        query_timeout (float): Time limit of each search query in seconds.
+            If 0, queries are not time limited. Default: 10.
+        shared_store (str): Directory through which data is shared between
+            processes. If set, updates publish data to it and workers attach
+            to published data with Database.sync. Server processes which have
+            not been initialized build their database from the app config
+            when it sets shared_store. Default: None.
     '''
     data_path = sty.StringType(required=True, validators=[is_csv])
     columns = sty.ListType(sty.StringType, default=[])
@@ -345,3 +367,12 @@ class Config(Model):
     )
     conform = sty.ListType(sty.ModelType(ConformAction), default=[])
     plots = sty.ListType(sty.ModelType(PlotItem), default=[])
+    plot_executor = sty.StringType(
+        default='thread', choices=['thread', 'process']
+    )
+    plot_workers = sty.IntType(default=4, min_value=1)
+    warm_cache = sty.BooleanType(default=False)
+    pinned_queries = sty.ListType(sty.StringType(), default=[])
+    search_cache_size = sty.IntType(default=64 * 1024**2, min_value=0)
+    query_timeout = sty.FloatType(default=10.0, min_value=0)
+    shared_store = sty.StringType(default=None)
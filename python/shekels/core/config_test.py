@@ -61,7 +61,8 @@ class ConfigValidatorTests(unittest.TestCase):
 
     def test_is_plot_kind(self):
         vals = [
-            'area', 'bar', 'barh', 'line', 'lines', 'ratio', 'scatter', 'spread'
+            'area', 'bar', 'barh', 'histogram', 'line', 'lines', 'ratio',
+            'scatter', 'spread',
         ]
         for val in vals:
             cfg.is_plot_kind(val)
@@ -267,6 +268,7 @@ class ConfigSchematicTests(unittest.TestCase):
         self.assertIsNone(result['y_title'])
         self.assertEqual(result['bins'], 50)
         self.assertEqual(result['bar_mode'], 'stack')
+        self.assertIsNone(result['max_points'])
 
         # kind
         bad = dict(kind='foo')
@@ -280,6 +282,12 @@ class ConfigSchematicTests(unittest.TestCase):
         with self.assertRaisesRegex(DataError, expected):
             cfg.FigureItem(bad).validate()
 
+        # max points
+        bad = dict(max_points=3)
+        expected = 'max_points.*greater than or equal to 4'
+        with self.assertRaisesRegex(DataError, expected):
+            cfg.FigureItem(bad).validate()
+
     def test_plot_item(self):
         result = cfg.PlotItem({}).to_primitive()
         self.assertEqual(result['filters'], [])
@@ -358,6 +366,13 @@ class ConfigSchematicTests(unittest.TestCase):
             self.assertEqual(result.columns, [])
             self.assertEqual(result.conform, [])
             self.assertEqual(result.default_query, 'select * from data')
+            self.assertEqual(result.plot_executor, 'thread')
+            self.assertEqual(result.plot_workers, 4)
+            self.assertFalse(result.warm_cache)
+            self.assertEqual(result.pinned_queries, [])
+            self.assertEqual(result.search_cache_size, 64 * 1024**2)
+            self.assertEqual(result.query_timeout, 10.0)
+            self.assertIsNone(result.shared_store)
 
             # data_path bad ext
             bad = deepcopy(config)
@@ -387,3 +402,24 @@ class ConfigSchematicTests(unittest.TestCase):
             expected = 'Invalid color scheme keys:.*foo'
             with self.assertRaisesRegex(DataError, expected):
                 cfg.Config(bad).validate()
+
+            # plot executor
+            bad = deepcopy(config)
+            bad['plot_executor'] = 'foo'
+            expected = 'plot_executor.*must be one of'
+            with self.assertRaisesRegex(DataError, expected):
+                cfg.Config(bad).validate()
+
+            # plot workers
+            bad = deepcopy(config)
+            bad['plot_workers'] = 0
+            expected = 'plot_workers.*Int value should be greater than or equal to 1'
+            with self.assertRaisesRegex(DataError, expected):
+                cfg.Config(bad).validate()
+
+            # search cache size
+            bad = deepcopy(config)
+            bad['search_cache_size'] = -1
+            expected = 'search_cache_size.*greater than or equal to 0'
+            with self.assertRaisesRegex(DataError, expected):
+                cfg.Config(bad).validate()
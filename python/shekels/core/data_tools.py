@@ -1,22 +1,28 @@
-from typing import Any, Dict, List, Optional, Union  # noqa: F401
-import cufflinks as cf  # noqa: F401
+from typing import Any, Dict, List, Optional, Tuple, Union  # noqa: F401
+from threading import Event, Lock  # noqa: F401
 
+from collections import namedtuple
 from copy import copy
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
 from random import randint
 import datetime as dt
+import json
 import re
 
 from lunchbox.enforce import Enforce
-from pandas import DataFrame, DatetimeIndex
+from pandas import DataFrame, DatetimeIndex, Series, to_numeric
+from pandas.api.types import infer_dtype
 from schematics.exceptions import DataError
 import lunchbox.tools as lbt
 import numpy as np
-import pandasql
 import pyparsing as pp
 import rolling_pin.blob_etl as rpb
 import webcolors
 
 from shekels.core.config import ConformAction
+from shekels.core.engine import Engine
+import shekels.core.cache as sch
 import shekels.core.config as cfg
 import shekels.enforce.enforce_tools as eft
 # ------------------------------------------------------------------------------
@@ -67,6 +73,38 @@ COLOR_COERCION_LUT = {
     '#FFA15A': '#EB9E58',
 }
 
+TRACE_COLORS = [
+    'cyan2', 'red2', 'green2', 'blue2', 'orange2', 'purple2', 'yellow2',
+    'light2', 'cyan1', 'red1', 'green1', 'blue1',
+]
+'''
+Henanigans trace colorway, given as color scheme keys.
+'''
+
+GRID_COLOR = '#343434'
+
+Stage = namedtuple('Stage', ['stage', 'action', 'key'])
+'''
+Immutable data manipulation stage.
+
+Attributes:
+    stage (str): Kind of stage. Options: filter, group, pivot.
+    action (tuple): Validated action primitive as sorted (key, value) pairs.
+    key (str): Hash of this stage and all stages preceding it.
+'''
+
+PlotPlan = namedtuple('PlotPlan', ['key', 'stages', 'figure', 'min_width'])
+'''
+Immutable execution plan of a validated plot.
+
+Attributes:
+    key (str): Hash of plot spec.
+    stages (tuple[Stage]): Data manipulation stages.
+    figure (tuple): Keyword arguments for build_figure as sorted
+        (key, value) pairs. Color scheme is likewise stored as pairs.
+    min_width (int): Minimum width of plot in percent.
+'''
+
 
 def conform(data, actions=[], columns=[]):
     # type: (DataFrame, List[dict], List[str]) -> DataFrame
@@ -125,6 +163,117 @@ def conform(data, actions=[], columns=[]):
     return data
 
 
+def serialize_dates(data):
+    # type: (DataFrame) -> DataFrame
+    '''
+    Converts date column of given DataFrame to ISO format strings, identical
+    to those of Timestamp.isoformat. Null dates are converted to None.
+
+    Args:
+        data (DataFrame): Data.
+
+    Returns:
+        DataFrame: Copy of data.
+    '''
+    data = data.copy()
+    if 'date' not in data.columns or data.date.dtype.kind != 'M':
+        return data
+
+    dates = data.date
+    output = np.datetime_as_string(
+        dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[s]')
+    )
+    output = Series(output, index=dates.index, dtype=object)
+
+    # only dates with fractional seconds or timezones need isoformat
+    mask = dates.notnull()
+    if dates.dt.tz is None:
+        mask &= (dates.dt.microsecond != 0) | (dates.dt.nanosecond != 0)
+    if mask.any():
+        output[mask] = dates[mask].apply(lambda x: x.isoformat())
+
+    data.date = output.where(dates.notnull(), None)
+    return data
+
+
+def to_records(data):
+    # type: (DataFrame) -> List[dict]
+    '''
+    Converts given DataFrame to a list of JSONifiable dicts.
+
+    Args:
+        data (DataFrame): Data.
+
+    Returns:
+        list[dict]: Records.
+    '''
+    data = serialize_dates(data).astype(object)
+    data = data.where(data.notnull(), None)
+    return data.to_dict(orient='records')
+
+
+def _to_json_values(data):
+    # type: (Series) -> np.ndarray
+    '''
+    Serializes each value of given Series to a JSON string, identical to
+    json.dumps of the value in to_records. Numeric and boolean columns are
+    formatted with numpy, whose float strings equal float.__repr__.
+
+    Args:
+        data (Series): Column.
+
+    Returns:
+        numpy.ndarray: Object array of JSON strings.
+    '''
+    nulls = data.isnull().to_numpy()
+    kind = data.dtype.kind
+    if kind == 'f':
+        values = data.to_numpy(dtype=np.float64, na_value=np.nan)
+        output = values.astype(str).astype(object)
+        output[np.isposinf(values)] = 'Infinity'
+        output[np.isneginf(values)] = '-Infinity'
+    elif kind in 'iu':
+        values = data.to_numpy(dtype=object) if nulls.any() else data.to_numpy()
+        output = values.astype(str).astype(object)
+    elif kind == 'b':
+        values = data.to_numpy(dtype=bool, na_value=False)
+        output = np.where(values, 'true', 'false').astype(object)
+    elif infer_dtype(data, skipna=True) in ['string', 'empty']:
+        output = data.to_numpy(dtype=object).copy()
+        output[~nulls] = [encode_basestring_ascii(x) for x in output[~nulls]]
+    else:
+        output = np.array(
+            [json.dumps(x) for x in data.astype(object)], dtype=object
+        )
+    output[nulls] = 'null'
+    return output
+
+
+def to_json(data):
+    # type: (DataFrame) -> bytes
+    '''
+    Serializes given DataFrame to JSON bytes, identical to json.dumps of
+    to_records. Values are serialized per column rather than per row.
+
+    Args:
+        data (DataFrame): Data.
+
+    Returns:
+        bytes: JSON list of records.
+    '''
+    if data.size == 0:
+        return b'[]'
+
+    data = serialize_dates(data)
+    rows = np.full(len(data), '', dtype=object)
+    for i, name in enumerate(data.columns):
+        # json.dumps encodes non-string keys, such as ints, as strings
+        key = json.dumps({name: None})[1:-5]
+        sep = '' if i == 0 else ', '
+        rows = rows + (sep + key) + _to_json_values(data.iloc[:, i])
+    return ('[{' + '}, {'.join(rows) + '}]').encode('utf-8')
+
+
 def filter_data(data, column, comparator, value):
     # type: (DataFrame, str, str, Any) -> DataFrame
     '''
@@ -386,6 +535,203 @@ def pivot_data(data, columns, values=[], index=None):
     return data
 
 
+def get_stages(filters=[], group=None, pivot=None):
+    # type: (List[dict], Optional[dict], Optional[dict]) -> Tuple[Stage, ...]
+    '''
+    Validates given data manipulations and returns them as an ordered tuple of
+    stages.
+
+    Args:
+        filters (list[dict], optional): List of filters for data. Default: [].
+        group (dict, optional): Grouping operation. Default: None.
+        pivot (dict, optional): Pivot operation. Default: None.
+
+    Raises:
+        DataError: If any filter in filters is invalid.
+        DataError: If group is invalid.
+        DataError: If pivot is invalid.
+
+    Returns:
+        tuple[Stage]: Stages.
+    '''
+    items = [('filter', x) for x in filters]
+    if group is not None:
+        items.append(('group', group))
+    if pivot is not None:
+        items.append(('pivot', pivot))
+
+    lut = dict(
+        filter=(cfg.FilterAction, 'Invalid filter'),
+        group=(cfg.GroupAction, 'Invalid group'),
+        pivot=(cfg.PivotAction, 'Invalid pivot'),
+    )
+    stages = []
+    key = None
+    for stage, action in items:
+        model, msg = lut[stage]
+        item = model(action)  # type: Any
+        try:
+            item.validate()
+        except DataError as e:
+            raise DataError({msg: e.to_primitive()})
+        item = item.to_primitive()
+        key = sch.get_hash([key, stage, item])
+        stages.append(Stage(stage, tuple(sorted(item.items())), key))
+    return tuple(stages)
+
+
+def execute_stages(data, stages, memo=None):
+    # type: (DataFrame, Tuple[Stage, ...], Optional[dict]) -> DataFrame
+    '''
+    Applies given stages to given data in order.
+    If a memo is given, the output of every stage is stored in it under the
+    stage's key. Stage prefixes shared between calls are thus computed only
+    once. Memoized frames must not be mutated.
+
+    Args:
+        data (DataFrame): Data.
+        stages (tuple[Stage]): Stages as returned by get_stages.
+        memo (dict, optional): Memo of stage outputs. Default: None.
+
+    Raises:
+        EnforceError: If a stage cannot be applied to data.
+
+    Returns:
+        DataFrame: Manipulated data.
+    '''
+    if memo is None:
+        memo = {}
+
+    for stage, action, key in stages:
+        if key in memo:
+            data = memo[key]
+            continue
+
+        action = dict(action)
+        if stage == 'filter':
+            if len(data) > 0:
+                data = filter_data(
+                    data,
+                    action['column'],
+                    action['comparator'],
+                    action['value'],
+                )
+        elif stage == 'group':
+            data = group_data(
+                data.copy(),
+                action['columns'],
+                action['metric'],
+                datetime_column=action['datetime_column'],
+            )
+        else:
+            data = pivot_data(
+                data.copy(),
+                action['columns'],
+                values=action['values'],
+                index=action['index'],
+            )
+        memo[key] = data
+    return data
+
+
+def compile_plot(plot, color_scheme={}):
+    # type: (Dict, Dict[str, str]) -> PlotPlan
+    '''
+    Validates given plot and compiles it into an immutable execution plan.
+    Plans are executed with execute_plan, without any further validation.
+
+    Args:
+        plot (dict): Plot as PlotItem dictionary.
+        color_scheme (dict[str, str], optional): Color scheme, which the
+            plot's own color scheme is applied on top of. Default: {}.
+
+    Raises:
+        DataError: If plot is invalid.
+
+    Returns:
+        PlotPlan: Plot plan.
+    '''
+    item = cfg.PlotItem(plot)  # type: Any
+    item.validate()
+    item = item.to_primitive()
+
+    figure = item['figure']
+    cs = copy(color_scheme)
+    cs.update(figure['color_scheme'])
+    figure['color_scheme'] = cs
+
+    stages = get_stages(
+        filters=item['filters'], group=item['group'], pivot=item['pivot']
+    )
+    key = sch.get_hash([[x.key for x in stages], figure, item['min_width']])
+
+    figure['color_scheme'] = tuple(sorted(cs.items()))
+    figure = tuple(sorted(figure.items()))
+    return PlotPlan(key, stages, figure, item['min_width'])
+
+
+PLOT_PLAN_CACHE = sch.LRUCache(max_bytes=16 * 1024**2)
+'''
+Cache of compiled plot plans keyed by plots and color scheme.
+'''
+
+
+def get_plans(plots, color_scheme={}):
+    # type: (List[dict], Dict[str, str]) -> Tuple[PlotPlan, ...]
+    '''
+    Compiles given plots into plot plans.
+    Plans are cached in PLOT_PLAN_CACHE, keyed by a hash of plots and color
+    scheme, so plots are only validated once per config.
+
+    Args:
+        plots (list[dict]): List of dicts defining plots.
+        color_scheme (dict[str, str], optional): Color scheme of app. Each
+            plot's own color scheme is applied on top of it. Default: {}.
+
+    Raises:
+        EnforceError: If plots is not a list of dicts.
+        DataError: If any plot is invalid.
+
+    Returns:
+        tuple[PlotPlan]: Plot plans.
+    '''
+    msg = 'Plots must be a list of dictionaries. Given value: {a}.'
+    Enforce(plots, 'instance of', list, message=msg)
+    for item in plots:
+        Enforce(item, 'instance of', dict, message=msg)
+    # --------------------------------------------------------------------------
+
+    key = sch.get_hash([plots, color_scheme])
+    plans = PLOT_PLAN_CACHE.get(key)
+    if plans is None:
+        plans = tuple(compile_plot(x, color_scheme) for x in plots)
+        PLOT_PLAN_CACHE.set(key, plans)
+    return plans
+
+
+def execute_plan(data, plan, memo=None):
+    # type: (DataFrame, PlotPlan, Optional[dict]) -> Dict
+    '''
+    Generates a plotly figure dictionary from given data and plot plan.
+
+    Args:
+        data (DataFrame): Data.
+        plan (PlotPlan): Plot plan as returned by compile_plot.
+        memo (dict, optional): Memo of stage outputs shared between figures.
+            See execute_stages. Default: None.
+
+    Raises:
+        EnforceError: If figure cannot be built from data.
+
+    Returns:
+        dict: Plotly Figure as dictionary.
+    '''
+    data = execute_stages(data, plan.stages, memo=memo)
+    kwargs = dict(plan.figure)
+    kwargs['color_scheme'] = dict(kwargs['color_scheme'])
+    return build_figure(data, **kwargs)
+
+
 def get_figure(
     data,              # type: DataFrame
     filters=[],        # type: List[dict]
@@ -400,6 +746,8 @@ def get_figure(
     y_title=None,      # type: Optional[str]
     bins=50,           # type: int
     bar_mode='stack',  # type: str
+    max_points=None,   # type: Optional[int]
+    memo=None,         # type: Optional[dict]
 ):
     '''
     Generates a plotly figure dictionary from given data and manipulations.
@@ -410,7 +758,8 @@ def get_figure(
         group (dict, optional): Grouping operation. Default: None.
         pivot (dict, optional): Pivot operation. Default: None.
         kind (str, optional): Kind of plot. Default: bar.
-        color_scheme (dict[str, str], optional): Color scheme. Default: {}.
+        color_scheme (dict[str, str], optional): Color scheme overrides for
+            COLOR_SCHEME. Default: {}.
         x_axis (str): Column to use as x axis: Default: None.
         y_axis (str): Column to use as y axis: Default: None.
         title (str, optional): Title of plot. Default: None.
@@ -419,81 +768,303 @@ def get_figure(
         bins (int, optional): Number of bins if histogram. Default: 50.
         bar_mode (str, optional): How bars in bar graph are presented.
             Default: stack.
+        max_points (int, optional): Maximum number of points per trace of
+            area, line and scatter plots. Default: None.
+        memo (dict, optional): Memo of stage outputs shared between figures.
+            See execute_stages. Default: None.
 
     Raises:
         DataError: If any filter in filters is invalid.
         DataError: If group is invalid.
         DataError: If pivot is invalid.
+        EnforceError: If figure cannot be built from data.
 
     Returns:
         dict: Plotly Figure as dictionary.
     '''
-    data = data.copy()
+    stages = get_stages(filters=filters, group=group, pivot=pivot)
+    data = execute_stages(data, stages, memo=memo)
+    return build_figure(
+        data,
+        kind=kind,
+        color_scheme=color_scheme,
+        x_axis=x_axis,
+        y_axis=y_axis,
+        title=title,
+        x_title=x_title,
+        y_title=y_title,
+        bins=bins,
+        bar_mode=bar_mode,
+        max_points=max_points,
+    )
 
-    # filter
-    for f in filters:
-        f = cfg.FilterAction(f)
-        try:
-            f.validate()
-        except DataError as e:
-            raise DataError({'Invalid filter': e.to_primitive()})
 
-        f = f.to_primitive()
-        if len(data) == 0:
-            break
-        data = filter_data(data, f['column'], f['comparator'], f['value'])
+def downsample(values, max_points):
+    # type: (Any, int) -> np.ndarray
+    '''
+    Gets indices of a shape preserving subset of given values, at most
+    max_points long. The first and last values are always kept. The remaining
+    values are split into equal buckets, and the minimum and maximum of each
+    bucket are kept, so that peaks remain visible. NaNs are ignored.
 
-    # group
-    if group is not None:
-        grp = group  # type: Any
-        grp = cfg.GroupAction(grp)
-        try:
-            grp.validate()
-        except DataError as e:
-            raise DataError({'Invalid group': e.to_primitive()})
-        grp = grp.to_primitive()
-
-        data = group_data(
-            data,
-            grp['columns'],
-            grp['metric'],
-            datetime_column=grp['datetime_column'],
-        )
+    Args:
+        values (list or numpy.ndarray): Numeric values.
+        max_points (int): Maximum number of indices returned.
 
-    # pivot
-    if pivot is not None:
-        pvt = pivot  # type: Any
-        pvt = cfg.PivotAction(pvt)
-        try:
-            pvt.validate()
-        except DataError as e:
-            raise DataError({'Invalid pivot': e.to_primitive()})
-        pvt = pvt.to_primitive()
+    Raises:
+        EnforceError: If max_points is less than 4.
 
-        data = pivot_data(
-            data, pvt['columns'], values=pvt['values'], index=pvt['index']
-        )
+    Returns:
+        numpy.ndarray: Sorted indices of values to be kept.
+    '''
+    msg = 'Max points must be greater or equal to {b}. {a} < {b}.'
+    Enforce(max_points, '>=', 4, message=msg)
+    # --------------------------------------------------------------------------
+
+    values = np.asarray(values, dtype=float)
+    size = len(values)
+    if size <= max_points:
+        return np.arange(size)
+
+    inner = values[1:-1]
+    buckets = (max_points - 2) // 2
+    width = int(np.ceil(len(inner) / buckets))
+    pad = np.full(buckets * width - len(inner), np.nan)
+    grid = np.concatenate([inner, pad]).reshape(buckets, width)
+    nan = np.isnan(grid)
+    lo = np.where(nan, np.inf, grid).argmin(axis=1)
+    hi = np.where(nan, -np.inf, grid).argmax(axis=1)
+
+    offset = np.arange(buckets) * width + 1
+    output = np.concatenate([[0], lo + offset, hi + offset, [size - 1]])
+    output = np.unique(output)
+    return output[output < size]
+
+
+def build_figure(
+    data,              # type: DataFrame
+    kind='bar',        # type: str
+    color_scheme={},   # type: Dict[str, str]
+    x_axis=None,       # type: Optional[str]
+    y_axis=None,       # type: Optional[str]
+    title=None,        # type: Optional[str]
+    x_title=None,      # type: Optional[str]
+    y_title=None,      # type: Optional[str]
+    bins=50,           # type: int
+    bar_mode='stack',  # type: str
+    max_points=None,   # type: Optional[int]
+):
+    '''
+    Builds a plotly figure dictionary from given data, styled with the
+    henanigans theme. Each column of data becomes a trace, plotted against the
+    index, unless x_axis is given.
+
+    Legal kinds:
+
+        * area
+        * bar
+        * barh
+        * hist, histogram
+        * line, lines
+        * ratio
+        * scatter
+        * spread
+
+    Args:
+        data (DataFrame): Data.
+        kind (str, optional): Kind of plot. Default: bar.
+        color_scheme (dict[str, str], optional): Color scheme overrides for
+            COLOR_SCHEME. Default: {}.
+        x_axis (str): Column to use as x axis: Default: None.
+        y_axis (str): Column to use as y axis: Default: None.
+        title (str, optional): Title of plot. Default: None.
+        x_title (str, optional): Title of x axis. Default: None.
+        y_title (str, optional): Title of y axis. Default: None.
+        bins (int, optional): Number of bins if histogram. Histograms are
+            binned server side into bar traces of bin counts, with bin edges
+            shared by all traces. Default: 50.
+        bar_mode (str, optional): How bars in bar graph are presented.
+            Default: stack.
+        max_points (int, optional): Maximum number of points per trace of
+            area, line and scatter plots. Traces are downsampled with
+            downsample. Area traces share the indices of their stacked sum.
+            Default: None.
+
+    Raises:
+        EnforceError: If data is not a DataFrame.
+        EnforceError: If kind is not legal.
+        EnforceError: If x_axis or y_axis not in data columns.
+        EnforceError: If kind is spread or ratio and there are less than 2
+            traces.
+        EnforceError: If max_points is less than 4.
+
+    Returns:
+        dict: Plotly figure as dictionary.
+    '''
+    kinds = [
+        'area', 'bar', 'barh', 'hist', 'histogram', 'line', 'lines', 'ratio',
+        'scatter', 'spread',
+    ]
+    Enforce(data, 'instance of', DataFrame)
+    msg = '{a} is not a legal plot kind. Legal kinds: {b}.'
+    Enforce(kind, 'in', kinds, message=msg)
+    axes = [x for x in [x_axis, y_axis] if x is not None]
+    eft.enforce_columns_in_dataframe(axes, data)
+    if kind in ['ratio', 'spread']:
+        msg = f'{kind.capitalize()} plots require at least 2 traces. '
+        msg += 'Given traces: {a}.'
+        Enforce(len(data.columns) - len(axes), '>=', 2, message=msg)
+    if max_points is not None:
+        msg = 'Max points must be greater or equal to {b}. {a} < {b}.'
+        Enforce(max_points, '>=', 4, message=msg)
+    # --------------------------------------------------------------------------
+
+    cs = copy(cfg.COLOR_SCHEME)
+    cs.update(color_scheme)
+    colors = [cs[x] for x in TRACE_COLORS]
 
-    # create figure
-    figure = data.iplot(
-        kind=kind, asFigure=True, theme='henanigans', colorscale='henanigans',
-        x=x_axis, y=y_axis, title=title, xTitle=x_title, yTitle=y_title,
-        barmode=bar_mode, bins=bins
-    ).to_dict()  # type: dict
-    figure['layout']['title']['font']['color'] = '#F4F4F4'
-    figure['layout']['xaxis']['title']['font']['color'] = '#F4F4F4'
-    figure['layout']['yaxis']['title']['font']['color'] = '#F4F4F4'
-    if color_scheme != {}:
-        figure = conform_figure(figure, color_scheme)
-
-    # makes area traces stackable
-    if kind == 'area':
-        for trace in figure['data']:
-            trace['stackgroup'] = 1
+    x = data.index.tolist()
+    cols = data.columns.tolist()
+    if x_axis is not None:
+        x = data[x_axis].tolist()
+        cols.remove(x_axis)
+    if y_axis is not None:
+        cols = [y_axis]
+
+    def get_numeric(col):
+        return to_numeric(data[col], errors='coerce').to_numpy(dtype=float)
+
+    points = 0 if max_points is None else max_points
+    sample = kind in ['area', 'line', 'lines', 'scatter'] and points > 0
+    if sample and kind == 'area' and len(cols) > 0:
+        total = np.nansum([get_numeric(x) for x in cols], axis=0)
+        area_index = downsample(total, points)
+
+    # histograms are binned here, with bin edges shared by all traces
+    if kind in ['hist', 'histogram']:
+        values = np.concatenate([[]] + [get_numeric(x) for x in cols])
+        edges = np.histogram_bin_edges(values[np.isfinite(values)], bins=bins)
+        centers = ((edges[:-1] + edges[1:]) / 2).tolist()
+        widths = np.diff(edges).tolist()
+
+    traces = []
+    for i, col in enumerate(cols):
+        color = colors[i % len(colors)]
+        trace = dict(name=str(col))  # type: Dict[str, Any]
+
+        if kind in ['bar', 'barh']:
+            x_, y_ = x, data[col].tolist()
+            if kind == 'barh':
+                x_, y_ = y_, x_
+            trace.update(
+                type='bar',
+                orientation='h' if kind == 'barh' else 'v',
+                x=x_,
+                y=y_,
+                marker=dict(color=color, line=dict(color=color, width=1)),
+            )
+
+        elif kind in ['hist', 'histogram']:
+            y_ = get_numeric(col)
+            y_ = np.histogram(y_[np.isfinite(y_)], bins=edges)[0]
+            trace.update(
+                type='bar',
+                x=centers,
+                y=y_.tolist(),
+                width=widths,
+                opacity=0.8,
+                marker=dict(color=color, line=dict(color=cs['light1'], width=1.3)),
+            )
+
+        else:
+            x_, y_ = x, data[col].tolist()
+            if sample:
+                if kind == 'area':
+                    index = area_index
+                else:
+                    index = downsample(get_numeric(col), points)
+                if len(index) < len(y_):
+                    x_ = [x_[j] for j in index]
+                    y_ = [y_[j] for j in index]
+
+            trace.update(
+                type='scatter',
+                mode='markers' if kind == 'scatter' else 'lines',
+                x=x_,
+                y=y_,
+                line=dict(color=color, width=1.3),
+            )
+            if kind == 'scatter':
+                trace['marker'] = dict(color=color)
+            elif kind == 'area':
+                trace['fill'] = 'tonexty'
+                trace['stackgroup'] = 1
+        traces.append(trace)
+
+    def get_axis(text):
+        return dict(
+            gridcolor=GRID_COLOR,
+            showgrid=True,
+            tickfont=dict(color=cs['light1']),
+            title=dict(text=text, font=dict(color=cs['light2'])),
+            zerolinecolor=cs['grey2'],
+        )
 
+    layout = dict(
+        barmode=bar_mode,
+        legend=dict(bgcolor=cs['grey1'], font=dict(color=cs['light2'])),
+        paper_bgcolor=cs['grey1'],
+        plot_bgcolor=cs['grey1'],
+        title=dict(text=title, font=dict(color=cs['light2'])),
+        xaxis=get_axis(x_title),
+        yaxis=get_axis(y_title),
+    )  # type: Dict[str, Any]
+    if kind in ['hist', 'histogram']:
+        layout['bargap'] = 0
+
+    # spread and ratio plots compare first two traces in a lower subplot
+    if kind in ['ratio', 'spread']:
+        a = data[cols[0]].astype(float).to_numpy()
+        b = data[cols[1]].astype(float).to_numpy()
+        sub = dict(
+            type='scatter',
+            mode='lines',
+            x=x,
+            xaxis='x2',
+            yaxis='y2',
+            fill='tozeroy',
+            connectgaps=False,
+            showlegend=False,
+            name=kind.capitalize(),
+        )
+        if kind == 'spread':
+            diff = a - b
+            pos = np.where(diff >= 0, diff, np.nan).tolist()
+            neg = np.where(diff < 0, diff, np.nan).tolist()
+            for y_, color in [(pos, cs['green1']), (neg, cs['red1'])]:
+                trace = dict(y=y_, line=dict(color=color, width=0.5))
+                trace.update(sub)
+                traces.append(trace)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = a / b
+            ratio[~np.isfinite(ratio)] = np.nan
+            trace = dict(y=ratio.tolist(), line=dict(color=cs['green1'], width=1))
+            trace.update(sub)
+            traces.append(trace)
+
+        layout['hovermode'] = 'x'
+        layout['yaxis']['domain'] = [0.3, 1]
+        layout['yaxis2'] = get_axis(kind.capitalize())
+        layout['yaxis2']['domain'] = [0, 0.25]
+        layout['xaxis2'] = get_axis(x_title)
+        layout['xaxis2'].update(anchor='y2', matches='x', showticklabels=False)
+
+    figure = dict(data=traces, layout=layout)
     return figure
 
 
+@lru_cache(maxsize=4096)
 def parse_rgba(string):
     '''
     Parses rgb and rgba strings into tuples of numbers.
@@ -530,6 +1101,8 @@ def parse_rgba(string):
 def conform_figure(figure, color_scheme):
     '''
     Conforms given figure to use given color scheme.
+    Colors are converted from rgb(a) to hex, coerced to standard colors and
+    then to the color scheme, in a single pass over the figure.
 
     Args:
         figure (dict): Plotly figure.
@@ -544,19 +1117,37 @@ def conform_figure(figure, color_scheme):
         if key in color_scheme:
             lut[val] = color_scheme[key]
 
-    # rgba? to hex --> coerce to standard colors --> coerce with color_scheme
-    figure = rpb.BlobETL(figure) \
-        .set(
-            predicate=lambda k, v: isinstance(v, str) and 'rgb' in v,
-            value_setter=lambda k, v: webcolors.rgb_to_hex(parse_rgba(v)[:3]).upper()) \
-        .set(
-            predicate=lambda k, v: isinstance(v, str),
-            value_setter=lambda k, v: COLOR_COERCION_LUT.get(v, v)) \
-        .set(
-            predicate=lambda k, v: isinstance(v, str),
-            value_setter=lambda k, v: lut.get(v, v)) \
-        .to_dict()
-    return figure
+    # composite lut: coerce to standard colors --> coerce with color_scheme
+    composite = {}
+    for key in set(COLOR_COERCION_LUT.keys()).union(lut.keys()):
+        val = COLOR_COERCION_LUT.get(key, key)
+        composite[key] = lut.get(val, val)
+
+    # memo of conformed strings, shared by per-point color arrays
+    memo = {}  # type: Dict[str, str]
+
+    def conform_string(value):
+        # type: (str) -> str
+        if value not in memo:
+            color = value
+            if 'rgb' in value:
+                rgba = parse_rgba(value)
+                if rgba is not None:
+                    color = webcolors.rgb_to_hex(rgba[:3]).upper()
+            memo[value] = composite.get(color, color)
+        return memo[value]
+
+    def conform_item(item):
+        # type: (Any) -> Any
+        if isinstance(item, str):
+            return conform_string(item)
+        if isinstance(item, dict):
+            return {k: conform_item(v) for k, v in item.items()}
+        if isinstance(item, (list, tuple)):
+            return [conform_item(x) for x in item]
+        return item
+
+    return conform_item(figure)
 
 
 # SQL-PARSING-------------------------------------------------------------------
@@ -591,9 +1182,10 @@ def get_sql_grammar():
     return grammar
 
 
-def query_data(data, query, uri='sqlite:///:memory:'):
+def query_data(data, query, engine=None, timeout=None, cancel=None):
+    # type: (DataFrame, str, Optional[Engine], Optional[float], Optional[Event]) -> DataFrame
     '''
-    Parses SQL + regex query and applies it to given data.
+    Applies given SQL + regex query to given data, as a single SQL statement.
 
     Regex operators:
 
@@ -603,70 +1195,129 @@ def query_data(data, query, uri='sqlite:///:memory:'):
     Args:
         data (DataFrame): DataFrame to be queried.
         query (str): SQL query that may include regex operators.
+        engine (Engine, optional): Engine with data already loaded. If given,
+            query runs against it. Otherwise data is loaded into a temporary
+            engine. Default: None.
+        timeout (float, optional): Time limit in seconds. Default: None.
+        cancel (Event, optional): Event which cancels query when set.
+            Default: None.
+
+    Raises:
+        PandaSQLException: If query is invalid.
+        TimeoutError: If query exceeds time limit.
+        InterruptedError: If query is cancelled.
 
     Returns:
         DataFrame: Data filtered by query.
     '''
-    # split queries by where/and/or
-    queries = re.split(' where | and | or ', query, flags=re.I)
+    if engine is not None:
+        return engine.query(query, timeout=timeout, cancel=cancel)
 
-    # detect whether any sub query has a regex operator
-    has_regex = False
-    for q in queries:
-        if re.search(' regex | ~ | !~ ', q, flags=re.I):
-            has_regex = True
-            break
+    engine = Engine(data)
+    try:
+        return engine.query(query, timeout=timeout, cancel=cancel)
+    finally:
+        engine.close()
 
-    # if no regex operator is found just submit query to pandasql
-    if not has_regex:
-        data = pandasql.PandaSQL(uri)(query, locals())
 
-    else:
-        grammar = get_sql_grammar()
-
-        # move select statement to end
-        if 'select' in queries[0]:
-            q = queries.pop(0)
-            queries.append(q)
-
-        for q in queries:
-            # get column, operator and value
-            parse = grammar.parseString(q).asDict()
-            op = parse['operator']
-
-            # initial select statement
-            if op == 'select':
-                data = pandasql.PandaSQL(uri)(q, locals())
-
-            # regex search
-            elif op == '~':
-                mask = data[parse['column']] \
-                    .astype(str) \
-                    .apply(lambda x: re.search(parse['value'], x, flags=re.I)) \
-                    .astype(bool)
-                data = data[mask]
-
-            # regex not search
-            elif op == '!~':
-                mask = data[parse['column']] \
-                    .astype(str) \
-                    .apply(lambda x: re.search(parse['value'], x, flags=re.I)) \
-                    .astype(bool)
-                data = data[~mask]
-
-            # ther SQL query
-            else:
-                data = pandasql.sqldf('select * from data where ' + q, {'data': data})
-
-            if len(data) == 0:
-                break
-    return data
+def _close_flat_entry(entry):
+    # type: (Dict[str, Any]) -> None
+    '''
+    Detaches engine of given entry evicted from FLAT_DICT_CACHE, if it has
+    one, and retires it, so that it is closed once its running queries finish.
+
+    Args:
+        entry (dict): Cache entry.
+    '''
+    with entry['lock']:
+        engine = entry['engine']
+        entry['engine'] = None
+    if engine is not None:
+        engine.retire()
+
+
+FLAT_DICT_CACHE = sch.LRUCache(
+    max_bytes=16 * 1024**2, on_evict=_close_flat_entry
+)
+'''
+Cache of flattened dicts and the engines which hold them, keyed by dict hash.
+Entry sizes include the tables held by their engines, and engines are retired
+when their entries are evicted.
+'''
+
+
+def _get_flat_entry(data):
+    # type: (dict) -> Dict[str, Any]
+    '''
+    Gets cache entry of given dict from FLAT_DICT_CACHE, flattening dict if
+    it is not cached.
+
+    Args:
+        data (dict): Dictionary.
+
+    Returns:
+        dict: Entry with key, flat dict, engine, which is None until queried,
+            and a lock which guards engine.
+    '''
+    key = sch.get_hash(data)
+    entry = FLAT_DICT_CACHE.get(key)
+    if entry is None:
+        flat = rpb.BlobETL(data).to_flat_dict()
+        entry = dict(key=key, flat=flat, engine=None, lock=Lock())
+        FLAT_DICT_CACHE.set(key, entry, size=sch.get_size(flat))
+    return entry
+
+
+def flatten_dict(data):
+    # type: (dict) -> Dict[str, Any]
+    '''
+    Flattens given dict into a dict of key paths and values.
+    Flat dicts are cached by content, so each dict is only flattened once.
+
+    Args:
+        data (dict): Dictionary.
+
+    Returns:
+        dict: Flat dictionary.
+    '''
+    return dict(_get_flat_entry(data)['flat'])
+
+
+def edit_flat_dict(data, old_key, new_key, value):
+    # type: (dict, str, str, Any) -> dict
+    '''
+    Replaces given flat key of given dict with given new key and value.
+    Only the edited item changes, the cached flat dict is not re-flattened.
+    The flat dict of the edited dict is cached.
+
+    Args:
+        data (dict): Dictionary.
+        old_key (str): Flat key to be replaced.
+        new_key (str): New flat key.
+        value (object): New value.
+
+    Returns:
+        dict: Edited dictionary. Unchanged copy if old_key is not in dict.
+    '''
+    flat = flatten_dict(data)
+    if old_key in flat:
+        del flat[old_key]
+        flat[new_key] = value
+    output = rpb.BlobETL(flat).to_dict()
+
+    key = sch.get_hash(output)
+    if key not in FLAT_DICT_CACHE:
+        entry = dict(key=key, flat=flat, engine=None, lock=Lock())
+        FLAT_DICT_CACHE.set(key, entry, size=sch.get_size(flat))
+    return output
 
 
 def query_dict(data, query):
     # type: (dict, str) -> dict
     '''
     Query a given diction with a given SQL query.
+    Queries run against a key, value table of the flattened dictionary,
+    which is cached along with its engine.
 
     Args:
         data (dict): Dictionary to be queried.
@@ -675,12 +1326,27 @@ def query_dict(data, query):
     Returns:
         dict: Queried dictionary.
     '''
-    data_ = data  # type: Any
-    data_ = rpb.BlobETL(data_) \
-        .to_flat_dict() \
-        .items()
-    data_ = DataFrame(list(data_), columns=['key', 'value'])
-    data_ = query_data(data_, query)
+    entry = _get_flat_entry(data)
+    table = None
+    with entry['lock']:
+        engine = entry['engine']
+        if engine is None:
+            table = DataFrame(
+                list(entry['flat'].items()), columns=['key', 'value']
+            )
+            engine = Engine(table)
+            entry['engine'] = engine
+        engine.retain()
+
+    try:
+        data_ = engine.query(query)  # type: Any
+    finally:
+        engine.release()
+        if table is not None:
+            # engine holds a copy of table, so entry is resized
+            size = sch.get_size(entry['flat']) + sch.get_size(table)
+            FLAT_DICT_CACHE.set(entry['key'], entry, size=size)
+
     data_ = dict(zip(data_.key.tolist(), data_.value.tolist()))
     data_ = rpb.BlobETL(data_).to_dict()
     return data_
@@ -1,13 +1,20 @@
 from copy import deepcopy
 from datetime import datetime
+from threading import Barrier, Thread
+import json
 import re
 import unittest
+import unittest.mock as mock
 
 from lunchbox.enforce import EnforceError
 from pandas import DataFrame, Series
 from schematics.exceptions import DataError
+import numpy as np
+import pandas as pd
 import pandasql
 
+from shekels.core.engine import Engine
+import shekels.core.cache as sch
 import shekels.core.data_tools as sdt
 import shekels.enforce.enforce_tools as eft
 # ------------------------------------------------------------------------------
@@ -154,6 +161,86 @@ class DataToolsTests(unittest.TestCase):
         with self.assertRaisesRegex(ValueError, expected):
             sdt.conform(data, actions=[ow, sub, bad])
 
+    # TO-RECORDS----------------------------------------------------------------
+    def test_to_records(self):
+        data = self.get_data()
+        data = sdt.conform(data)
+        result = sdt.to_records(data)
+        expected = data.copy()
+        expected.date = expected.date.apply(lambda x: x.isoformat())
+        expected = expected.replace({np.nan: None}).to_dict(orient='records')
+        self.assertEqual(result, expected)
+
+    def test_to_records_no_date(self):
+        data = DataFrame([[1, np.nan]], columns=['foo', 'bar'])
+        result = sdt.to_records(data)
+        self.assertEqual(result, [{'foo': 1, 'bar': None}])
+
+    def test_to_records_null_date(self):
+        data = DataFrame()
+        data['date'] = pd.to_datetime(['2020-01-01', None])
+        data['amount'] = [1.5, np.nan]
+        result = sdt.to_records(data)
+        expected = [
+            {'date': '2020-01-01T00:00:00', 'amount': 1.5},
+            {'date': None, 'amount': None},
+        ]
+        self.assertEqual(result, expected)
+        self.assertIs(type(result[0]['amount']), float)
+
+    def test_to_json(self):
+        data = sdt.conform(self.get_data())
+        data.loc[0, 'date'] = None
+        data['count'] = range(len(data))
+        data['flag'] = True
+        data['mixed'] = [[1], {'a': 1}] + [None] * (len(data) - 2)
+        data.loc[1, 'amount'] = np.inf
+        data.loc[2, 'description'] = 'a "quoted"\nvalue é'
+        result = sdt.to_json(data)
+        expected = json.dumps(sdt.to_records(data)).encode('utf-8')
+        self.assertEqual(result, expected)
+
+        # nullable and non-string column names
+        data = DataFrame({
+            0: pd.array([1, None], dtype='Int64'),
+            1: pd.array([True, None], dtype='boolean'),
+            2: np.array([0.1, np.nan], dtype=np.float32),
+        })
+        result = sdt.to_json(data)
+        expected = json.dumps(sdt.to_records(data)).encode('utf-8')
+        self.assertEqual(result, expected)
+
+        self.assertEqual(sdt.to_json(DataFrame()), b'[]')
+        self.assertEqual(sdt.to_json(DataFrame(index=[0, 1])), b'[]')
+
+    def test_serialize_dates(self):
+        data = DataFrame()
+        data['date'] = pd.to_datetime([
+            '2020-01-01',
+            '2020-01-01 01:02:03.5',
+            '2020-01-01 00:00:00.000000001',
+            None,
+        ])
+        data['amount'] = 1
+        result = sdt.serialize_dates(data)
+        expected = [x.isoformat() for x in data.date[:3]] + [None]
+        self.assertEqual(result.date.tolist(), expected)
+        self.assertEqual(result.date.tolist()[1], '2020-01-01T01:02:03.500000')
+        self.assertEqual(data.date.dtype.kind, 'M')
+
+        data.date = data.date.dt.tz_localize('UTC')
+        result = sdt.serialize_dates(data)
+        expected = [x.isoformat() for x in data.date[:3]] + [None]
+        self.assertEqual(result.date.tolist(), expected)
+        self.assertEqual(result.date.tolist()[0], '2020-01-01T00:00:00+00:00')
+
+    def test_to_records_no_mutation(self):
+        result = self.get_data()
+        result = sdt.conform(result)
+        expected = result.copy()
+        sdt.to_records(result)
+        eft.enforce_dataframes_are_equal(result, expected)
+
     # FILTER-DATA---------------------------------------------------------------
     def get_data_2(self):
         data = DataFrame()
@@ -460,6 +547,131 @@ class DataToolsTests(unittest.TestCase):
         self.assertEqual(result.index.tolist(), [1, 2, 3, 4, 5])
 
     # GET-FIGURE----------------------------------------------------------------
+    def test_get_stages(self):
+        filt = dict(column='Amount', comparator='==', value='donotmatch')
+        grp = dict(columns=['Description'], metric='count')
+        pvt = dict(columns=['Description'], values=['Amount'], index='Date')
+
+        result = sdt.get_stages()
+        self.assertEqual(result, ())
+
+        result = sdt.get_stages(filters=[filt, filt], group=grp, pivot=pvt)
+        result = [x.stage for x in result]
+        self.assertEqual(result, ['filter', 'filter', 'group', 'pivot'])
+
+        result = dict(sdt.get_stages(group=grp)[0].action)
+        self.assertEqual(result['datetime_column'], 'date')
+
+        # keys hash stage prefixes
+        a = sdt.get_stages(filters=[filt], group=grp)
+        b = sdt.get_stages(filters=[filt], pivot=pvt)
+        self.assertEqual(a[0].key, b[0].key)
+        self.assertNotEqual(a[1].key, b[1].key)
+
+        expected = 'Invalid pivot.*columns.*This field is required'
+        with self.assertRaisesRegex(DataError, expected):
+            sdt.get_stages(pivot=dict(values=['Amount'], index='Date'))
+
+    def test_execute_stages(self):
+        data = self.get_data()
+        filt = dict(column='Account Name', comparator='==', value='AMEX')
+        grp = dict(columns=['Category'], metric='count', datetime_column='Date')
+        stages = sdt.get_stages(filters=[filt], group=grp)
+
+        expected = sdt.group_data(
+            sdt.filter_data(data, 'Account Name', '==', 'AMEX'),
+            ['Category'],
+            'count',
+            datetime_column='Date',
+        )
+        result = sdt.execute_stages(data, stages)
+        self.assertEqual(result.to_dict(), expected.to_dict())
+        self.assertEqual(data.columns.tolist(), self.get_data().columns.tolist())
+
+        result = sdt.execute_stages(data, [])
+        self.assertIs(result, data)
+
+    def test_execute_stages_memo(self):
+        data = self.get_data()
+        filt = dict(column='Account Name', comparator='==', value='AMEX')
+        grp = dict(columns=['Category'], metric='count', datetime_column='Date')
+        a = sdt.get_stages(filters=[filt])
+        b = sdt.get_stages(filters=[filt], group=grp)
+
+        memo = {}
+        filtered = sdt.execute_stages(data, a, memo=memo)
+        self.assertEqual(len(memo), 1)
+
+        sdt.execute_stages(data, b, memo=memo)
+        self.assertEqual(len(memo), 2)
+        self.assertIs(sdt.execute_stages(data, a, memo=memo), filtered)
+
+        # shared prefixes are read from memo
+        memo = {key: filtered.head(1) for key in memo.keys()}
+        result = sdt.execute_stages(data, a, memo=memo)
+        self.assertEqual(len(result), 1)
+
+    def test_compile_plot(self):
+        plot = dict(
+            filters=[dict(column='Amount', comparator='>', value=0)],
+            figure=dict(kind='line', color_scheme=dict(cyan2='#FF0000')),
+        )
+        result = sdt.compile_plot(plot, dict(grey1='#0000FF'))
+        self.assertIsInstance(result, sdt.PlotPlan)
+        self.assertEqual(result.min_width, 25)
+        self.assertEqual([x.stage for x in result.stages], ['filter'])
+
+        figure = dict(result.figure)
+        self.assertEqual(figure['kind'], 'line')
+        self.assertEqual(
+            dict(figure['color_scheme']),
+            dict(grey1='#0000FF', cyan2='#FF0000')
+        )
+
+        # keys
+        expected = sdt.compile_plot(deepcopy(plot), dict(grey1='#0000FF'))
+        self.assertEqual(result.key, expected.key)
+
+        expected = sdt.compile_plot(plot, dict(grey1='#000000'))
+        self.assertNotEqual(result.key, expected.key)
+
+        with self.assertRaisesRegex(DataError, 'foo is not a legal plot kind'):
+            sdt.compile_plot(dict(figure=dict(kind='foo')))
+
+    def test_get_plans(self):
+        plot = {"figure": {"kind": "line"}}
+        sdt.PLOT_PLAN_CACHE.clear()
+        result = sdt.get_plans([plot, plot], {'grey1': '#000000'})
+        self.assertEqual(len(result), 2)
+        self.assertEqual(dict(result[0].figure)['kind'], 'line')
+
+        # cached
+        with mock.patch.object(sdt, 'compile_plot') as compile_plot:
+            expected = sdt.get_plans([plot, plot], {'grey1': '#000000'})
+            compile_plot.assert_not_called()
+        self.assertIs(result, expected)
+
+        expected = 'Plots must be a list of dictionaries. Given value: foo.'
+        with self.assertRaisesRegex(EnforceError, expected):
+            sdt.get_plans(['foo'])
+
+        with self.assertRaisesRegex(DataError, 'kind'):
+            sdt.get_plans([{"figure": {"kind": "foo"}}])
+
+    def test_execute_plan(self):
+        data = self.get_figure_data()
+        plan = sdt.compile_plot(dict(
+            filters=[dict(column='foo', comparator='>', value=1.0)],
+            figure=dict(kind='line', color_scheme=dict(cyan2='#FF0000')),
+        ))
+        result = sdt.execute_plan(data, plan)
+        self.assertEqual(result['data'][0]['y'], [2.0, 4.0])
+        self.assertEqual(result['data'][0]['line']['color'], '#FF0000')
+
+        memo = {}
+        sdt.execute_plan(data, plan, memo=memo)
+        self.assertEqual(list(memo.keys()), [plan.stages[0].key])
+
     def test_get_figure_filter_error(self):
         data = self.get_data()
         good = dict(
@@ -581,11 +793,11 @@ class DataToolsTests(unittest.TestCase):
 
         # kind
         result = fig['data'][0]['type']
-        self.assertEqual(result, 'histogram')
+        self.assertEqual(result, 'bar')
 
         # bins
-        result = fig['data'][0]['nbinsx']
-        self.assertEqual(result, 100)
+        result = fig['data'][0]['x']
+        self.assertEqual(len(result), 100)
 
         # title
         result = fig['layout']['title']['text']
@@ -598,6 +810,196 @@ class DataToolsTests(unittest.TestCase):
         # y_title
         result = fig['layout']['yaxis']['title']['text']
         self.assertEqual(result, 'bars')
+
+    # BUILD-FIGURE--------------------------------------------------------------
+    def get_figure_data(self):
+        data = DataFrame()
+        data['foo'] = [1.0, 2.0, 4.0]
+        data['bar'] = [2.0, 2.0, 1.0]
+        data['date'] = [
+            datetime(2021, 1, 1), datetime(2021, 1, 2), datetime(2021, 1, 3)
+        ]
+        return data.set_index('date')
+
+    def test_build_figure_errors(self):
+        data = self.get_figure_data()
+
+        expected = 'foo is not a legal plot kind.'
+        with self.assertRaisesRegex(EnforceError, expected):
+            sdt.build_figure(data, kind='foo')
+
+        expected = r"Given columns not found in data. \['taco'\]"
+        with self.assertRaisesRegex(EnforceError, expected):
+            sdt.build_figure(data, x_axis='taco')
+
+        expected = 'Spread plots require at least 2 traces. Given traces: 1.'
+        with self.assertRaisesRegex(EnforceError, expected):
+            sdt.build_figure(data[['foo']], kind='spread')
+
+    def test_build_figure_layout(self):
+        data = self.get_figure_data()
+        cs = dict(grey1='#0000FF', light2='#00FF00')
+        result = sdt.build_figure(
+            data,
+            color_scheme=cs,
+            title='title',
+            x_title='x',
+            y_title='y',
+            bar_mode='group',
+        )['layout']
+        self.assertEqual(result['barmode'], 'group')
+        self.assertEqual(result['paper_bgcolor'], '#0000FF')
+        self.assertEqual(result['plot_bgcolor'], '#0000FF')
+        self.assertEqual(result['legend']['bgcolor'], '#0000FF')
+        self.assertEqual(result['title'], dict(text='title', font=dict(color='#00FF00')))
+        self.assertEqual(result['xaxis']['title']['text'], 'x')
+        self.assertEqual(result['yaxis']['title']['text'], 'y')
+        self.assertEqual(result['xaxis']['zerolinecolor'], '#444444')
+
+    def test_build_figure_bar(self):
+        data = self.get_figure_data()
+        result = sdt.build_figure(data, kind='bar', color_scheme=dict(red2='#FF0000'))
+        result = result['data']
+        self.assertEqual(len(result), 2)
+        self.assertEqual([x['name'] for x in result], ['foo', 'bar'])
+        self.assertEqual(result[0]['type'], 'bar')
+        self.assertEqual(result[0]['orientation'], 'v')
+        self.assertEqual(result[0]['x'], data.index.tolist())
+        self.assertEqual(result[0]['y'], [1.0, 2.0, 4.0])
+        self.assertEqual(result[0]['marker']['color'], '#B6ECF3')
+        self.assertEqual(result[1]['marker']['color'], '#FF0000')
+
+        result = sdt.build_figure(data, kind='barh')['data'][0]
+        self.assertEqual(result['orientation'], 'h')
+        self.assertEqual(result['x'], [1.0, 2.0, 4.0])
+        self.assertEqual(result['y'], data.index.tolist())
+
+    def test_build_figure_axes(self):
+        data = self.get_figure_data()
+        result = sdt.build_figure(data, kind='line', x_axis='foo')['data']
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['x'], [1.0, 2.0, 4.0])
+        self.assertEqual(result[0]['y'], [2.0, 2.0, 1.0])
+
+        result = sdt.build_figure(data, kind='line', y_axis='bar')['data']
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]['name'], 'bar')
+
+    def test_build_figure_line(self):
+        data = self.get_figure_data()
+        for kind in ['line', 'lines', 'area', 'scatter']:
+            result = sdt.build_figure(data, kind=kind)['data'][0]
+            self.assertEqual(result['type'], 'scatter')
+            self.assertEqual(result['line']['color'], '#B6ECF3')
+
+        result = sdt.build_figure(data, kind='line')['data'][0]
+        self.assertEqual(result['mode'], 'lines')
+
+        result = sdt.build_figure(data, kind='scatter')['data'][0]
+        self.assertEqual(result['mode'], 'markers')
+
+        result = sdt.build_figure(data, kind='area')['data'][0]
+        self.assertEqual(result['stackgroup'], 1)
+
+    def test_downsample(self):
+        expected = 'Max points must be greater or equal to 4. 3 < 4.'
+        with self.assertRaisesRegex(EnforceError, expected):
+            sdt.downsample([1, 2, 3], 3)
+
+        result = sdt.downsample([1, 2, 3], 4).tolist()
+        self.assertEqual(result, [0, 1, 2])
+
+        values = np.sin(np.linspace(0, 20, 1000))
+        values[500] = 10
+        values[600] = -10
+        values[700] = np.nan
+        result = sdt.downsample(values, 100)
+        self.assertLessEqual(len(result), 100)
+        self.assertEqual(result[0], 0)
+        self.assertEqual(result[-1], 999)
+        self.assertIn(500, result)
+        self.assertIn(600, result)
+        self.assertNotIn(700, result)
+        self.assertEqual(result.tolist(), sorted(result.tolist()))
+
+        # uneven buckets
+        result = sdt.downsample(np.arange(7), 6)
+        self.assertLessEqual(len(result), 6)
+        self.assertEqual(result[-1], 6)
+
+    def test_build_figure_max_points(self):
+        data = DataFrame()
+        data['foo'] = np.arange(100, dtype=float)
+        data['bar'] = np.arange(100, dtype=float)[::-1]
+        data['bar'] = data['bar'].astype(object)
+
+        expected = 'Max points must be greater or equal to 4. 2 < 4.'
+        with self.assertRaisesRegex(EnforceError, expected):
+            sdt.build_figure(data, kind='line', max_points=2)
+
+        for kind in ['line', 'lines', 'scatter', 'area']:
+            result = sdt.build_figure(data, kind=kind, max_points=10)['data']
+            for trace in result:
+                self.assertLessEqual(len(trace['x']), 10)
+                self.assertEqual(len(trace['x']), len(trace['y']))
+                self.assertEqual(trace['x'][0], 0)
+                self.assertEqual(trace['x'][-1], 99)
+
+        # area traces share indices
+        result = sdt.build_figure(data, kind='area', max_points=10)['data']
+        self.assertEqual(result[0]['x'], result[1]['x'])
+
+        # other kinds are untouched
+        result = sdt.build_figure(data, kind='bar', max_points=10)['data']
+        self.assertEqual(len(result[0]['x']), 100)
+
+        result = sdt.build_figure(data, kind='line', max_points=100)['data']
+        self.assertEqual(len(result[0]['x']), 100)
+
+    def test_build_figure_histogram(self):
+        data = self.get_figure_data()
+        data.loc[data.index[0], 'foo'] = None
+        result = sdt.build_figure(data, kind='histogram', bins=2)
+        self.assertEqual(result['layout']['bargap'], 0)
+
+        # bin edges are shared by traces: foo=[2, 4], bar=[2, 2, 1]
+        foo, bar = result['data']
+        self.assertEqual(foo['type'], 'bar')
+        self.assertEqual(foo['x'], [1.75, 3.25])
+        self.assertEqual(foo['width'], [1.5, 1.5])
+        self.assertEqual(foo['y'], [1, 1])
+        self.assertEqual(bar['x'], foo['x'])
+        self.assertEqual(bar['y'], [3, 0])
+
+        # payload does not grow with data
+        data = DataFrame(dict(foo=np.random.rand(10000)))
+        result = sdt.build_figure(data, kind='hist', bins=10)['data'][0]
+        self.assertEqual(len(result['x']), 10)
+        self.assertEqual(sum(result['y']), 10000)
+
+        # no data
+        data = DataFrame(dict(foo=[None, None]))
+        result = sdt.build_figure(data, kind='hist', bins=10)['data'][0]
+        self.assertEqual(sum(result['y']), 0)
+
+    def test_build_figure_spread(self):
+        data = self.get_figure_data()
+        result = sdt.build_figure(data, kind='spread')
+        self.assertEqual(len(result['data']), 4)
+        self.assertEqual(result['layout']['yaxis2']['domain'], [0, 0.25])
+        self.assertEqual(result['layout']['xaxis2']['anchor'], 'y2')
+
+        pos, neg = result['data'][2:]
+        self.assertEqual(pos['yaxis'], 'y2')
+        self.assertEqual(pos['y'][1:], [0.0, 3.0])
+        self.assertEqual(neg['y'][0], -1.0)
+
+    def test_build_figure_ratio(self):
+        data = self.get_figure_data()
+        result = sdt.build_figure(data, kind='ratio')
+        self.assertEqual(len(result['data']), 3)
+        self.assertEqual(result['layout']['yaxis2']['title']['text'], 'Ratio')
+        self.assertEqual(result['data'][2]['y'], [0.5, 1.0, 4.0])
     # --------------------------------------------------------------------------
 
     def test_parse_rgba(self):
@@ -617,10 +1019,10 @@ class DataToolsTests(unittest.TestCase):
         self.assertIsNone(result)
 
     def test_conform_figure(self):
-        data = self.get_data_2()
-        fig = data.iplot(
-            asFigure=True, theme='henanigans', colorscale='henanigans'
-        ).to_dict()
+        fig = dict(
+            data=[dict(line=dict(color='rgba(182, 236, 243, 1.0)'))],
+            layout=dict(legend=dict(bgcolor='#242424')),
+        )
         expected1 = '#0000FF'
         expected2 = '#FF0000'
         color_scheme = {
@@ -635,6 +1037,25 @@ class DataToolsTests(unittest.TestCase):
         result = temp['data'][0]['line']['color']
         self.assertEqual(result, expected2)
 
+    def test_conform_figure_arrays(self):
+        colors = ['rgba(182, 236, 243, 0.6)', '#EF553B', 'rgb(foo)', 'red']
+        fig = dict(
+            data=[dict(marker=dict(color=colors * 2), x=[1, 2], name='kiwi')],
+            layout=dict(legend=dict(bgcolor='#242424'), bargap=0.1),
+        )
+        expected = deepcopy(fig)
+        result = sdt.conform_figure(fig, {'cyan2': '#FF0000'})
+
+        expected_colors = ['#FF0000', '#F77E70', 'rgb(foo)', 'red'] * 2
+        self.assertEqual(result['data'][0]['marker']['color'], expected_colors)
+        self.assertEqual(result['data'][0]['x'], [1, 2])
+        self.assertEqual(result['data'][0]['name'], 'kiwi')
+        self.assertEqual(result['layout']['bargap'], 0.1)
+        self.assertEqual(result['layout']['legend']['bgcolor'], '#242424')
+
+        # no mutation
+        self.assertEqual(fig, expected)
+
     # SQL-PARSING---------------------------------------------------------------
     def test_get_sql_grammar_select(self):
         grammar = sdt.get_sql_grammar()
@@ -707,6 +1128,48 @@ class DataToolsTests(unittest.TestCase):
         expected = pandasql.sqldf(query, dict(data=data))
         eft.enforce_dataframes_are_equal(result, expected)
 
+    def test_query_data_engine(self):
+        data = DataFrame()
+        data['foo'] = ['a', 'b', 'c']
+        data['bar'] = [1, 2, 3]
+        engine = Engine(data)
+        result = sdt.query_data(data, 'select * from data where bar > 1', engine=engine)
+        self.assertEqual(result.foo.tolist(), ['b', 'c'])
+
+        # regex queries also run against engine
+        with mock.patch.object(sdt, 'Engine') as klass:
+            result = sdt.query_data(
+                data, "select * from data where foo ~ 'a|c'", engine=engine
+            )
+            klass.assert_not_called()
+        self.assertEqual(result.foo.tolist(), ['a', 'c'])
+        engine.close()
+
+    def test_query_data_timeout(self):
+        engine = mock.MagicMock()
+        cancel = mock.Mock()
+        sdt.query_data(None, 'foo', engine=engine, timeout=5, cancel=cancel)
+        engine.query.assert_called_once_with('foo', timeout=5, cancel=cancel)
+
+    def test_query_data_regex_or(self):
+        data = self.get_data()
+        query = 'select Description from data where '
+        query += "Category ~ 'fancy' or (Description regex kiwi and Amount > 50)"
+        result = sdt.query_data(data, query).Description.tolist()
+        self.assertEqual(result, ['Kiwi', 'FooBar'])
+
+        query = 'select Description from data where '
+        query += "not (Category !~ 'food') or Account_Name = 'Discover'"
+        data = data.rename(columns={'Account Name': 'Account_Name'})
+        result = sdt.query_data(data, query).Description.tolist()
+        self.assertEqual(result, ['Kiwi', 'BBsPizza', 'Ignore'])
+
+    def test_query_data_regex_error(self):
+        data = self.get_data()
+        query = "select * from data where Category ~ '(('"
+        with self.assertRaises(pandasql.PandaSQLException):
+            sdt.query_data(data, query)
+
     def test_query_data_empty(self):
         data = self.get_data()
         query = 'select * from data where '
@@ -797,3 +1260,100 @@ class DataToolsTests(unittest.TestCase):
             'taco': 'pizza'
         }
         self.assertEqual(result, expected)
+
+    def test_query_dict_cache(self):
+        data = {'foo': {'bar': 'a', 'baz': 'b'}, 'taco': 'pizza'}
+        sdt.FLAT_DICT_CACHE.clear()
+        with mock.patch.object(sdt, 'Engine', wraps=Engine) as engine:
+            with mock.patch.object(
+                sdt.rpb.BlobETL, 'to_flat_dict', autospec=True,
+                side_effect=sdt.rpb.BlobETL.to_flat_dict,
+            ) as flatten:
+                result = sdt.query_dict(data, 'select * from data where key ~ foo')
+                self.assertEqual(result, {'foo': {'bar': 'a', 'baz': 'b'}})
+                result = sdt.query_dict(deepcopy(data), 'select * from data')
+                self.assertEqual(result, data)
+                self.assertEqual(flatten.call_count, 1)
+                self.assertEqual(engine.call_count, 1)
+
+    def test_query_dict_eviction(self):
+        data = {'foo': {'bar': 'a', 'baz': 'b'}, 'taco': 'pizza'}
+        sdt.FLAT_DICT_CACHE.clear()
+        sdt.query_dict(data, 'select * from data')
+
+        # entry size includes table held by engine
+        entry = sdt.FLAT_DICT_CACHE.get(sch.get_hash(data))
+        self.assertGreater(
+            sdt.FLAT_DICT_CACHE.size, sch.get_size(entry['flat'])
+        )
+
+        # engine is closed on eviction
+        engine = entry['engine']
+        with mock.patch.object(engine, 'close', wraps=engine.close) as close:
+            sdt.FLAT_DICT_CACHE.clear()
+            close.assert_called_once()
+        self.assertEqual(engine._connections, [])
+        self.assertIsNone(entry['engine'])
+
+    def test_query_dict_eviction_during_query(self):
+        data = {'foo': {'bar': 'a', 'baz': 'b'}, 'taco': 'pizza'}
+        sdt.FLAT_DICT_CACHE.clear()
+        sdt.query_dict(data, 'select * from data')
+        engine = sdt.FLAT_DICT_CACHE.get(sch.get_hash(data))['engine']
+
+        def query(*args, **kwargs):
+            sdt.FLAT_DICT_CACHE.clear()
+            self.assertNotEqual(engine._connections, [])
+            return Engine.query(engine, *args, **kwargs)
+
+        # engine is closed once query finishes
+        with mock.patch.object(engine, 'query', side_effect=query):
+            result = sdt.query_dict(data, 'select * from data where key ~ taco')
+        self.assertEqual(result, {'taco': 'pizza'})
+        self.assertEqual(engine._connections, [])
+
+    def test_query_dict_threads(self):
+        data = {'foo': {'bar': 'a', 'baz': 'b'}, 'taco': 'pizza'}
+        sdt.FLAT_DICT_CACHE.clear()
+        barrier = Barrier(10)
+        results = []  # type: list
+
+        def query():
+            barrier.wait()
+            results.append(sdt.query_dict(data, 'select * from data'))
+
+        with mock.patch.object(sdt, 'Engine', wraps=Engine) as engine:
+            threads = [Thread(target=query) for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(engine.call_count, 1)
+        self.assertEqual(results, [data] * 10)
+
+    def test_flatten_dict(self):
+        data = {'foo': {'bar': 1}, 'taco': 'pizza'}
+        sdt.FLAT_DICT_CACHE.clear()
+        result = sdt.flatten_dict(data)
+        self.assertEqual(result, {'foo/bar': 1, 'taco': 'pizza'})
+
+        # returns a copy
+        result['foo/bar'] = 2
+        self.assertEqual(sdt.flatten_dict(data)['foo/bar'], 1)
+        self.assertEqual(len(sdt.FLAT_DICT_CACHE), 1)
+
+    def test_edit_flat_dict(self):
+        data = {'foo': {'bar': 1}, 'taco': 'pizza'}
+        sdt.FLAT_DICT_CACHE.clear()
+        result = sdt.edit_flat_dict(data, 'foo/bar', 'foo/baz', 2)
+        self.assertEqual(result, {'foo': {'baz': 2}, 'taco': 'pizza'})
+        self.assertEqual(data, {'foo': {'bar': 1}, 'taco': 'pizza'})
+
+        # edited dict is cached
+        with mock.patch.object(sdt.rpb.BlobETL, 'to_flat_dict') as flatten:
+            result = sdt.flatten_dict(result)
+            flatten.assert_not_called()
+        self.assertEqual(result, {'foo/baz': 2, 'taco': 'pizza'})
+
+        result = sdt.edit_flat_dict(data, 'foo/qux', 'foo/baz', 2)
+        self.assertEqual(result, data)
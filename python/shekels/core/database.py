@@ -1,15 +1,25 @@
-from typing import List, Union  # noqa: F401
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union  # noqa: F401
 from pathlib import Path  # noqa: F401
 
+from contextlib import contextmanager
 from copy import deepcopy
-from functools import lru_cache
+from threading import Event, Lock  # noqa: F401
+import hashlib
+import json
+import mmap
+import time
 
+from lunchbox.enforce import Enforce
 import jsoncomment as jsonc
 import numpy as np
 import pandas as pd
 
+from shekels.core.cache import LRUCache
 from shekels.core.config import Config
+from shekels.core.engine import Engine
+from shekels.core.store import SharedStore
 import shekels.core.data_tools as sdt
+import shekels.core.planner as spl
 # ------------------------------------------------------------------------------
 
 
@@ -17,6 +27,10 @@ class Database:
     '''
     Database is a class for wrapping a mint transaction DataFrame with a simple
     CRUD-like API. API methods include: update, read and search.
+
+    If config's shared_store is set, data is shared between processes. Updates
+    publish data to the store, and sync attaches to data published by other
+    processes, without reading the CSV.
     '''
     @staticmethod
     def from_json(filepath):
@@ -46,23 +60,66 @@ class Database:
         config.validate()
         self._config = config.to_primitive()
         self._data = None  # type: Union[None, pd.DataFrame]
+        self._engine = None  # type: Optional[Engine]
+        self._version = 0
+        self._records = None  # type: Optional[List[dict]]
+        self._json = None  # type: Union[None, bytes, mmap.mmap]
+        self._digest = ''
+        self._cache = LRUCache(max_bytes=self._config['search_cache_size'])
+        self._lock = Lock()
+        self._swap_lock = Lock()
+        self._store = None  # type: Optional[SharedStore]
+        if self._config['shared_store'] is not None:
+            self._store = SharedStore(self._config['shared_store'])
 
     @staticmethod
-    def _to_records(data):
-        # type: (pd.DataFrame) -> List[dict]
+    def _freeze(data):
+        # type: (pd.DataFrame) -> pd.DataFrame
         '''
-        Converts given DataFrame to a list of JSONifiable dicts.
+        Returns a read-only view of given DataFrame, sharing its memory.
+        Writes to the view, or to any view of it, raise a ValueError.
+        Columns backed by extension arrays, such as nullable booleans, are
+        left writable.
 
         Args:
             data (DataFrame): Data.
 
         Returns:
-            list[dict]: Records.
+            DataFrame: Read-only data.
+        '''
+        # Only public API is used: to_numpy returns a view of the storage of
+        # numpy backed columns, which is marked read-only and wrapped without
+        # copying. Supports pandas 1.5 to 2.x without copy-on-write, under
+        # which frames never share writable memory anyway.
+        columns = {}  # type: Dict[int, Any]
+        for i in range(data.shape[1]):
+            column = data.iloc[:, i]
+            array = column.to_numpy()
+            if np.shares_memory(array, column.to_numpy()):
+                array = array.view()
+                array.flags.writeable = False
+                columns[i] = array
+            else:
+                columns[i] = column.array
+
+        output = pd.DataFrame(columns, index=data.index, copy=False)
+        output.columns = data.columns
+        return output
+
+    @staticmethod
+    def _to_json(data):
+        # type: (pd.DataFrame) -> bytes
         '''
-        data = data.copy()
-        data.date = data.date.apply(lambda x: x.isoformat())
-        data = data.replace({np.nan: None}).to_dict(orient='records')
-        return data
+        Serializes given DataFrame to JSON bytes, as a list of records
+        identical to the JSON of data_tools.to_records.
+
+        Args:
+            data (DataFrame): Data.
+
+        Returns:
+            bytes: JSON.
+        '''
+        return sdt.to_json(data)
 
     @property
     def config(self):
@@ -80,6 +137,7 @@ class Database:
         # type: () -> Union[None, pd.DataFrame]
         '''
         Returns a copy of this instance's data.
+        Use view for read-only access, which does not copy data.
 
         Returns:
             DataFrame: Copy of data.
@@ -88,23 +146,181 @@ class Database:
             return None
         return self._data.copy()
 
+    @property
+    def view(self):
+        # type: () -> Union[None, pd.DataFrame]
+        '''
+        Returns a read-only view of this instance's data, which shares memory
+        with it. Writing to the values of a view raises a ValueError, whereas
+        adding or replacing columns only affects the view. Call copy on a view
+        to get writeable data.
+
+        Returns:
+            DataFrame: View of data.
+        '''
+        if self._data is None:
+            return None
+        return self._data.copy(deep=False)
+
+    @property
+    def is_loaded(self):
+        # type: () -> bool
+        '''
+        bool: Whether database has been updated with data.
+        '''
+        return self._data is not None
+
+    @property
+    def version(self):
+        # type: () -> int
+        '''
+        int: Data version, incremented by every update.
+        '''
+        return self._version
+
+    @property
+    def digest(self):
+        # type: () -> str
+        '''
+        str: SHA256 digest of data, or empty string if database has not
+            been updated.
+        '''
+        return self._digest
+
+    @property
+    def row_count(self):
+        # type: () -> int
+        '''
+        int: Number of rows of data, or 0 if database has not been updated.
+        '''
+        if self._data is None:
+            return 0
+        return len(self._data)
+
+    @property
+    def cache_stats(self):
+        # type: () -> Dict[str, int]
+        '''
+        dict: Search result cache statistics.
+        '''
+        return self._cache.stats
+
     def update(self):
         # type: () -> Database
         '''
-        Loads CSV found in config's data_path into self._data.
+        Loads CSV found in config's data_path into self._data, and loads that
+        data into a new SQL engine. Data is read-only once loaded. Clears cached
+        results and serializes data to JSON. If config's shared_store is set,
+        data is published to it.
 
         Returns:
             Database: self.
         '''
         data = pd.read_csv(self._config['data_path'], index_col=None)
-        self._data = sdt.conform(
+        data = self._freeze(sdt.conform(
             data,
             actions=self._config['conform'],
             columns=self._config['columns'],
-        )
+        ))
+        engine = Engine(data)
+        json_ = self._to_json(data)
+        digest = hashlib.sha256(json_).hexdigest()
+
+        with self._lock:
+            version = self._version + 1
+            if self._store is not None:
+                version = self._store.publish(
+                    data, engine, json_, digest, version=version
+                )
+            self._set_data(version, data, engine, json_, digest)
         return self
 
-    @lru_cache(maxsize=1)
+    def sync(self):
+        # type: () -> bool
+        '''
+        Attaches to the latest data published to config's shared_store by
+        another process, if it is newer than current data. Published data is
+        memory mapped rather than copied, and its JSON is copied on demand.
+
+        Raises:
+            FileNotFoundError: If latest version cannot be loaded.
+
+        Returns:
+            bool: Whether new data was attached.
+        '''
+        if self._store is None or self._store.version <= self._version:
+            return False
+
+        with self._lock:
+            while True:
+                version = self._store.version
+                if version <= self._version:
+                    return False
+                try:
+                    item = self._store.load(version)
+                    break
+                except FileNotFoundError:
+                    # version was pruned while loading, so load the newer one
+                    if self._store.version == version:
+                        raise
+
+            self._set_data(
+                item['version'],
+                self._freeze(item['data']),
+                item['engine'],
+                item['json'],
+                item['digest'],
+            )
+        return True
+
+    def _set_data(self, version, data, engine, json_, digest):
+        # type: (int, pd.DataFrame, Engine, Union[bytes, mmap.mmap], str) -> None
+        '''
+        Replaces data, engine and serialized data, and clears cached results.
+
+        Args:
+            version (int): Data version.
+            data (DataFrame): Data.
+            engine (Engine): Engine loaded with data.
+            json_ (bytes or mmap): Data serialized as JSON, or a memory map
+                of it, which is copied when first read.
+            digest (str): Digest of data.
+        '''
+        with self._swap_lock:
+            old = self._engine
+            self._data = data
+            self._engine = engine
+            self._version = version
+            self._records = None
+            self._json = json_
+            self._digest = digest
+        self._cache.clear()
+
+        # old engine is closed once queries borrowing it finish
+        if old is not None:
+            old.retire()
+
+    @contextmanager
+    def _borrow(self):
+        # type: () -> Iterator[Tuple[int, Optional[pd.DataFrame], Optional[Engine]]]
+        '''
+        Context manager which borrows the current version, data and engine,
+        so that the engine is not closed by an update or sync until it is
+        returned.
+
+        Yields:
+            tuple: Version, data and engine.
+        '''
+        with self._swap_lock:
+            version, data, engine = self._version, self._data, self._engine
+            if engine is not None:
+                engine.retain()
+        try:
+            yield version, data, engine
+        finally:
+            if engine is not None:
+                engine.release()
+
     def read(self):
         # type: () -> List[dict]
         '''
@@ -116,24 +332,315 @@ class Database:
         Returns:
             list[dict]: Data as records.
         '''
-        if self._data is None:
+        if not self.is_loaded:
+            msg = 'Database not updated. Please call update.'
+            raise RuntimeError(msg)
+        if self._records is None:
+            self._records = sdt.to_records(self._data)
+        return self._records
+
+    def read_json(self):
+        # type: () -> bytes
+        '''
+        Returns data as JSON bytes if update has been called.
+        Data is serialized once per update. JSON of data attached by sync is
+        copied from its memory map once.
+
+        Raises:
+            RuntimeError: If update has not first been called.
+
+        Returns:
+            bytes: Data as a JSON list of records.
+        '''
+        json_ = self._json
+        if json_ is None:
             msg = 'Database not updated. Please call update.'
             raise RuntimeError(msg)
-        return self._to_records(self._data)
+        if isinstance(json_, mmap.mmap):
+            json_ = json_[:]
+            self._json = json_
+        return json_
 
-    @lru_cache()
-    def search(self, query):
-        # type: (str) -> List[dict]
+    def _search_frame(self, query=None, cancel=None):
+        # type: (Optional[str], Optional[Event]) -> pd.DataFrame
+        '''
+        Gets data, or results of given query, as a read-only DataFrame.
+        Query results are cached by data version and normalized query.
+        Queries are limited to config's query_timeout.
+
+        Args:
+            query (str, optional): SQL query. Default: None.
+                If None, all data is returned.
+            cancel (Event, optional): Event which cancels query when set.
+                Default: None.
+
+        Raises:
+            RuntimeError: If update has not first been called.
+            PandaSQLException: If query is invalid.
+            TimeoutError: If query exceeds time limit.
+            InterruptedError: If query is cancelled.
+
+        Returns:
+            DataFrame: Data or query results.
+        '''
+        with self._borrow() as (version, data, engine):
+            if data is None:
+                msg = 'Database not updated. Please call update.'
+                raise RuntimeError(msg)
+            if query is None:
+                return data
+
+            key = (version, spl.normalize_query(query))
+            output = self._cache.get(key)
+            if output is None:
+                output = self._freeze(sdt.query_data(
+                    data,
+                    query,
+                    engine=engine,
+                    timeout=self._config['query_timeout'],
+                    cancel=cancel,
+                ))
+                self._cache.set(key, output)
+            return output
+
+    def search(self, query, cancel=None):
+        # type: (str, Optional[Event]) -> List[dict]
         '''
         Search data according to given SQL query.
+        Query results are cached by data version and normalized query. Queries
+        are limited to config's query_timeout.
 
         Args:
             query (str): SQL query. Make sure to use "FROM data" in query.
+            cancel (Event, optional): Event which cancels query when set.
+                Default: None.
+
+        Raises:
+            PandaSQLException: If query is invalid.
+            TimeoutError: If query exceeds time limit.
+            InterruptedError: If query is cancelled.
+
+        Returns:
+            list[dict]: Formatted data.
+        '''
+        return json.loads(self.search_json(query, cancel=cancel))
+
+    def search_json(self, query, cancel=None):
+        # type: (str, Optional[Event]) -> bytes
+        '''
+        Search data according to given SQL query, and serialize results as
+        JSON bytes. Serialized results are cached next to query results, by
+        data version and normalized query.
+
+        Args:
+            query (str): SQL query. Make sure to use "FROM data" in query.
+            cancel (Event, optional): Event which cancels query when set.
+                Default: None.
+
+        Raises:
+            PandaSQLException: If query is invalid.
+            TimeoutError: If query exceeds time limit.
+            InterruptedError: If query is cancelled.
+
+        Returns:
+            bytes: Results as a JSON list of records.
+        '''
+        key = (self._version, spl.normalize_query(query), 'json')
+        output = self._cache.get(key)
+        if output is None:
+            output = self._to_json(self._search_frame(query, cancel=cancel))
+            self._cache.set(key, output)
+        return output
+
+    def explain(self, query):
+        # type: (str) -> Dict[str, Any]
+        '''
+        Profiles given search query. The query is planned, executed and
+        serialized without using any caches, and each stage is timed.
+
+        Stages:
+
+            * plan - parsing and planning of query
+            * execute - SQL execution, including regex evaluation
+            * serialize - conversion of results to JSON
+
+        Args:
+            query (str): SQL query. Make sure to use "FROM data" in query.
+
+        Raises:
+            RuntimeError: If update has not first been called.
+            PandaSQLException: If query is invalid.
+            TimeoutError: If query exceeds time limit.
+
+        Returns:
+            dict: Query plan, SQLite plan, per stage timings, rows in and out
+                and bytes serialized.
+        '''
+        with self._borrow() as (version, source, engine):
+            if engine is None or source is None:
+                msg = 'Database not updated. Please call update.'
+                raise RuntimeError(msg)
+
+            total = time.perf_counter()
+            start = time.perf_counter()
+            plan = spl.plan_query(query)
+            stages = [dict(stage='plan', seconds=time.perf_counter() - start)]
+
+            stats = {}  # type: Dict[str, Any]
+            start = time.perf_counter()
+            data = engine.query(
+                query, timeout=self._config['query_timeout'], stats=stats
+            )
+            stages.append(dict(
+                stage='execute',
+                seconds=time.perf_counter() - start,
+                rows_in=len(source),
+                rows_out=len(data),
+                **stats,
+            ))
+
+            start = time.perf_counter()
+            size = len(self._to_json(data))
+            stages.append(dict(
+                stage='serialize',
+                seconds=time.perf_counter() - start,
+                rows_in=len(data),
+                rows_out=len(data),
+                bytes=size,
+            ))
+
+            key = (version, spl.normalize_query(query))
+            return dict(
+                query=key[1],
+                sql=plan.sql,
+                predicates=[x._asdict() for x in plan.predicates],
+                sqlite_plan=engine.explain(query),
+                stages=stages,
+                seconds=time.perf_counter() - total,
+                cached=key in self._cache,
+            )
+
+    @staticmethod
+    def _get_sort_positions(data, order_by):
+        # type: (pd.DataFrame, List[str]) -> np.ndarray
+        '''
+        Gets row positions of given data sorted by given columns. Columns
+        prefixed with "-" are sorted in descending order. Nulls are always
+        sorted last. Sorting is stable.
+
+        Args:
+            data (DataFrame): Data.
+            order_by (list[str]): Columns to sort by.
+
+        Raises:
+            EnforceError: If order_by column is not in data.
 
         Returns:
-            DataFrame: Formatted data.
+            numpy.ndarray: Row positions.
         '''
-        output = sdt.query_data(self._data, query)
-        # pandasql coerces Timestamps to strings
-        output.date = pd.DatetimeIndex(output.date)
-        return self._to_records(output)
+        columns = [x.lstrip('-') for x in order_by]
+        for col in columns:
+            msg = 'Order by column {a} is not in {b}.'
+            Enforce(col, 'in', data.columns.tolist(), message=msg)
+        # ----------------------------------------------------------------------
+
+        keys = list(range(len(columns)))
+        temp = data[columns].reset_index(drop=True)
+        temp.columns = keys
+        temp = temp.sort_values(
+            keys,
+            ascending=[not x.startswith('-') for x in order_by],
+            na_position='last',
+            kind='mergesort',
+        )
+        return temp.index.to_numpy()
+
+    def page_frame(
+        self, query=None, limit=None, offset=0, order_by=[], cancel=None
+    ):
+        # type: (Optional[str], Optional[int], int, List[str], Optional[Event]) -> Dict[str, Any]
+        '''
+        Gets a page of data, or of search results if a query is given, as a
+        DataFrame. Rows are sorted and sliced before they are copied, so that
+        only the rows of the page need be serialized. Query results and sort
+        orders, as row positions, are cached.
+
+        Args:
+            query (str, optional): SQL query. Default: None.
+                If None, all data is paged.
+            limit (int, optional): Maximum number of rows. Default: None.
+                If None, all rows after offset are returned.
+            offset (int, optional): Number of rows to skip. Default: 0.
+            order_by (list[str], optional): Columns to sort by. Columns
+                prefixed with "-" are sorted in descending order. Nulls are
+                always sorted last. Default: [].
+            cancel (Event, optional): Event which cancels query when set.
+                Default: None.
+
+        Raises:
+            EnforceError: If limit is less than 0.
+            EnforceError: If offset is less than 0.
+            EnforceError: If order_by column is not in results.
+
+        Returns:
+            dict: Page DataFrame as frame and total number of rows as total.
+        '''
+        if limit is not None:
+            msg = 'Limit must be greater or equal to {b}. {a} < {b}.'
+            Enforce(limit, '>=', 0, message=msg)
+        msg = 'Offset must be greater or equal to {b}. {a} < {b}.'
+        Enforce(offset, '>=', 0, message=msg)
+        # ----------------------------------------------------------------------
+
+        data = self._search_frame(query, cancel=cancel)
+        stop = None if limit is None else offset + limit
+        if len(order_by) == 0:
+            return dict(frame=data.iloc[offset:stop], total=len(data))
+
+        key = (
+            self._version,
+            None if query is None else spl.normalize_query(query),
+            tuple(order_by),
+        )
+        positions = self._cache.get(key)
+        if positions is None:
+            positions = self._get_sort_positions(data, order_by)
+            self._cache.set(key, positions)
+        return dict(frame=data.iloc[positions[offset:stop]], total=len(data))
+
+    def page(
+        self, query=None, limit=None, offset=0, order_by=[], cancel=None
+    ):
+        # type: (Optional[str], Optional[int], int, List[str], Optional[Event]) -> Dict[str, Any]
+        '''
+        Gets a page of data, or of search results if a query is given.
+        Only the rows of the page are serialized. See page_frame.
+
+        Args:
+            query (str, optional): SQL query. Default: None.
+                If None, all data is paged.
+            limit (int, optional): Maximum number of rows. Default: None.
+                If None, all rows after offset are returned.
+            offset (int, optional): Number of rows to skip. Default: 0.
+            order_by (list[str], optional): Columns to sort by. Columns
+                prefixed with "-" are sorted in descending order. Nulls are
+                always sorted last. Default: [].
+            cancel (Event, optional): Event which cancels query when set.
+                Default: None.
+
+        Raises:
+            EnforceError: If limit is less than 0.
+            EnforceError: If offset is less than 0.
+            EnforceError: If order_by column is not in results.
+
+        Returns:
+            dict: Page records and total number of rows.
+        '''
+        page = self.page_frame(
+            query=query,
+            limit=limit,
+            offset=offset,
+            order_by=order_by,
+            cancel=cancel,
+        )
+        return dict(records=sdt.to_records(page['frame']), total=page['total'])
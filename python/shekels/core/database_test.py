@@ -1,9 +1,13 @@
 from copy import deepcopy
 import json
+import mmap
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from threading import Event, Thread
 import unittest
+import unittest.mock as mock
 
+from lunchbox.enforce import EnforceError
 from pandas import DataFrame
 import numpy as np
 import pandas as pd
@@ -130,21 +134,70 @@ class DatabaseTests(unittest.TestCase):
             expected = temp._data.columns.tolist()
             self.assertNotEqual(result, expected)
 
-    def test_to_records(self):
+    def test_view(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            temp = db.Database(config)
+            self.assertIs(temp.view, None)
+
+            temp.update()
+            result = temp.view
+            pd.testing.assert_frame_equal(result, temp._data)
+            for col in ['amount', 'date']:
+                self.assertTrue(
+                    np.shares_memory(result[col].values, temp._data[col].values)
+                )
+
+            with self.assertRaisesRegex(ValueError, 'read-only'):
+                result.loc[0, 'amount'] = 99
+            with self.assertRaisesRegex(ValueError, 'read-only'):
+                temp._data.loc[0, 'amount'] = 99
+
+            result['new_col'] = None
+            self.assertNotIn('new_col', temp._data.columns)
+
+            result = temp.view.copy()
+            result.loc[0, 'amount'] = 99
+            self.assertEqual(result.loc[0, 'amount'], 99)
+            self.assertNotEqual(temp._data.loc[0, 'amount'], 99)
+
+    def test_is_loaded(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            temp = db.Database(config)
+            self.assertFalse(temp.is_loaded)
+            temp.update()
+            self.assertTrue(temp.is_loaded)
+
+    def test_freeze(self):
+        data = sdt.conform(self.get_data())
+        result = db.Database._freeze(data)
+        pd.testing.assert_frame_equal(result, data)
+        self.assertTrue(np.shares_memory(
+            result.amount.to_numpy(), data.amount.to_numpy()
+        ))
+        with self.assertRaisesRegex(ValueError, 'read-only'):
+            result.loc[0, 'amount'] = 99
+        with self.assertRaisesRegex(ValueError, 'read-only'):
+            result.loc[0, 'date'] = pd.Timestamp('2021-01-01')
+
+    def test_to_json(self):
         data = self.get_data()
         data = sdt.conform(data)
-        result = db.Database._to_records(data)
-        expected = data.copy()
-        expected.date = expected.date.apply(lambda x: x.isoformat())
-        expected = expected.replace({np.nan: None}).to_dict(orient='records')
+        data.loc[0, 'date'] = None
+        result = json.loads(db.Database._to_json(data))
+        expected = sdt.to_records(data)
         self.assertEqual(result, expected)
 
-    def test_to_records_no_mutation(self):
-        result = self.get_data()
-        result = sdt.conform(result)
-        expected = result.copy()
-        db.Database._to_records(result)
-        eft.enforce_dataframes_are_equal(result, expected)
+        result = db.Database._to_json(DataFrame())
+        self.assertEqual(result, b'[]')
+
+        # floats are serialized like json.dumps
+        data = DataFrame(dict(amount=[0.1 + 0.2, 1e-7, np.nan]))
+        result = db.Database._to_json(data)
+        expected = b'[{"amount": 0.30000000000000004}, {"amount": 1e-07}, '
+        expected += b'{"amount": null}]'
+        self.assertEqual(result, expected)
 
     def test_update(self):
         with TemporaryDirectory() as root:
@@ -158,6 +211,154 @@ class DatabaseTests(unittest.TestCase):
 
             eft.enforce_dataframes_are_equal(result, expected)
 
+    def test_update_engine(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config)
+            self.assertEqual(database.version, 0)
+            self.assertIsNone(database._engine)
+
+            database.update()
+            self.assertEqual(database.version, 1)
+            engine = database._engine
+            result = engine.query('select * from data')
+            self.assertEqual(len(result), len(database._data))
+
+            database.update()
+            self.assertEqual(database.version, 2)
+            self.assertIsNot(database._engine, engine)
+            self.assertEqual(engine._connections, [])
+
+    def test_update_during_query(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config).update()
+            query = "select * from data where description ~ 'Ignore'"
+            expected = database.search(query)
+            database._cache.clear()
+
+            engine = database._engine
+            started = Event()
+            proceed = Event()
+            query_ = engine.query
+
+            def slow_query(*args, **kwargs):
+                started.set()
+                proceed.wait(5)
+                return query_(*args, **kwargs)
+
+            results = []  # type: list
+
+            def search():
+                try:
+                    results.append(database.search(query))
+                except Exception as error:
+                    results.append(error)
+
+            with mock.patch.object(engine, 'query', side_effect=slow_query):
+                thread = Thread(target=search)
+                thread.start()
+                started.wait(5)
+
+                # old engine stays open while its query runs
+                database.update()
+                self.assertIsNot(database._engine, engine)
+                self.assertNotEqual(engine._connections, [])
+                proceed.set()
+                thread.join()
+
+            self.assertEqual(results, [expected])
+            self.assertEqual(engine._connections, [])
+
+    def test_update_shared_store(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            config['shared_store'] = Path(root, 'store').as_posix()
+            database = db.Database(config)
+            store = database._store
+            self.assertEqual(store.root, Path(root, 'store'))
+
+            database.update()
+            self.assertEqual(store.version, 1)
+            self.assertEqual(store.load(1)['digest'], database.digest)
+
+            # versions continue from published versions
+            other = db.Database(config).update()
+            self.assertEqual(other.version, 2)
+            self.assertEqual(store.version, 2)
+
+    def test_sync(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            self.assertFalse(db.Database(config).sync())
+
+            config['shared_store'] = Path(root, 'store').as_posix()
+            worker = db.Database(config)
+            self.assertFalse(worker.sync())
+            self.assertFalse(worker.is_loaded)
+
+            ingest = db.Database(config).update()
+            self.assertFalse(ingest.sync())
+            query = "select * from data where description ~ 'Ignore'"
+            worker._cache.set('foo', 'bar')
+
+            self.assertTrue(worker.sync())
+            self.assertFalse(worker.sync())
+            self.assertEqual(worker.version, ingest.version)
+            self.assertEqual(worker.digest, ingest.digest)
+            self.assertEqual(worker.row_count, ingest.row_count)
+            self.assertNotIn('foo', worker._cache)
+            self.assertIsInstance(worker._json, mmap.mmap)
+            self.assertEqual(worker.read_json(), ingest.read_json())
+            self.assertIsInstance(worker._json, bytes)
+            self.assertEqual(worker.read(), ingest.read())
+            self.assertEqual(worker.search(query), ingest.search(query))
+            pd.testing.assert_frame_equal(worker.view, ingest.view)
+
+            # worker data is memory mapped and read-only
+            base = worker.view.amount.values
+            while not isinstance(base, np.memmap):
+                base = base.base
+            self.assertIsInstance(base, np.memmap)
+            with self.assertRaisesRegex(ValueError, 'read-only'):
+                worker.view.loc[0, 'description'] = 'foo'
+
+            engine = worker._engine
+            ingest.update()
+            self.assertTrue(worker.sync())
+            self.assertEqual(worker.version, 2)
+            self.assertEqual(engine._connections, [])
+
+    def test_sync_pruned(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            config['shared_store'] = Path(root, 'store').as_posix()
+            worker = db.Database(config)
+            ingest = db.Database(config).update()
+            load = worker._store.load
+
+            # version is pruned while worker loads it
+            def side_effect(version):
+                if version == 1:
+                    ingest.update()
+                    ingest.update()
+                return load(version)
+
+            with mock.patch.object(
+                worker._store, 'load', side_effect=side_effect
+            ):
+                self.assertTrue(worker.sync())
+            self.assertEqual(worker.version, 3)
+            self.assertEqual(worker.read(), ingest.read())
+
+            # missing latest version is raised
+            ingest.update()
+            with mock.patch.object(
+                worker._store, 'load', side_effect=FileNotFoundError
+            ):
+                with self.assertRaises(FileNotFoundError):
+                    worker.sync()
+
     def test_read(self):
         with TemporaryDirectory() as root:
             config, _ = self.get_config(root)
@@ -174,9 +375,281 @@ class DatabaseTests(unittest.TestCase):
             with self.assertRaisesRegex(RuntimeError, expected):
                 db.Database(config).read()
 
+    def test_read_update(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            csv_path = config['data_path']
+            dbase = db.Database(config).update()
+            self.assertIs(dbase.read(), dbase.read())
+            self.assertEqual(len(dbase.read()), 4)
+
+            data = pd.read_csv(csv_path, index_col=None).head(1)
+            data.to_csv(csv_path, index=False)
+            dbase.update()
+            self.assertEqual(len(dbase.read()), 1)
+
+    def test_read_json(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            dbase = db.Database(config)
+            self.assertEqual(dbase.row_count, 0)
+
+            expected = 'Database not updated. Please call update.'
+            with self.assertRaisesRegex(RuntimeError, expected):
+                dbase.read_json()
+
+            self.assertEqual(dbase.digest, '')
+            dbase.update()
+            self.assertEqual(len(dbase.digest), 64)
+            self.assertEqual(dbase.row_count, 4)
+            result = dbase.read_json()
+            self.assertIsInstance(result, bytes)
+            self.assertIs(dbase.read_json(), result)
+            self.assertEqual(json.loads(result), dbase.read())
+
     def test_search(self):
         with TemporaryDirectory() as root:
             config, _ = self.get_config(root)
             query = "SELECT * FROM data WHERE description LIKE 'Ignore'"
             result = db.Database(config).update().search(query)
             self.assertEqual(len(result), 1)
+
+    def test_search_cache(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            csv_path = config['data_path']
+            database = db.Database(config).update()
+            query = "SELECT * FROM data WHERE description LIKE 'Ignore'"
+            with mock.patch.object(
+                sdt, 'query_data', wraps=sdt.query_data
+            ) as query_data:
+                a = database.search(query)
+                b = database.search('  ' + query.replace(' ', '\n') + ';')
+                self.assertEqual(a, b)
+                self.assertEqual(query_data.call_count, 1)
+
+                # results and their JSON are cached
+                stats = database.cache_stats
+                self.assertEqual(stats['items'], 2)
+                self.assertEqual(stats['hits'], 1)
+                self.assertEqual(stats['misses'], 2)
+                self.assertGreater(stats['size'], 0)
+
+                # update invalidates cached results
+                data = pd.read_csv(csv_path, index_col=None).head(1)
+                data.to_csv(csv_path, index=False)
+                database.update()
+                self.assertEqual(database.cache_stats['items'], 0)
+                result = database.search(query)
+                self.assertEqual(query_data.call_count, 2)
+                self.assertEqual(result, [])
+
+    def test_search_cache_size(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            config['search_cache_size'] = 0
+            database = db.Database(config).update()
+            database.search('SELECT * FROM data')
+            database.search('SELECT * FROM data')
+            stats = database.cache_stats
+            self.assertEqual(stats['items'], 0)
+            self.assertEqual(stats['misses'], 4)
+
+    def test_search_json(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config).update()
+            query = "SELECT * FROM data WHERE description LIKE 'Ignore'"
+            with mock.patch.object(sdt, 'to_json', wraps=sdt.to_json) as to_json:
+                result = database.search_json(query)
+                frame = database._search_frame(query)
+                expected = json.dumps(sdt.to_records(frame)).encode('utf-8')
+                self.assertEqual(result, expected)
+
+                # serialized results are cached
+                self.assertIs(database.search_json(query), result)
+                self.assertEqual(database.search(query), json.loads(result))
+                self.assertEqual(to_json.call_count, 1)
+
+    def test_page(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config).update()
+
+            result = database.page()
+            self.assertEqual(result['total'], 4)
+            self.assertEqual(result['records'], database.read())
+
+            result = database.page(limit=2, offset=1)
+            self.assertEqual(result['total'], 4)
+            self.assertEqual(result['records'], database.read()[1:3])
+
+            result = database.page(offset=10)
+            self.assertEqual(result, dict(records=[], total=4))
+
+            query = "SELECT * FROM data WHERE date >= '2020-10-28'"
+            result = database.page(query, limit=1)
+            self.assertEqual(result['total'], 3)
+            self.assertEqual(result['records'], database.search(query)[:1])
+
+    def test_page_order_by(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config).update()
+
+            result = database.page(order_by=['amount'])['records']
+            result = [x['amount'] for x in result]
+            self.assertEqual(result, sorted(result))
+
+            result = database.page(order_by=['-date', 'amount'], limit=3)
+            result = [(x['date'], x['amount']) for x in result['records']]
+            expected = sorted(
+                [(x['date'], x['amount']) for x in database.read()],
+                key=lambda x: (x[0], -x[1]),
+                reverse=True,
+            )[:3]
+            self.assertEqual(result, expected)
+
+            # sort orders are cached as row positions
+            items = database.cache_stats['items']
+            database.page(order_by=['-date', 'amount'], offset=2)
+            self.assertEqual(database.cache_stats['items'], items)
+            key = (database.version, None, ('-date', 'amount'))
+            positions = database._cache.get(key)
+            self.assertEqual(positions.dtype.kind, 'i')
+            self.assertEqual(len(positions), 4)
+
+    def test_page_frame(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config).update()
+            query = "SELECT * FROM data WHERE date >= '2020-10-28'"
+
+            result = database.page_frame(query, limit=2, offset=1)
+            self.assertEqual(result['total'], 3)
+            self.assertIsInstance(result['frame'], DataFrame)
+            self.assertEqual(len(result['frame']), 2)
+            self.assertEqual(
+                sdt.to_records(result['frame']),
+                database.search(query)[1:3],
+            )
+
+            # only page rows are serialized
+            with mock.patch.object(
+                sdt, 'to_records', wraps=sdt.to_records
+            ) as to_records:
+                database.page(query, limit=1)
+                self.assertEqual(len(to_records.call_args.args[0]), 1)
+
+            # query results are cached as frames, with their full size
+            frame = database._cache.get((database.version, query))
+            self.assertIsInstance(frame, DataFrame)
+            with self.assertRaisesRegex(ValueError, 'read-only'):
+                frame.loc[0, 'amount'] = 99
+
+            size = database.cache_stats['size']
+            database.page(query, order_by=['amount'])
+            self.assertGreater(database.cache_stats['size'], size)
+
+    def test_page_nulls(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config).update()
+            query = "SELECT *, CASE WHEN amount > 50 THEN amount END AS x FROM data"
+            result = database.page(query, order_by=['x'])['records']
+            self.assertEqual(result[-1]['x'], None)
+            result = database.page(query, order_by=['-x'])['records']
+            self.assertEqual(result[-1]['x'], None)
+            self.assertEqual(result[0]['x'], 99.99)
+
+    def test_page_errors(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config).update()
+
+            expected = 'Limit must be greater or equal to 0. -1 < 0.'
+            with self.assertRaisesRegex(EnforceError, expected):
+                database.page(limit=-1)
+
+            expected = 'Offset must be greater or equal to 0. -1 < 0.'
+            with self.assertRaisesRegex(EnforceError, expected):
+                database.page(offset=-1)
+
+            expected = 'Order by column foo is not in'
+            with self.assertRaisesRegex(EnforceError, expected):
+                database.page(order_by=['-foo'])
+
+    def test_search_timeout(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            config['query_timeout'] = 0.5
+            database = db.Database(config).update()
+            cancel = mock.Mock()
+            with mock.patch.object(
+                sdt, 'query_data', wraps=sdt.query_data
+            ) as query_data:
+                database.page('SELECT * FROM data', cancel=cancel)
+                kwargs = query_data.call_args.kwargs
+                self.assertEqual(kwargs['timeout'], 0.5)
+                self.assertIs(kwargs['cancel'], cancel)
+
+    def test_explain(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config)
+
+            expected = 'Database not updated. Please call update.'
+            with self.assertRaisesRegex(RuntimeError, expected):
+                database.explain('SELECT * FROM data')
+
+            database.update()
+            query = "SELECT * FROM data WHERE description ~ 'pizza' "
+            query += "AND date >= '2020-10-28'"
+            result = database.explain(query)
+            self.assertFalse(result['cached'])
+            self.assertEqual(
+                [x['kind'] for x in result['predicates']], ['date', 'regex']
+            )
+            self.assertRegex(result['sql'], "^SELECT .* WHERE date >= .* AND")
+            self.assertRegex(result['sqlite_plan'][0], 'data_date')
+
+            stages = {x['stage']: x for x in result['stages']}
+            self.assertEqual(list(stages.keys()), ['plan', 'execute', 'serialize'])
+            self.assertEqual(stages['execute']['rows_in'], 4)
+            self.assertEqual(stages['execute']['rows_out'], 1)
+            self.assertEqual(stages['execute']['regex_calls'], 3)
+            self.assertEqual(stages['serialize']['rows_out'], 1)
+            expected = len(json.dumps(database.search(query)))
+            self.assertEqual(stages['serialize']['bytes'], expected)
+            self.assertGreaterEqual(
+                result['seconds'], sum(x['seconds'] for x in stages.values())
+            )
+
+            # explain does not use search cache
+            self.assertTrue(database.explain(query)['cached'])
+            self.assertEqual(database.cache_stats['hits'], 0)
+
+    def test_search_engine(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config).update()
+
+            # data is not copied into a new database per query
+            query = "SELECT * FROM data WHERE date >= '2020-10-29'"
+            with mock.patch.object(sdt, 'Engine') as engine:
+                result = database.search(query)
+                engine.assert_not_called()
+            self.assertEqual(len(result), 2)
+            self.assertEqual(result[0]['date'], '2020-10-29T00:00:00')
+
+            result = database.search('SELECT count(*) AS total FROM data')
+            self.assertEqual(result, [{'total': 4}])
+
+    def test_search_regex(self):
+        with TemporaryDirectory() as root:
+            config, _ = self.get_config(root)
+            database = db.Database(config).update()
+            query = "SELECT * FROM data WHERE description ~ 'pizza'"
+            result = database.search(query)
+            self.assertEqual(len(result), 1)
+            self.assertEqual(result[0]['date'], '2020-10-29T00:00:00')
@@ -0,0 +1,495 @@
+from typing import Any, Iterator, List, Optional, Union  # noqa: F401
+
+from pathlib import Path
+from contextlib import contextmanager
+from functools import lru_cache
+from threading import Event, Lock, local  # noqa: F401
+from uuid import uuid4
+import queue
+import sqlite3
+import time
+
+from lunchbox.enforce import Enforce
+from pandas import DataFrame
+from pandasql import PandaSQLException
+import pandas as pd
+import regex
+
+import shekels.core.planner as spl
+# ------------------------------------------------------------------------------
+
+
+INDEX_COLUMNS = ['date', 'category', 'account']
+'''
+Columns indexed by Engine, if present in data.
+'''
+
+PROGRESS_STEPS = 1000
+'''
+Number of SQLite virtual machine instructions between interrupt checks.
+'''
+
+POOL_SIZE = 8
+'''
+Maximum number of connections opened by each Engine.
+'''
+
+MMAP_SIZE = 1024**3
+'''
+Maximum number of bytes of a database file memory mapped by each connection.
+'''
+
+
+@lru_cache(maxsize=256)
+def get_regex(pattern):
+    # type: (str) -> regex.Pattern
+    '''
+    Compiles given pattern into a case insensitive regular expression.
+    Compiled expressions are cached.
+
+    Args:
+        pattern (str): Regular expression.
+
+    Raises:
+        regex.error: If pattern is invalid.
+
+    Returns:
+        regex.Pattern: Compiled regular expression.
+    '''
+    return regex.compile(pattern, flags=regex.I)
+
+
+def regexp(pattern, value, timeout=None):
+    # type: (Optional[str], Any, Optional[float]) -> bool
+    '''
+    SQL REGEXP function. Searches given value, as a string, for given pattern.
+
+    Args:
+        pattern (str): Regular expression.
+        value (object): Value to be searched.
+        timeout (float, optional): Time limit of search in seconds.
+            Default: None.
+
+    Raises:
+        TimeoutError: If search exceeds time limit.
+
+    Returns:
+        bool: Whether pattern was found. False if either argument is NULL.
+    '''
+    if pattern is None or value is None:
+        return False
+    return get_regex(pattern).search(str(value), timeout=timeout) is not None
+
+
+class Engine:
+    '''
+    Persistent in-process SQL engine, which holds a single DataFrame as a table
+    within an in-memory SQLite database. Data is loaded once, and then queried
+    any number of times. Queries check out a connection to the same
+    shared-cache database from a pool, which is bounded, so that the number
+    of connections does not grow with the number of threads. Engines may also
+    be saved to and loaded from read-only SQLite files, which are memory
+    mapped.
+    Queries are planned with planner.get_plan. They may use regex operators,
+    which are rewritten into calls to a registered REGEXP function.
+    '''
+    def __init__(
+        self, data, table='data', indexes=INDEX_COLUMNS, pool_size=POOL_SIZE
+    ):
+        # type: (DataFrame, str, List[str], int) -> None
+        '''
+        Constructs an Engine instance and loads given data into it.
+
+        Args:
+            data (DataFrame): Data to be loaded.
+            table (str, optional): Table name. Default: data.
+            indexes (list[str], optional): Columns to be indexed, if present
+                in data. Default: INDEX_COLUMNS.
+            pool_size (int, optional): Maximum number of connections.
+                Default: POOL_SIZE.
+
+        Raises:
+            EnforceError: If data is not a DataFrame.
+            EnforceError: If pool_size is less than 1.
+        '''
+        Enforce(data, 'instance of', DataFrame)
+        msg = 'Pool size must be greater or equal to {b}. {a} < {b}.'
+        Enforce(pool_size, '>=', 1, message=msg)
+        # ----------------------------------------------------------------------
+
+        self._setup(
+            f'file:shekels-{uuid4().hex}?mode=memory&cache=shared',
+            table,
+            [x for x in data.columns if data[x].dtype.kind == 'M'],
+            pool_size,
+        )
+
+        # pooled connections keep database alive for lifetime of engine
+        with self._checkout() as conn:
+            data.to_sql(table, conn, index=False)
+            for col in indexes:
+                if col in data.columns:
+                    conn.execute(
+                        f'CREATE INDEX "{table}_{col}" ON "{table}" ("{col}")'
+                    )
+            conn.commit()
+
+    @staticmethod
+    def from_file(filepath, date_columns=[], table='data', pool_size=POOL_SIZE):
+        # type: (Union[str, Path], List[str], str, int) -> Engine
+        '''
+        Constructs a read-only Engine instance from a given SQLite file, as
+        written by save. The file must not be modified while in use. It is
+        memory mapped, so its pages are shared between processes.
+        All pool_size connections are opened immediately, so the engine keeps
+        working if the file is later deleted.
+
+        Args:
+            filepath (str or Path): Path to SQLite file.
+            date_columns (list[str], optional): Columns returned as datetimes.
+                Default: [].
+            table (str, optional): Table name. Default: data.
+            pool_size (int, optional): Maximum number of connections.
+                Default: POOL_SIZE.
+
+        Raises:
+            EnforceError: If pool_size is less than 1.
+            FileNotFoundError: If filepath does not exist.
+
+        Returns:
+            Engine: Engine instance.
+        '''
+        msg = 'Pool size must be greater or equal to {b}. {a} < {b}.'
+        Enforce(pool_size, '>=', 1, message=msg)
+        # ----------------------------------------------------------------------
+
+        filepath = Path(filepath).absolute()
+        if not filepath.is_file():
+            raise FileNotFoundError(f'{filepath} does not exist.')
+
+        engine = Engine.__new__(Engine)
+        engine._setup(
+            filepath.as_uri() + '?mode=ro&immutable=1',
+            table,
+            date_columns,
+            pool_size,
+        )
+        for _ in range(pool_size):
+            conn = engine._connect()
+            engine._connections.append(conn)
+            engine._pool.put(conn)
+        return engine
+
+    def _setup(self, uri, table, date_columns, pool_size):
+        # type: (str, str, List[str], int) -> None
+        '''
+        Sets up connection state of engine.
+
+        Args:
+            uri (str): SQLite database URI.
+            table (str): Table name.
+            date_columns (list[str]): Columns returned as datetimes.
+            pool_size (int): Maximum number of connections.
+        '''
+        self._uri = uri
+        self._local = local()
+        self._lock = Lock()
+        self._pool = queue.LifoQueue()  # type: queue.LifoQueue
+        self._connections = []  # type: List[sqlite3.Connection]
+        self._references = 0
+        self._retired = False
+        self.pool_size = pool_size
+        self.table = table
+        self.date_columns = list(date_columns)  # type: List[str]
+
+    def _connect(self):
+        # type: () -> sqlite3.Connection
+        '''
+        Creates a new connection to database.
+
+        Returns:
+            sqlite3.Connection: Connection.
+        '''
+        conn = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+        conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+        conn.create_function('REGEXP', 2, self._regexp, deterministic=True)
+        return conn
+
+    def _acquire(self):
+        # type: () -> sqlite3.Connection
+        '''
+        Takes an idle connection from pool. If there is none, a new connection
+        is opened, unless pool is full, in which case this blocks until a
+        connection is released.
+
+        Returns:
+            sqlite3.Connection: Connection.
+        '''
+        while True:
+            try:
+                return self._pool.get_nowait()
+            except queue.Empty:
+                pass
+
+            with self._lock:
+                if len(self._connections) < self.pool_size:
+                    conn = self._connect()
+                    self._connections.append(conn)
+                    return conn
+
+            try:
+                return self._pool.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def _release(self, conn):
+        # type: (sqlite3.Connection) -> None
+        '''
+        Returns given connection to pool. Connections which were checked out
+        when engine was closed are closed instead.
+
+        Args:
+            conn (sqlite3.Connection): Connection.
+        '''
+        with self._lock:
+            if any(x is conn for x in self._connections):
+                self._pool.put(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def _checkout(self):
+        # type: () -> Iterator[sqlite3.Connection]
+        '''
+        Context manager which checks out a connection from pool.
+
+        Yields:
+            sqlite3.Connection: Connection.
+        '''
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def _get_interrupt(self):
+        # type: () -> Optional[Exception]
+        '''
+        Gets error with which current thread's query should be interrupted.
+
+        Returns:
+            Exception: InterruptedError if query was cancelled, TimeoutError
+                if query exceeded its time limit, otherwise None.
+        '''
+        cancel = getattr(self._local, 'cancel', None)
+        if cancel is not None and cancel.is_set():
+            return InterruptedError('Query cancelled.')
+
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is not None and time.monotonic() > deadline:
+            return self._get_timeout_error()
+        return None
+
+    def _get_timeout_error(self):
+        # type: () -> TimeoutError
+        '''
+        Gets error raised when current thread's query exceeds its time limit.
+
+        Returns:
+            TimeoutError: Timeout error.
+        '''
+        msg = f'Query exceeded time limit of {self._local.timeout} seconds.'
+        return TimeoutError(msg)
+
+    def _progress(self):
+        # type: () -> int
+        '''
+        SQLite progress handler. Aborts query if it has been interrupted.
+
+        Returns:
+            int: 1 if query is to be aborted, otherwise 0.
+        '''
+        return int(self._get_interrupt() is not None)
+
+    def _regexp(self, pattern, value):
+        # type: (Optional[str], Any) -> bool
+        '''
+        SQL REGEXP function, which checks for interrupts before each
+        evaluation, bounds each evaluation by the remaining time of the query
+        and records regex errors.
+
+        Args:
+            pattern (str): Regular expression.
+            value (object): Value to be searched.
+
+        Raises:
+            Exception: If query has been interrupted.
+            TimeoutError: If evaluation exceeds remaining time of query.
+            regex.error: If pattern is invalid.
+
+        Returns:
+            bool: Whether pattern was found. False if either argument is NULL.
+        '''
+        interrupt = self._get_interrupt()
+        if interrupt is not None:
+            raise interrupt
+
+        timeout = None
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is not None:
+            timeout = max(deadline - time.monotonic(), 0)
+
+        stats = getattr(self._local, 'stats', None)
+        start = time.perf_counter()
+        try:
+            return regexp(pattern, value, timeout=timeout)
+        except TimeoutError:
+            self._local.error = self._get_timeout_error()
+            raise self._local.error
+        except regex.error as error:
+            self._local.error = error
+            raise error
+        finally:
+            if stats is not None:
+                stats['regex_calls'] += 1
+                stats['regex_seconds'] += time.perf_counter() - start
+
+    def query(self, query, timeout=None, cancel=None, stats=None):
+        # type: (str, Optional[float], Optional[Event], Optional[dict]) -> DataFrame
+        '''
+        Queries database with given SQL query.
+        Datetime columns are returned as datetimes.
+
+        Args:
+            query (str): SQL query, which may include regex operators.
+            timeout (float, optional): Time limit in seconds. Default: None.
+                If None or 0, query is not time limited.
+            cancel (Event, optional): Event which cancels query when set.
+                Default: None.
+            stats (dict, optional): Dict into which number of regex
+                evaluations and their total time are written, as regex_calls
+                and regex_seconds. Default: None.
+
+        Raises:
+            PandaSQLException: If query is invalid.
+            TimeoutError: If query exceeds time limit.
+            InterruptedError: If query is cancelled.
+
+        Returns:
+            DataFrame: Query results.
+        '''
+        if stats is not None:
+            stats.update(regex_calls=0, regex_seconds=0.0)
+        self._local.stats = stats
+        self._local.error = None
+        self._local.cancel = cancel
+        self._local.timeout = timeout
+        self._local.deadline = None
+        if timeout:
+            self._local.deadline = time.monotonic() + timeout
+
+        with self._checkout() as conn:
+            if timeout or cancel is not None:
+                conn.set_progress_handler(self._progress, PROGRESS_STEPS)
+            try:
+                return pd.read_sql_query(
+                    spl.get_plan(query).sql,
+                    conn,
+                    parse_dates=self.date_columns,
+                )
+            except (sqlite3.Error, pd.errors.DatabaseError) as error:
+                interrupt = self._get_interrupt()
+                if isinstance(self._local.error, TimeoutError):
+                    interrupt = interrupt or self._local.error
+                if interrupt is not None:
+                    raise interrupt from error
+                if self._local.error is not None:
+                    raise PandaSQLException(self._local.error)
+                raise PandaSQLException(error)
+            finally:
+                conn.set_progress_handler(None, 0)
+                self._local.stats = None
+                self._local.cancel = None
+                self._local.deadline = None
+
+    def explain(self, query):
+        # type: (str) -> List[str]
+        '''
+        Gets SQLite query plan of given query.
+
+        Args:
+            query (str): SQL query, which may include regex operators.
+
+        Raises:
+            PandaSQLException: If query is invalid.
+
+        Returns:
+            list[str]: Query plan steps.
+        '''
+        sql = 'EXPLAIN QUERY PLAN ' + spl.get_plan(query).sql
+        with self._checkout() as conn:
+            try:
+                rows = conn.execute(sql).fetchall()
+            except sqlite3.Error as error:
+                raise PandaSQLException(error)
+        return [x[-1] for x in rows]
+
+    def save(self, filepath):
+        # type: (Union[str, Path]) -> None
+        '''
+        Writes database, including indexes, to given SQLite file.
+
+        Args:
+            filepath (str or Path): Path to SQLite file.
+        '''
+        target = sqlite3.connect(Path(filepath).as_posix())
+        try:
+            with self._checkout() as conn:
+                conn.backup(target)
+        finally:
+            target.close()
+
+    def retain(self):
+        # type: () -> None
+        '''
+        Adds a reference to engine, which defers closing it by retire until
+        the reference is released.
+        '''
+        with self._lock:
+            self._references += 1
+
+    def release(self):
+        # type: () -> None
+        '''
+        Removes a reference added by retain. Closes engine if it has been
+        retired and this was its last reference.
+        '''
+        with self._lock:
+            self._references -= 1
+            close = self._retired and self._references == 0
+        if close:
+            self.close()
+
+    def retire(self):
+        # type: () -> None
+        '''
+        Closes engine once all references to it have been released.
+        '''
+        with self._lock:
+            self._retired = True
+            close = self._references == 0
+        if close:
+            self.close()
+
+    def close(self):
+        # type: () -> None
+        '''
+        Closes all connections, which frees database. Connections checked out
+        by running queries are closed once those queries finish.
+        '''
+        with self._lock:
+            while not self._pool.empty():
+                self._pool.get_nowait().close()
+            self._connections = []
+            self._pool = queue.LifoQueue()
+        self._local = local()
@@ -0,0 +1,316 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+import sqlite3
+import time
+import unittest
+
+from lunchbox.enforce import EnforceError
+from pandas import DataFrame
+from pandasql import PandaSQLException
+import pandas as pd
+import regex
+
+from shekels.core.engine import Engine
+import shekels.core.engine as sen
+# ------------------------------------------------------------------------------
+
+
+class EngineTests(unittest.TestCase):
+    def test_regexp(self):
+        self.assertTrue(sen.regexp('f.o', 'FOO'))
+        self.assertTrue(sen.regexp('1\\.5', 1.5))
+        self.assertFalse(sen.regexp('bar', 'foo'))
+        self.assertFalse(sen.regexp('bar', None))
+        self.assertFalse(sen.regexp(None, 'foo'))
+
+        sen.get_regex.cache_clear()
+        sen.regexp('foo', 'foo')
+        sen.regexp('foo', 'bar')
+        self.assertEqual(sen.get_regex.cache_info().hits, 1)
+
+    def test_get_regex(self):
+        result = sen.get_regex('(\\d+,)+')
+        self.assertIsNotNone(result.search('1,22,333,'))
+
+        with self.assertRaisesRegex(regex.error, 'missing \\)'):
+            sen.get_regex('((')
+
+    def test_regexp_timeout(self):
+        value = 'a' * 35 + 'b'
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            sen.regexp('(a|aa)+$', value, timeout=0.1)
+        self.assertLess(time.monotonic() - start, 1)
+
+        self.assertTrue(sen.regexp('(a|aa)+b', value, timeout=1))
+        self.assertFalse(sen.regexp('(.*a){25}', 'a' * 24, timeout=1))
+
+    def get_data(self):
+        data = DataFrame()
+        data['date'] = pd.to_datetime(['2020-01-01', '2020-02-01', '2020-03-01'])
+        data['category'] = ['food', 'rent', 'food']
+        data['amount'] = [1.5, 1000.0, 2.5]
+        return data
+
+    def test_init(self):
+        expected = 'foo is not instance of .*DataFrame'
+        with self.assertRaisesRegex(EnforceError, expected):
+            Engine('foo')
+
+        engine = Engine(self.get_data())
+        self.assertEqual(engine.table, 'data')
+        self.assertEqual(engine.date_columns, ['date'])
+        engine.close()
+
+    def test_indexes(self):
+        engine = Engine(self.get_data(), indexes=['date', 'category', 'foo'])
+        result = engine.query(
+            "select name from sqlite_master where type = 'index' order by name"
+        ).name.tolist()
+        self.assertEqual(result, ['data_category', 'data_date'])
+        engine.close()
+
+    def test_query(self):
+        engine = Engine(self.get_data())
+        result = engine.query(
+            "select * from data where date >= '2020-01-15' and category = 'food'"
+        )
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result.date.dtype.kind, 'M')
+        self.assertEqual(result.date[0], pd.Timestamp('2020-03-01'))
+        self.assertEqual(result.amount[0], 2.5)
+
+        result = engine.query('select count(*) as n from data')
+        self.assertEqual(result.n[0], 3)
+
+        expected = 'no such table: foo'
+        with self.assertRaisesRegex(PandaSQLException, expected):
+            engine.query('select * from foo')
+        engine.close()
+
+    def test_query_regex(self):
+        engine = Engine(self.get_data())
+        result = engine.query(
+            "select * from data where category ~ 'FOOD' or amount > 100"
+        )
+        self.assertEqual(len(result), 3)
+
+        result = engine.query(
+            "select * from data where category !~ food and amount > 100"
+        )
+        self.assertEqual(result.category.tolist(), ['rent'])
+
+        # regex errors are reported
+        expected = 'missing \\)'
+        with self.assertRaisesRegex(PandaSQLException, expected):
+            engine.query("select * from data where category ~ '(('")
+        engine.close()
+
+    def test_query_timeout(self):
+        engine = Engine(self.get_data())
+        query = 'with recursive c(x) as (select 1 union all select x + 1 from c) '
+        query += 'select count(*) from c'
+        expected = 'Query exceeded time limit of 0.1 seconds.'
+        with self.assertRaisesRegex(TimeoutError, expected):
+            engine.query(query, timeout=0.1)
+
+        # progress handler is removed after query
+        result = engine.query('select * from data', timeout=0.1)
+        self.assertEqual(len(result), 3)
+        self.assertIsNone(engine._get_interrupt())
+        engine.close()
+
+    def test_query_timeout_regex(self):
+        engine = Engine(self.get_data())
+        engine._local.cancel = None
+        engine._local.timeout = 1
+        engine._local.deadline = 0
+        with self.assertRaisesRegex(TimeoutError, 'time limit of 1 seconds'):
+            engine._regexp('foo', 'foo')
+
+        engine._local.deadline = None
+        self.assertTrue(engine._regexp('foo', 'foo'))
+        engine.close()
+
+    def test_query_timeout_backtracking(self):
+        data = self.get_data()
+        data.loc[0, 'category'] = 'a' * 35 + 'b'
+        engine = Engine(data)
+        query = "select * from data where category ~ '(a|aa)+$'"
+        start = time.monotonic()
+        expected = 'Query exceeded time limit of 0.5 seconds.'
+        with self.assertRaisesRegex(TimeoutError, expected):
+            engine.query(query, timeout=0.5)
+        self.assertLess(time.monotonic() - start, 1.5)
+        engine.close()
+
+    def test_query_cancel(self):
+        engine = Engine(self.get_data())
+        cancel = Event()
+        result = engine.query('select * from data', cancel=cancel)
+        self.assertEqual(len(result), 3)
+
+        cancel.set()
+        with self.assertRaisesRegex(InterruptedError, 'Query cancelled.'):
+            engine.query("select * from data where category ~ 'food'", cancel=cancel)
+        engine.close()
+
+    def test_query_stats(self):
+        engine = Engine(self.get_data())
+        stats = {}
+        engine.query(
+            "select * from data where amount < 100 and category ~ 'food'",
+            stats=stats
+        )
+        self.assertEqual(stats['regex_calls'], 2)
+        self.assertGreater(stats['regex_seconds'], 0)
+
+        # stats are not collected without a dict
+        engine.query("select * from data where category ~ 'food'")
+        self.assertEqual(stats['regex_calls'], 2)
+        engine.close()
+
+    def test_explain(self):
+        engine = Engine(self.get_data())
+        result = engine.explain("select * from data where date > '2020-01-15'")
+        self.assertEqual(len(result), 1)
+        self.assertRegex(result[0], 'USING INDEX data_date')
+
+        with self.assertRaisesRegex(PandaSQLException, 'no such table: foo'):
+            engine.explain('select * from foo')
+        engine.close()
+
+    def test_query_threads(self):
+        engine = Engine(self.get_data())
+        results = []
+
+        def query():
+            results.append(len(engine.query('select * from data')))
+
+        threads = [Thread(target=query) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [3, 3, 3, 3])
+        self.assertLessEqual(len(engine._connections), sen.POOL_SIZE)
+        engine.close()
+
+    def test_pool(self):
+        expected = 'Pool size must be greater or equal to 1. 0 < 1.'
+        with self.assertRaisesRegex(EnforceError, expected):
+            Engine(self.get_data(), pool_size=0)
+
+        engine = Engine(self.get_data(), pool_size=2)
+        self.assertEqual(engine.pool_size, 2)
+        self.assertEqual(len(engine._connections), 1)
+        results = []
+
+        def query():
+            results.append(len(engine.query(
+                "select * from data where category ~ '^f'"
+            )))
+
+        # short lived threads do not leak connections
+        threads = [Thread(target=query) for _ in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [2] * 50)
+        self.assertLessEqual(len(engine._connections), 2)
+        self.assertEqual(engine._pool.qsize(), len(engine._connections))
+
+        # connections are reused by the same thread
+        for _ in range(10):
+            engine.query('select * from data')
+        self.assertLessEqual(len(engine._connections), 2)
+
+        engine.close()
+        self.assertEqual(engine._pool.qsize(), 0)
+
+    def test_release_closed(self):
+        engine = Engine(self.get_data())
+        conn = engine._acquire()
+        engine.close()
+
+        # checked out connections are closed once released
+        self.assertEqual(len(conn.execute('select * from data').fetchall()), 3)
+        engine._release(conn)
+        self.assertEqual(engine._pool.qsize(), 0)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute('select 1')
+
+    def test_retire(self):
+        engine = Engine(self.get_data())
+        engine.retain()
+        engine.retain()
+        engine.retire()
+        self.assertEqual(len(engine.query('select * from data')), 3)
+        engine.release()
+        self.assertNotEqual(engine._connections, [])
+
+        # closed on last release
+        engine.release()
+        self.assertEqual(engine._connections, [])
+
+        # closed immediately without references
+        engine = Engine(self.get_data())
+        engine.query('select * from data')
+        engine.retire()
+        self.assertEqual(engine._connections, [])
+
+    def test_close(self):
+        engine = Engine(self.get_data())
+        engine.query('select * from data')
+        engine.close()
+        self.assertEqual(engine._connections, [])
+
+        # database is freed once all connections are closed
+        expected = 'no such table: data'
+        with self.assertRaisesRegex(PandaSQLException, expected):
+            engine.query('select * from data')
+        engine.close()
+
+    def test_separate_databases(self):
+        a = Engine(self.get_data())
+        b = Engine(self.get_data().head(1))
+        self.assertEqual(len(a.query('select * from data')), 3)
+        self.assertEqual(len(b.query('select * from data')), 1)
+        a.close()
+        b.close()
+
+    def test_save_and_from_file(self):
+        with TemporaryDirectory() as root:
+            filepath = Path(root, 'data.db')
+            engine = Engine(self.get_data())
+            engine.save(filepath)
+            expected = engine.query('select * from data order by amount')
+            engine.close()
+
+            result = Engine.from_file(filepath, date_columns=['date'])
+            self.assertEqual(result.table, 'data')
+            self.assertEqual(result.date_columns, ['date'])
+            pd.testing.assert_frame_equal(
+                result.query('select * from data order by amount'), expected
+            )
+
+            # indexes are saved
+            indexes = result.query(
+                "select name from sqlite_master where type = 'index'"
+            ).name.tolist()
+            self.assertEqual(sorted(indexes), ['data_category', 'data_date'])
+
+            # regex operators are supported
+            query = 'select * from data where category ~ ^f'
+            self.assertEqual(len(result.query(query)), 2)
+
+            # read-only
+            with self.assertRaisesRegex(PandaSQLException, 'readonly'):
+                result.query("insert into data (category) values ('foo')")
+            result.close()
+
+    def test_from_file_missing(self):
+        with self.assertRaisesRegex(FileNotFoundError, 'does not exist'):
+            Engine.from_file('/tmp/foo/bar.db')
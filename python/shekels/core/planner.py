@@ -0,0 +1,321 @@
+from typing import List, Tuple  # noqa: F401
+
+from collections import namedtuple
+import re
+
+from shekels.core.cache import LRUCache
+# ------------------------------------------------------------------------------
+
+
+REGEX_TOKEN = re.compile(
+    r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|(!~|\bnot\s+regex\b)|(~|\bregex\b)",
+    flags=re.I
+)
+'''
+Matches quoted strings and identifiers, not regex operators and regex
+operators within a SQL query.
+'''
+
+BARE_VALUE = re.compile(r"\s*([^\s()'][^\s()]*)")
+'''
+Matches an unquoted value following a regex operator.
+'''
+
+LAST_WORD = re.compile(r"(\w+)\s*$")
+'''
+Matches the last word of a SQL fragment.
+'''
+
+NON_OPERANDS = [
+    'all', 'and', 'as', 'between', 'by', 'case', 'distinct', 'else',
+    'exists', 'from', 'glob', 'having', 'in', 'is', 'join', 'like', 'not',
+    'on', 'or', 'select', 'then', 'when', 'where',
+]
+'''
+Keywords which cannot precede or follow a binary regex operator as operands.
+'''
+
+TOKEN = re.compile(
+    r"('(?:[^']|'')*')|(\"(?:[^\"]|\"\")*\")|(\s+)|(\w+)|(.)", flags=re.S
+)
+'''
+Matches SQL tokens: strings, quoted identifiers, whitespace, words and single
+characters.
+'''
+
+WHITESPACE = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|\s+")
+'''
+Matches quoted strings and identifiers, and whitespace.
+'''
+
+CLAUSE_KEYWORDS = [
+    'except', 'group', 'having', 'intersect', 'limit', 'order', 'union',
+    'window',
+]
+'''
+Keywords which end a WHERE clause.
+'''
+
+PREDICATE_PRIORITY = dict(date=0, other=1, regex=2)
+'''
+Execution order of WHERE clause predicates by kind.
+'''
+
+PLAN_CACHE = LRUCache(max_bytes=16 * 1024**2)
+'''
+Cache of query plans keyed by normalized query.
+'''
+
+Predicate = namedtuple('Predicate', ['kind', 'sql'])
+'''
+Top-level conjunct of a WHERE clause.
+
+Attributes:
+    kind (str): Kind of predicate. Options: date, other, regex.
+    sql (str): SQL of predicate.
+'''
+
+QueryPlan = namedtuple('QueryPlan', ['sql', 'head', 'predicates', 'tail'])
+'''
+Parsed and optimized SQL query.
+
+Attributes:
+    sql (str): Executable SQL.
+    head (str): SQL up to and including WHERE keyword.
+    predicates (tuple[Predicate]): WHERE clause predicates in execution order.
+    tail (str): SQL following WHERE clause.
+'''
+
+
+def is_binary_operator(query, start, stop, word=False):
+    # type: (str, int, int, bool) -> bool
+    '''
+    Determines whether the regex operator at given span of given query is a
+    binary operator, which has an operand on either side. So, unary bitwise
+    NOT and identifiers named regex are not rewritten.
+
+    Args:
+        query (str): SQL query.
+        start (int): Start index of operator.
+        stop (int): Stop index of operator.
+        word (bool, optional): Whether operator is a word. Default: False.
+
+    Returns:
+        bool: Whether operator is binary.
+    '''
+    before = query[:start].rstrip()
+    if before == '':
+        return False
+    if before[-1] not in '\'")':
+        match = LAST_WORD.search(before)
+        if match is None or match.group(1).lower() in NON_OPERANDS:
+            return False
+
+    after = query[stop:]
+    if after.strip() == '':
+        return False
+    if word:
+        match = BARE_VALUE.match(after)
+        if after[0] not in ' \t\n' or (
+            match is not None and match.group(1).lower() in NON_OPERANDS
+        ):
+            return False
+    return True
+
+
+def rewrite_regex(query):
+    # type: (str) -> str
+    '''
+    Rewrites regex operators within given query into SQL REGEXP operators.
+    Unquoted values following regex operators are quoted. Operators within
+    quoted strings and identifiers, and operators which are not binary, such
+    as bitwise NOT, are left untouched.
+
+    Regex operators:
+
+        * ~, regex - Match regular expression
+        * !~, not regex - Do not match regular expression
+
+    Args:
+        query (str): SQL query that may include regex operators.
+
+    Returns:
+        str: SQL query.
+    '''
+    output = []
+    pos = 0
+    while True:
+        match = REGEX_TOKEN.search(query, pos)
+        if match is None:
+            output.append(query[pos:])
+            break
+
+        output.append(query[pos:match.start()])
+        pos = match.end()
+        quoted, not_regex, _ = match.groups()
+        if quoted is not None:
+            output.append(quoted)
+            continue
+
+        word = match.group()[-1].isalpha()
+        if not is_binary_operator(query, match.start(), pos, word=word):
+            # rescan remainder, so "not regex" may still match "regex"
+            output.append(query[match.start()])
+            pos = match.start() + 1
+            continue
+
+        output.append(' NOT REGEXP ' if not_regex else ' REGEXP ')
+        bare = BARE_VALUE.match(query, pos)
+        if bare is not None:
+            value = bare.group(1).replace("'", "''")
+            output.append(f"'{value}'")
+            pos = bare.end()
+    return ''.join(output)
+
+
+def normalize_query(query):
+    # type: (str) -> str
+    '''
+    Normalizes given query by collapsing whitespace outside of quotes and
+    removing trailing semicolons.
+
+    Args:
+        query (str): SQL query.
+
+    Returns:
+        str: Normalized query.
+    '''
+    query = WHITESPACE.sub(lambda x: x.group(1) or ' ', query)
+    return query.strip().rstrip(';').strip()
+
+
+def get_predicate(tokens):
+    # type: (List[Tuple[str, str]]) -> Predicate
+    '''
+    Classifies given predicate tokens.
+    Predicates calling REGEXP are regex predicates and predicates referencing a
+    date column are date predicates.
+
+    Args:
+        tokens (list[tuple[str, str]]): List of (kind, text) tokens.
+
+    Returns:
+        Predicate: Predicate.
+    '''
+    words = set()
+    for kind, text in tokens:
+        if kind == 'word':
+            words.add(text.lower())
+        elif kind == 'identifier':
+            words.add(text[1:-1].lower())
+
+    kind = 'other'
+    if 'regexp' in words:
+        kind = 'regex'
+    elif 'date' in words:
+        kind = 'date'
+    sql = ''.join(x[1] for x in tokens).strip()
+    return Predicate(kind, sql)
+
+
+def plan_query(query):
+    # type: (str) -> QueryPlan
+    '''
+    Parses given SQL + regex query into a query plan.
+    Regex operators are rewritten into REGEXP operators. If the WHERE clause
+    is a top-level conjunction, its predicates are reordered, so that date
+    predicates, which are indexed, run first and regex predicates, which are
+    most expensive, run last. Parentheses and CASE ... END expressions are
+    nested, so conjunctions within them are not split.
+
+    Args:
+        query (str): SQL query that may include regex operators.
+
+    Returns:
+        QueryPlan: Query plan.
+    '''
+    sql = rewrite_regex(normalize_query(query))
+    kinds = ['string', 'identifier', 'space', 'word', 'char']
+    tokens = []
+    for match in TOKEN.finditer(sql):
+        i = match.lastindex or 1
+        tokens.append((kinds[i - 1], match.group(i)))
+
+    # find top-level where clause
+    depth = 0
+    start = None
+    stop = len(tokens)
+    for i, (kind, text) in enumerate(tokens):
+        word = text.lower() if kind == 'word' else None
+        if text == '(' or word == 'case':
+            depth += 1
+        elif text == ')' or word == 'end':
+            depth -= 1
+        elif depth == 0 and word is not None:
+            if start is None and word == 'where':
+                start = i + 1
+            elif start is not None and word in CLAUSE_KEYWORDS:
+                stop = i
+                break
+
+    if start is None:
+        return QueryPlan(sql, sql, tuple(), '')
+
+    # split where clause into top-level conjuncts
+    conjuncts = [[]]  # type: List[List[Tuple[str, str]]]
+    depth = 0
+    between = False
+    reorder = True
+    for kind, text in tokens[start:stop]:
+        word = text.lower() if kind == 'word' else None
+        if text == '(' or word == 'case':
+            depth += 1
+        elif text == ')' or word == 'end':
+            depth -= 1
+        elif depth == 0 and word == 'between':
+            between = True
+        elif depth == 0 and word == 'or':
+            reorder = False
+        elif depth == 0 and word == 'and':
+            if between:
+                between = False
+            else:
+                conjuncts.append([])
+                continue
+        conjuncts[-1].append((kind, text))
+
+    predicates = [get_predicate(x) for x in conjuncts]
+    if reorder:
+        predicates = sorted(
+            predicates, key=lambda x: PREDICATE_PRIORITY[x.kind]
+        )
+    else:
+        predicates = [get_predicate(tokens[start:stop])]
+
+    head = ''.join(x[1] for x in tokens[:start]).strip()
+    tail = ''.join(x[1] for x in tokens[stop:]).strip()
+    sql = head + ' ' + ' AND '.join(x.sql for x in predicates)
+    if tail != '':
+        sql += ' ' + tail
+    return QueryPlan(sql, head, tuple(predicates), tail)
+
+
+def get_plan(query):
+    # type: (str) -> QueryPlan
+    '''
+    Gets query plan of given query.
+    Plans are cached in PLAN_CACHE by normalized query, so repeated queries
+    are only parsed once.
+
+    Args:
+        query (str): SQL query that may include regex operators.
+
+    Returns:
+        QueryPlan: Query plan.
+    '''
+    key = normalize_query(query)
+    plan = PLAN_CACHE.get(key)
+    if plan is None:
+        plan = plan_query(key)
+        PLAN_CACHE.set(key, plan)
+    return plan
@@ -0,0 +1,166 @@
+import unittest
+
+import shekels.core.planner as spl
+# ------------------------------------------------------------------------------
+
+
+class PlannerTests(unittest.TestCase):
+    def test_rewrite_regex(self):
+        result = spl.rewrite_regex("select * from data where foo ~ 'a|b'")
+        self.assertEqual(
+            result, "select * from data where foo  REGEXP  'a|b'"
+        )
+
+        result = spl.rewrite_regex('select * from data where foo regex a|b')
+        self.assertEqual(result, "select * from data where foo  REGEXP 'a|b'")
+
+        result = spl.rewrite_regex("foo !~ a and (bar NOT  REGEX b's)")
+        self.assertEqual(
+            result, "foo  NOT REGEXP 'a' and (bar  NOT REGEXP 'b''s')"
+        )
+
+        # quoted operators are ignored
+        expected = "select \"a ~ b\" from data where foo = 'x ~ y regex z'"
+        result = spl.rewrite_regex(expected)
+        self.assertEqual(result, expected)
+
+        # words containing regex are ignored
+        expected = 'select regex_column from data'
+        self.assertEqual(spl.rewrite_regex(expected), expected)
+
+    def test_rewrite_regex_unary(self):
+        # bitwise not is not a regex operator
+        for expected in [
+            'select ~amount as x from data',
+            'select -~amount from data',
+            'select * from data where ~amount > 1 and (~x) = 1',
+            'select ~ amount from data',
+        ]:
+            self.assertEqual(spl.rewrite_regex(expected), expected)
+
+        result = spl.rewrite_regex('select * from data where ~amount ~ 1')
+        self.assertEqual(result, "select * from data where ~amount  REGEXP '1'")
+
+        # identifiers named regex are not regex operators
+        for expected in [
+            'select regex from data',
+            'select amount regex from data',
+            'select * from data where regex = 1',
+            'select * from data where not regex',
+            'select t.regex from data as t',
+        ]:
+            self.assertEqual(spl.rewrite_regex(expected), expected)
+
+        result = spl.rewrite_regex('select * from data where regex regex a')
+        self.assertEqual(result, "select * from data where regex  REGEXP 'a'")
+        result = spl.rewrite_regex("select * from data where x not regex 'a'")
+        self.assertEqual(result, "select * from data where x  NOT REGEXP  'a'")
+
+    def test_normalize_query(self):
+        result = spl.normalize_query(
+            "  select *\n\tfrom   data where foo = 'a   b' ;  "
+        )
+        self.assertEqual(result, "select * from data where foo = 'a   b'")
+
+        result = spl.normalize_query('select "a  b" from data;;')
+        self.assertEqual(result, 'select "a  b" from data')
+
+    def test_get_predicate(self):
+        tokens = [('word', 'foo'), ('space', ' '), ('word', 'REGEXP')]
+        self.assertEqual(spl.get_predicate(tokens).kind, 'regex')
+
+        tokens = [('identifier', '"Date"'), ('char', '>'), ('word', '1')]
+        self.assertEqual(spl.get_predicate(tokens).kind, 'date')
+
+        tokens = [('word', 'amount'), ('char', '>'), ('word', '1')]
+        result = spl.get_predicate(tokens)
+        self.assertEqual(result, spl.Predicate('other', 'amount>1'))
+
+    def test_plan_query(self):
+        query = 'select * from data'
+        result = spl.plan_query(query)
+        self.assertEqual(result, spl.QueryPlan(query, query, tuple(), ''))
+
+        result = spl.plan_query(
+            "select * from data where description ~ foo and amount > 5 "
+            "and date >= '2020-01-01' order by date limit 5;"
+        )
+        expected = "select * from data where date >= '2020-01-01' AND " \
+            + "amount > 5 AND description  REGEXP 'foo' order by date limit 5"
+        self.assertEqual(result.sql, expected)
+        self.assertEqual(result.head, 'select * from data where')
+        self.assertEqual(result.tail, 'order by date limit 5')
+        self.assertEqual(
+            [x.kind for x in result.predicates], ['date', 'other', 'regex']
+        )
+
+    def test_plan_query_between(self):
+        result = spl.plan_query(
+            'select * from data where foo ~ x and amount between 1 and 5'
+        )
+        self.assertEqual(
+            result.sql,
+            "select * from data where amount between 1 and 5 AND foo  REGEXP 'x'"
+        )
+
+    def test_plan_query_or(self):
+        query = "select * from data where foo ~ x or date > 'y' and a = 1"
+        result = spl.plan_query(query)
+        self.assertEqual(result.sql, spl.rewrite_regex(query))
+        self.assertEqual(len(result.predicates), 1)
+
+    def test_plan_query_nested(self):
+        result = spl.plan_query(
+            'select * from (select * from data where a ~ x and date > 1) '
+            'where (b ~ y or c = 1) and date > 2'
+        )
+        expected = "select * from (select * from data where a  REGEXP 'x' " \
+            + "and date > 1) where date > 2 AND (b  REGEXP 'y' or c = 1)"
+        self.assertEqual(result.sql, expected)
+
+    def test_plan_query_case(self):
+        query = "select * from data where case when amount > 0 and " \
+            + "date > '2020' then 1 else 0 end = 1"
+        result = spl.plan_query(query)
+        self.assertEqual(result.sql, query)
+        self.assertEqual(len(result.predicates), 1)
+
+        query = "select * from data where foo ~ x and " \
+            + "CASE WHEN a > 0 AND b > 0 THEN 1 END = 1 and date > 'y'"
+        result = spl.plan_query(query)
+        expected = "select * from data where date > 'y' AND " \
+            + "CASE WHEN a > 0 AND b > 0 THEN 1 END = 1 AND foo  REGEXP 'x'"
+        self.assertEqual(result.sql, expected)
+
+        # where clause after a case expression in select
+        query = "select case when a > 0 and b > 0 then 1 end as c from data " \
+            + "where foo ~ x and date > 'y'"
+        result = spl.plan_query(query)
+        expected = "select case when a > 0 and b > 0 then 1 end as c from " \
+            + "data where date > 'y' AND foo  REGEXP 'x'"
+        self.assertEqual(result.sql, expected)
+
+    def test_plan_query_bitwise_not(self):
+        query = 'select ~amount as x from data where ~amount < 0 and foo ~ x'
+        result = spl.plan_query(query)
+        expected = 'select ~amount as x from data where ~amount < 0 AND '
+        expected += "foo  REGEXP 'x'"
+        self.assertEqual(result.sql, expected)
+        self.assertEqual(
+            [x.kind for x in result.predicates], ['other', 'regex']
+        )
+
+        spl.PLAN_CACHE.clear()
+        query = 'select -~amount from data'
+        self.assertEqual(spl.get_plan(query).sql, query)
+        self.assertEqual(spl.PLAN_CACHE.get(query).sql, query)
+
+    def test_get_plan(self):
+        spl.PLAN_CACHE.clear()
+        hits = spl.PLAN_CACHE.hits
+        misses = spl.PLAN_CACHE.misses
+        a = spl.get_plan('select * from data where foo ~ x')
+        b = spl.get_plan('  select *   from data\nwhere foo ~ x;')
+        self.assertIs(a, b)
+        self.assertEqual(spl.PLAN_CACHE.hits - hits, 1)
+        self.assertEqual(spl.PLAN_CACHE.misses - misses, 1)
@@ -0,0 +1,215 @@
+from typing import Any, Dict, List, Union  # noqa: F401
+
+from pathlib import Path
+from uuid import uuid4
+import fcntl
+import json
+import mmap
+import os
+import shutil
+
+from lunchbox.enforce import Enforce
+import numpy as np
+import pandas as pd
+
+from shekels.core.engine import Engine
+# ------------------------------------------------------------------------------
+
+
+MMAP_KINDS = 'biufcmM'
+'''
+Kinds of numpy dtypes stored as memory mapped arrays.
+'''
+
+
+class SharedStore:
+    '''
+    File-backed data store, through which one process publishes versions of
+    database data, and any number of other processes attach to them.
+
+    Each version is written to its own directory, which is never modified
+    once published:
+
+        * meta.json - version, digest and column metadata
+        * data.db - SQLite database, including indexes
+        * data.json - data serialized as JSON records
+        * columns - one file per column
+
+    Numeric, boolean and datetime columns are saved as numpy arrays and the
+    SQLite database and JSON are saved as files, all of which are memory
+    mapped when loaded. Memory mapped pages are shared between processes
+    through the OS page cache, so attached processes do not copy them. Other
+    columns are pickled, and are loaded into each process.
+
+    Every file of a version is opened when it is loaded, so versions deleted
+    by prune remain readable by processes which are still attached to them.
+    '''
+    def __init__(self, root, keep=2):
+        # type: (Union[str, Path], int) -> None
+        '''
+        Constructs a SharedStore instance. Creates root directory if it does
+        not exist.
+
+        Args:
+            root (str or Path): Store directory.
+            keep (int, optional): Number of latest versions kept when
+                publishing. Default: 2.
+
+        Raises:
+            EnforceError: If keep is less than 1.
+        '''
+        msg = 'Keep must be greater or equal to {b}. {a} < {b}.'
+        Enforce(keep, '>=', 1, message=msg)
+        # ----------------------------------------------------------------------
+
+        self.root = Path(root)
+        self.keep = keep
+        os.makedirs(self.root, exist_ok=True)
+
+    @property
+    def version(self):
+        # type: () -> int
+        '''
+        int: Latest published version, or 0 if nothing has been published.
+        '''
+        try:
+            return int(Path(self.root, 'current').read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def get_path(self, version):
+        # type: (int) -> Path
+        '''
+        Gets directory of given version.
+
+        Args:
+            version (int): Version.
+
+        Returns:
+            Path: Version directory.
+        '''
+        return Path(self.root, f'{version:08d}')
+
+    def publish(self, data, engine, json_, digest, version=1):
+        # type: (pd.DataFrame, Engine, bytes, str, int) -> int
+        '''
+        Publishes given data as a new version.
+        Data is written to a temporary directory, which is then renamed into
+        place, before the current version is atomically replaced. So, readers
+        never see partially written versions. All but the latest keep versions
+        are then deleted. Versions are chosen and published while holding an
+        exclusive lock on the store, so concurrent publishers do not collide.
+        Temporary directories are removed if publishing fails.
+
+        Args:
+            data (DataFrame): Data.
+            engine (Engine): Engine loaded with data.
+            json_ (bytes): Data serialized as JSON records.
+            digest (str): Digest of data.
+            version (int, optional): Minimum version number. Default: 1.
+
+        Returns:
+            int: Published version, which is greater than all previously
+                published versions.
+        '''
+        temp = Path(self.root, f'.tmp-{uuid4().hex}')
+        try:
+            os.makedirs(Path(temp, 'columns'))
+            columns = []
+            for i, col in enumerate(data.columns):
+                series = data[col].reset_index(drop=True)
+                dtype = series.dtype
+                if isinstance(dtype, np.dtype) and dtype.kind in MMAP_KINDS:
+                    filename = f'{i}.npy'
+                    np.save(Path(temp, 'columns', filename), series.to_numpy())
+                else:
+                    filename = f'{i}.pkl'
+                    series.to_pickle(Path(temp, 'columns', filename))
+                columns.append(dict(name=col, filename=filename))
+
+            engine.save(Path(temp, 'data.db'))
+            Path(temp, 'data.json').write_bytes(json_)
+
+            # version is chosen and published under an exclusive lock, so
+            # concurrent publishers never choose the same version
+            with open(Path(self.root, '.lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                version = max(version, self.version + 1)
+                meta = dict(
+                    version=version,
+                    digest=digest,
+                    rows=len(data),
+                    table=engine.table,
+                    date_columns=engine.date_columns,
+                    columns=columns,
+                )
+                Path(temp, 'meta.json').write_text(json.dumps(meta))
+
+                os.replace(temp, self.get_path(version))
+                current = Path(self.root, f'.current-{uuid4().hex}')
+                current.write_text(str(version))
+                os.replace(current, Path(self.root, 'current'))
+                self.prune()
+        finally:
+            shutil.rmtree(temp, ignore_errors=True)
+        return version
+
+    def prune(self):
+        # type: () -> None
+        '''
+        Deletes all but the latest keep versions.
+        '''
+        version = self.version
+        for path in self.root.iterdir():
+            if not path.is_dir() or not path.name.isdigit():
+                continue
+            if int(path.name) <= version - self.keep:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def load(self, version):
+        # type: (int) -> Dict[str, Any]
+        '''
+        Loads given published version. Memory mapped data is read-only.
+
+        Args:
+            version (int): Version.
+
+        Raises:
+            FileNotFoundError: If version does not exist.
+
+        Returns:
+            dict: Version, digest, data as DataFrame, Engine and JSON records
+                as a read-only memory map.
+        '''
+        path = self.get_path(version)
+        meta = json.loads(Path(path, 'meta.json').read_text())
+
+        data = {}
+        for item in meta['columns']:
+            filepath = Path(path, 'columns', item['filename'])
+            if filepath.suffix == '.npy':
+                data[item['name']] = np.load(filepath, mmap_mode='r')
+            else:
+                data[item['name']] = pd.read_pickle(filepath)
+        frame = pd.DataFrame(
+            data,
+            index=pd.RangeIndex(meta['rows']),
+            columns=[x['name'] for x in meta['columns']],
+            copy=False,
+        )
+
+        engine = Engine.from_file(
+            Path(path, 'data.db'),
+            date_columns=meta['date_columns'],
+            table=meta['table'],
+        )
+        with open(Path(path, 'data.json'), 'rb') as f:
+            json_ = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return dict(
+            version=meta['version'],
+            digest=meta['digest'],
+            data=frame,
+            engine=engine,
+            json=json_,
+        )
@@ -0,0 +1,202 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Barrier, Thread
+import mmap
+import unittest
+import unittest.mock as mock
+
+from lunchbox.enforce import EnforceError
+from pandas import DataFrame
+import numpy as np
+import pandas as pd
+
+from shekels.core.engine import Engine
+from shekels.core.store import SharedStore
+# ------------------------------------------------------------------------------
+
+
+class SharedStoreTests(unittest.TestCase):
+    def get_data(self):
+        data = DataFrame()
+        data['date'] = pd.to_datetime(['2020-01-01', None, '2020-03-01'])
+        data['category'] = ['food', 'rent', None]
+        data['amount'] = [1.5, 1000.0, np.nan]
+        data['count'] = [1, 2, 3]
+        data['flag'] = pd.array([True, None, False], dtype='boolean')
+        return data
+
+    def publish(self, store, data, version=1):
+        engine = Engine(data)
+        result = store.publish(data, engine, b'[]', 'digest', version=version)
+        engine.close()
+        return result
+
+    def test_init(self):
+        with TemporaryDirectory() as root:
+            root = Path(root, 'store')
+            result = SharedStore(root)
+            self.assertTrue(root.is_dir())
+            self.assertEqual(result.root, root)
+            self.assertEqual(result.keep, 2)
+
+            expected = 'Keep must be greater or equal to 1. 0 < 1.'
+            with self.assertRaisesRegex(EnforceError, expected):
+                SharedStore(root, keep=0)
+
+    def test_version(self):
+        with TemporaryDirectory() as root:
+            store = SharedStore(root)
+            self.assertEqual(store.version, 0)
+
+            Path(root, 'current').write_text('foo')
+            self.assertEqual(store.version, 0)
+
+            Path(root, 'current').write_text('7')
+            self.assertEqual(store.version, 7)
+
+    def test_publish(self):
+        with TemporaryDirectory() as root:
+            store = SharedStore(root)
+            data = self.get_data()
+            self.assertEqual(self.publish(store, data), 1)
+            self.assertEqual(store.version, 1)
+            self.assertEqual(self.publish(store, data), 2)
+            self.assertEqual(self.publish(store, data, version=10), 10)
+            self.assertEqual(self.publish(store, data, version=3), 11)
+
+            result = sorted(x.name for x in Path(root).iterdir())
+            self.assertEqual(
+                result, ['.lock', '00000010', '00000011', 'current']
+            )
+
+            result = sorted(x.name for x in Path(root, '00000011').iterdir())
+            expected = ['columns', 'data.db', 'data.json', 'meta.json']
+            self.assertEqual(result, expected)
+
+            result = sorted(
+                x.name for x in Path(root, '00000011', 'columns').iterdir()
+            )
+            expected = ['0.npy', '1.pkl', '2.npy', '3.npy', '4.pkl']
+            self.assertEqual(result, expected)
+
+    def test_publish_concurrent(self):
+        with TemporaryDirectory() as root:
+            store = SharedStore(root, keep=20)
+            data = self.get_data()
+            engine = Engine(data)
+            barrier = Barrier(8)
+            results = []  # type: list
+
+            def publish():
+                barrier.wait()
+                results.append(store.publish(data, engine, b'[]', 'digest'))
+
+            threads = [Thread(target=publish) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            engine.close()
+
+            self.assertEqual(sorted(results), list(range(1, 9)))
+            self.assertEqual(store.version, 8)
+            result = [x.name for x in Path(root).iterdir()]
+            self.assertEqual([x for x in result if x.startswith('.tmp')], [])
+            for version in results:
+                meta = store.load(version)
+                self.assertEqual(meta['version'], version)
+                meta['engine'].close()
+
+    def test_publish_error(self):
+        with TemporaryDirectory() as root:
+            store = SharedStore(root)
+            engine = mock.Mock()
+            engine.save.side_effect = OSError('foo')
+            with self.assertRaisesRegex(OSError, 'foo'):
+                store.publish(self.get_data(), engine, b'[]', 'digest')
+            self.assertEqual(list(Path(root).iterdir()), [])
+            self.assertEqual(store.version, 0)
+
+    def test_prune(self):
+        with TemporaryDirectory() as root:
+            store = SharedStore(root, keep=1)
+            Path(root, 'foo').mkdir()
+            self.publish(store, self.get_data())
+            self.publish(store, self.get_data())
+            result = sorted(x.name for x in Path(root).iterdir())
+            self.assertEqual(result, ['.lock', '00000002', 'current', 'foo'])
+
+    def test_load(self):
+        with TemporaryDirectory() as root:
+            store = SharedStore(root)
+            expected = self.get_data()
+            version = self.publish(store, expected)
+
+            result = store.load(version)
+            self.assertEqual(result['version'], version)
+            self.assertEqual(result['digest'], 'digest')
+            pd.testing.assert_frame_equal(result['data'], expected)
+
+            data = result['data']
+            for col in ['date', 'amount', 'count']:
+                self.assertIsInstance(data[col].values.base, np.memmap)
+            with self.assertRaisesRegex(ValueError, 'read-only'):
+                data.loc[0, 'amount'] = 99
+
+            engine = result['engine']
+            self.assertEqual(engine.date_columns, ['date'])
+            query = 'select * from data where category ~ food'
+            result = engine.query(query)
+            self.assertEqual(len(result), 1)
+            self.assertIs(result.date.dtype.kind, 'M')
+            engine.close()
+
+    def test_load_index(self):
+        with TemporaryDirectory() as root:
+            store = SharedStore(root)
+            data = self.get_data().iloc[1:]
+            result = store.load(self.publish(store, data))['data']
+            self.assertEqual(result.index.tolist(), [0, 1])
+            self.assertEqual(result.amount.tolist()[0], 1000.0)
+            self.assertEqual(result.category.tolist()[0], 'rent')
+
+    def test_load_missing(self):
+        with TemporaryDirectory() as root:
+            with self.assertRaises(FileNotFoundError):
+                SharedStore(root).load(1)
+
+    def test_load_json(self):
+        with TemporaryDirectory() as root:
+            store = SharedStore(root)
+            version = self.publish(store, self.get_data())
+            result = store.load(version)
+            self.assertIsInstance(result['json'], mmap.mmap)
+            self.assertEqual(result['json'][:], b'[]')
+            result['engine'].close()
+
+    def test_load_pruned(self):
+        with TemporaryDirectory() as root:
+            store = SharedStore(root, keep=1)
+            data = self.get_data()
+            result = store.load(self.publish(store, data))
+            engine = result['engine']
+            self.assertEqual(len(engine._connections), engine.pool_size)
+
+            # loaded version remains readable after it is pruned
+            self.publish(store, data)
+            self.assertFalse(store.get_path(1).exists())
+            self.assertEqual(result['json'][:], b'[]')
+            pd.testing.assert_frame_equal(result['data'], data)
+
+            def query():
+                results.append(len(engine.query('select * from data')))
+
+            results = []  # type: list
+            threads = [Thread(target=query) for _ in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, [3] * 20)
+            self.assertEqual(len(engine._connections), engine.pool_size)
+            engine.close()
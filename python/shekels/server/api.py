@@ -1,14 +1,17 @@
-from typing import Any  # noqa: F401
+from typing import Any, Dict  # noqa: F401
 
 from json import JSONDecodeError
+from threading import Event, Lock, Thread
 import json
 
+from lunchbox.enforce import EnforceError
 from pandasql import PandaSQLException
 from schematics.exceptions import DataError
 import flasgger as swg
 import flask
 
 from shekels.core.database import Database
+import shekels.core.data_tools as sdt
 import shekels.server.server_tools as svt
 # ------------------------------------------------------------------------------
 
@@ -31,12 +34,32 @@ def get_api():
             super().__init__(*args, **kwargs)
             self.database = None
             self.config = None
+            self.warm_up = None
+            self.searches = {}  # type: Dict[str, Event]
+            self.search_lock = Lock()
     return ApiBlueprint('api', __name__, url_prefix='')
 
 
 API = get_api()
 
 
+@API.before_app_request
+def sync():
+    # type: () -> None
+    '''
+    Attaches database to the latest data published to its shared store by
+    another process, before each request. If the app config has a shared
+    store, processes which have not been initialized build their database
+    from it, so that every worker process serves published data.
+    '''
+    if API.database is None:
+        if API.config is None or API.config.get('shared_store') is None:
+            return
+        API.database = Database(API.config)
+        API.config = API.database.config
+    API.database.sync()
+
+
 @API.route('/api')
 def api():
     # type: () -> Any
@@ -100,6 +123,11 @@ def initialize():
     API.database = Database(config)
     API.config = API.database.config
 
+    # compile plot plans once per config
+    sdt.get_plans(
+        API.config.get('plots', []), API.config.get('color_scheme', {})
+    )
+
     return flask.Response(
         response=json.dumps(dict(
             message='Database initialized.',
@@ -125,7 +153,8 @@ def initialize():
 def update():
     # type: () -> flask.Response
     '''
-    Update database.
+    Update database. If config's warm_cache is true, caches are warmed in a
+    background thread, stored as API.warm_up.
 
     Raise:
         RuntimeError: If database has not been initialized.
@@ -138,6 +167,14 @@ def update():
         raise RuntimeError(msg)
 
     API.database.update()
+    if API.config.get('warm_cache', False):
+        API.warm_up = Thread(
+            target=svt.warm_cache,
+            args=(API.database, API.config),
+            daemon=True,
+        )
+        API.warm_up.start()
+
     return flask.Response(
         response=json.dumps(dict(
             message='Database updated.',
@@ -149,9 +186,41 @@ def update():
 
 @API.route('/api/read', methods=['GET', 'POST'])
 @swg.swag_from(dict(
+    parameters=[
+        dict(
+            name='limit',
+            type='integer',
+            description='Maximum number of rows returned.',
+            required=False,
+        ),
+        dict(
+            name='offset',
+            type='integer',
+            description='Number of rows skipped.',
+            required=False,
+        ),
+        dict(
+            name='order_by',
+            type='string',
+            description='Comma separated columns to sort by. Prefix "-" for descending.',
+            required=False,
+        ),
+        dict(
+            name='format',
+            type='string',
+            description='Response format: json, columnar, ndjson, arrow or parquet.',
+            required=False,
+        ),
+        dict(
+            name='cursor',
+            type='string',
+            description='Cursor returned as next_cursor by previous request.',
+            required=False,
+        ),
+    ],
     responses={
         200: dict(
-            description='Read all data from database.',
+            description='Read data from database, with row total and next page cursor.',
             content='application/json',
         ),
         500: dict(
@@ -162,7 +231,8 @@ def update():
 def read():
     # type: () -> flask.Response
     '''
-    Read database.
+    Read database. Page parameters may be supplied as query string
+    arguments or as JSON.
 
     Raises:
         RuntimeError: If database has not been initilaized.
@@ -175,17 +245,33 @@ def read():
         msg = 'Database not initialized. Please call initialize.'
         raise RuntimeError(msg)
 
-    response = {}  # type: Any
+    params = flask.request.args.to_dict()  # type: Any
+    if flask.request.is_json:
+        params = flask.request.get_json()
+        if isinstance(params, str):
+            params = json.loads(params)
+
     try:
-        response = API.database.read()
+        format_ = svt.get_response_format(
+            params, flask.request.accept_mimetypes
+        )
+        params = svt.get_page_params(params, API.database.version)
+        params['query'] = None
+        etag = svt.get_etag(API.database, params, format_)
+        if flask.request.if_none_match.contains(etag):
+            return svt.not_modified_response(etag)
+
+        unpaged = params == dict(query=None, limit=None, offset=0, order_by=[])
+        if format_ == 'json' and unpaged:
+            response = svt.read_to_response(API.database)
+        else:
+            page = svt.get_page_response(API.database, params, format_=format_)
+            response = svt.page_to_response(page, format_)
     except Exception as error:
         return svt.error_to_response(error)
 
-    response = {'response': response}
-    return flask.Response(
-        response=json.dumps(response),
-        mimetype='application/json'
-    )
+    response.set_etag(etag)
+    return response
 
 
 @API.route('/api/search', methods=['POST'])
@@ -196,7 +282,43 @@ def read():
             type='string',
             description='SQL query for searching database. Make sure to use "FROM data" in query.',
             required=True,
-        )
+        ),
+        dict(
+            name='limit',
+            type='integer',
+            description='Maximum number of rows returned.',
+            required=False,
+        ),
+        dict(
+            name='offset',
+            type='integer',
+            description='Number of rows skipped.',
+            required=False,
+        ),
+        dict(
+            name='order_by',
+            type='string',
+            description='Column or columns to sort by. Prefix "-" for descending.',
+            required=False,
+        ),
+        dict(
+            name='format',
+            type='string',
+            description='Response format: json, columnar, ndjson, arrow or parquet.',
+            required=False,
+        ),
+        dict(
+            name='channel',
+            type='string',
+            description='Search channel. A search cancels the running search of its channel.',
+            required=False,
+        ),
+        dict(
+            name='cursor',
+            type='string',
+            description='Cursor of next page. Replaces all other parameters.',
+            required=False,
+        ),
     ],
     responses={
         200: dict(
@@ -205,22 +327,25 @@ def read():
         ),
         500: dict(
             description='Internal server error.',
-        )
+        ),
+        504: dict(
+            description='Query exceeded time limit.',
+        ),
     }
 ))
 def search():
     # type: () -> flask.Response
     '''
     Search database with a given SQL query.
+    Queries are limited to config's query_timeout. A search with a channel
+    cancels the running search of the same channel.
 
     Returns:
         Response: Flask Response instance.
     '''
     params = flask.request.get_json()  # type: Any
     params = json.loads(params)
-    try:
-        query = params['query']
-    except KeyError:
+    if 'query' not in params and 'cursor' not in params:
         msg = 'Please supply valid search params in the form '
         msg += '{"query": SQL query}.'
         raise RuntimeError(msg)
@@ -229,14 +354,139 @@ def search():
         msg = 'Database not initialized. Please call initialize.'
         raise RuntimeError(msg)
 
-    if API.database.data is None:
+    if not API.database.is_loaded:
         msg = 'Database not updated. Please call update.'
         raise RuntimeError(msg)
 
-    response = API.database.search(query)  # type: Any
-    response = {'response': response}
+    channel = params.get('channel')
+    format_ = svt.get_response_format(params, flask.request.accept_mimetypes)
+    params = svt.get_page_params(params, API.database.version)
+    etag = svt.get_etag(API.database, params, format_)
+    if flask.request.if_none_match.contains(etag):
+        return svt.not_modified_response(etag)
+
+    # a search cancels the running search of its channel
+    cancel = None
+    if channel is not None:
+        cancel = Event()
+        with API.search_lock:
+            if channel in API.searches:
+                API.searches[channel].set()
+            API.searches[channel] = cancel
+
+    try:
+        page = svt.get_page_response(
+            API.database, params, cancel=cancel, format_=format_
+        )
+    finally:
+        if channel is not None:
+            with API.search_lock:
+                if API.searches.get(channel) is cancel:
+                    del API.searches[channel]
+
+    response = svt.page_to_response(page, format_)
+    response.set_etag(etag)
+    return response
+
+
+@API.route('/api/search/batch', methods=['POST'])
+@swg.swag_from(dict(
+    parameters=[
+        dict(
+            name='queries',
+            type='object',
+            description='Map of query id to SQL query or search params, or list of queries.',
+            required=True,
+        ),
+        dict(
+            name='workers',
+            type='integer',
+            description='Number of queries executed in parallel, up to number of CPUs. Default: 1.',
+            required=False,
+        ),
+    ],
+    responses={
+        200: dict(
+            description='Returns a map of query id to search response or error.',
+            content='application/json',
+        ),
+        500: dict(
+            description='Internal server error.',
+        ),
+    }
+))
+def search_batch():
+    # type: () -> flask.Response
+    '''
+    Search database with a batch of SQL queries, in a single request.
+
+    Returns:
+        Response: Flask Response instance.
+    '''
+    params = flask.request.get_json()  # type: Any
+    params = json.loads(params)
+
+    if API.database is None:
+        msg = 'Database not initialized. Please call initialize.'
+        raise RuntimeError(msg)
+
+    if not API.database.is_loaded:
+        msg = 'Database not updated. Please call update.'
+        raise RuntimeError(msg)
+
+    queries, workers = svt.get_batch_params(params, API.database.version)
+    response = svt.search_batch(API.database, queries, workers=workers)
+    return flask.Response(
+        response=json.dumps({'response': response}),
+        mimetype='application/json'
+    )
+
+
+@API.route('/api/search/explain', methods=['POST'])
+@swg.swag_from(dict(
+    parameters=[
+        dict(
+            name='query',
+            type='string',
+            description='SQL query to be profiled. Make sure to use "FROM data" in query.',
+            required=True,
+        )
+    ],
+    responses={
+        200: dict(
+            description='Returns query plan and per stage timings, rows and bytes.',
+            content='application/json',
+        ),
+        500: dict(
+            description='Internal server error.',
+        ),
+        504: dict(
+            description='Query exceeded time limit.',
+        ),
+    }
+))
+def explain():
+    # type: () -> flask.Response
+    '''
+    Profile a search query. The query is executed without caching.
+
+    Returns:
+        Response: Flask Response instance.
+    '''
+    params = flask.request.get_json()  # type: Any
+    params = json.loads(params)
+    if 'query' not in params:
+        msg = 'Please supply valid explain params in the form '
+        msg += '{"query": SQL query}.'
+        raise RuntimeError(msg)
+
+    if API.database is None:
+        msg = 'Database not initialized. Please call initialize.'
+        raise RuntimeError(msg)
+
+    response = API.database.explain(params['query'])
     return flask.Response(
-        response=json.dumps(response),
+        response=json.dumps({'response': response}),
         mimetype='application/json'
     )
 
@@ -300,6 +550,51 @@ def handle_sql_error(error):
         Response: PandaSQLException response.
     '''
     return svt.error_to_response(error)
+
+
+@API.errorhandler(EnforceError)
+def handle_enforce_error(error):
+    # type: (EnforceError) -> flask.Response
+    '''
+    Handles errors raised by parameter validation.
+
+    Args:
+        error (EnforceError): Enforce error.
+
+    Returns:
+        Response: EnforceError response.
+    '''
+    return svt.error_to_response(error)
+
+
+@API.errorhandler(TimeoutError)
+def handle_timeout_error(error):
+    # type: (TimeoutError) -> flask.Response
+    '''
+    Handles query timeout errors.
+
+    Args:
+        error (TimeoutError): Timeout error.
+
+    Returns:
+        Response: TimeoutError response with 504 status.
+    '''
+    return svt.error_to_response(error, code=504)
+
+
+@API.errorhandler(InterruptedError)
+def handle_interrupted_error(error):
+    # type: (InterruptedError) -> flask.Response
+    '''
+    Handles cancelled query errors.
+
+    Args:
+        error (InterruptedError): Interrupted error.
+
+    Returns:
+        Response: InterruptedError response with 409 status.
+    '''
+    return svt.error_to_response(error, code=409)
 # ------------------------------------------------------------------------------
 
 
@@ -307,3 +602,6 @@ API.register_error_handler(500, handle_data_error)
 API.register_error_handler(500, handle_runtime_error)
 API.register_error_handler(500, handle_json_decode_error)
 API.register_error_handler(500, handle_sql_error)
+API.register_error_handler(500, handle_enforce_error)
+API.register_error_handler(504, handle_timeout_error)
+API.register_error_handler(409, handle_interrupted_error)
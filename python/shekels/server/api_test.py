@@ -1,14 +1,18 @@
 from copy import deepcopy
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from threading import Event
 import json
+import sys
 import unittest
+import unittest.mock as mock
 
 from pandas import DataFrame
 import flasgger as swg
 import flask
 
 from shekels.core.database import Database
+import shekels.core.data_tools as sdt
 import shekels.server.api as api
 # ------------------------------------------------------------------------------
 
@@ -100,6 +104,8 @@ class ApiTests(unittest.TestCase):
 
         self.app = self.context.app
         self.app.api.database = None
+        self.app.api.config = None
+        self.app.api.warm_up = None
         api.config = None
 
         self.client = self.app.test_client()
@@ -167,6 +173,110 @@ class ApiTests(unittest.TestCase):
         expected = self.app.api.database.read()
         self.assertEqual(result, expected)
 
+    def test_read_cached_payload(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        # data is served from bytes serialized at update time
+        database = self.app.api.database
+        with mock.patch.object(Database, 'read') as read:
+            result = self.client.get('/api/read').json
+            read.assert_not_called()
+        expected = dict(
+            response=database.read(), total=4, next_cursor=None
+        )
+        self.assertEqual(result, expected)
+
+    def test_read_page(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+        expected = self.app.api.database.read()
+
+        # query string
+        result = self.client.get('/api/read?limit=2&order_by=-amount').json
+        self.assertEqual(result['total'], 4)
+        amounts = sorted([x['amount'] for x in expected], reverse=True)
+        self.assertEqual([x['amount'] for x in result['response']], amounts[:2])
+
+        # json
+        params = json.dumps(dict(limit=3, offset=1))
+        result = self.client.post('/api/read', json=params).json
+        self.assertEqual(result['response'], expected[1:4])
+        self.assertIsNone(result['next_cursor'])
+
+        # cursor
+        result = self.client.get('/api/read?limit=3').json
+        self.assertEqual(result['response'], expected[:3])
+        cursor = result['next_cursor']
+        result = self.client.get(f'/api/read?cursor={cursor}').json
+        self.assertEqual(result['response'], expected[3:])
+        self.assertIsNone(result['next_cursor'])
+
+        # bad params
+        result = self.client.get('/api/read?limit=foo').json['message']
+        self.assertRegex(result, 'Limit must be a non-negative integer')
+
+        # stale cursor
+        self.client.post('/api/update')
+        result = self.client.get(f'/api/read?cursor={cursor}').json['message']
+        self.assertRegex(result, 'Cursor is stale')
+
+    def test_read_ndjson(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        result = self.client.get('/api/read?format=ndjson&limit=3')
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        self.assertEqual(result.headers['X-Total-Count'], '4')
+        self.assertIn('X-Next-Cursor', result.headers)
+        result = [json.loads(x) for x in result.get_data(as_text=True).splitlines()]
+        expected = self.app.api.database.read()[:3]
+        self.assertEqual(result, expected)
+
+        result = self.client.get('/api/read?format=foo').json['message']
+        self.assertRegex(result, 'Invalid response format: foo')
+
+    def test_read_columnar(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        headers = {'Accept': 'application/vnd.shekels.columnar+json'}
+        result = self.client.get('/api/read', headers=headers)
+        self.assertEqual(
+            result.mimetype, 'application/vnd.shekels.columnar+json'
+        )
+        result = json.loads(result.get_data())['response']
+        expected = DataFrame(self.app.api.database.read())
+        self.assertEqual(result['amount'], expected.amount.tolist())
+        self.assertEqual(sorted(result.keys()), sorted(expected.columns))
+
+    def test_read_etag(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        result = self.client.get('/api/read')
+        etag = result.headers['ETag']
+        self.assertRegex(etag, '^"1-[a-f0-9]{16}"$')
+
+        headers = {'If-None-Match': etag}
+        result = self.client.get('/api/read', headers=headers)
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.get_data(), b'')
+
+        result = self.client.get('/api/read?limit=2', headers=headers)
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result.headers['ETag'], etag)
+
+        self.client.post('/api/update')
+        result = self.client.get('/api/read', headers=headers)
+        self.assertEqual(result.status_code, 200)
+        self.assertRegex(result.headers['ETag'], '^"2-')
+
     def test_read_no_init(self):
         result = self.client.post('/api/read').json['message']
         expected = 'Database not initialized. Please call initialize.'
@@ -193,6 +303,29 @@ class ApiTests(unittest.TestCase):
         expected = 'Database updated.'
         self.assertEqual(result, expected)
 
+    def test_update_warm_cache(self):
+        self.config['warm_cache'] = True
+        self.config['pinned_queries'] = ['select * from data where amount > 50']
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.assertIsNone(self.app.api.warm_up)
+
+        result = self.client.post('/api/update').json['message']
+        self.assertEqual(result, 'Database updated.')
+
+        self.app.api.warm_up.join()
+        self.assertFalse(self.app.api.warm_up.is_alive())
+        with mock.patch.object(sdt, 'query_data') as query_data:
+            self.app.api.database.search('select * from data where amount > 50')
+            query_data.assert_not_called()
+
+        # no warm up by default
+        self.app.api.warm_up = None
+        self.config['warm_cache'] = False
+        self.client.post('/api/initialize', json=json.dumps(self.config))
+        self.client.post('/api/update')
+        self.assertIsNone(self.app.api.warm_up)
+
     def test_update_no_init(self):
         result = self.client.post('/api/update').json['message']
         expected = 'Database not initialized. Please call initialize.'
@@ -213,6 +346,232 @@ class ApiTests(unittest.TestCase):
         expected = self.app.api.database.search(query)
         self.assertEqual(result, expected)
 
+    def test_search_shared_store(self):
+        self.config['shared_store'] = Path(self.root, 'store').as_posix()
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+
+        # data is published by another process
+        ingest = Database(self.config).update()
+
+        query = 'SELECT * FROM data WHERE amount > 50'
+        temp = json.dumps({'query': query})
+        result = self.client.post('/api/search', json=temp).json['response']
+        self.assertEqual(result, ingest.search(query))
+        self.assertEqual(self.app.api.database.version, ingest.version)
+
+        ingest.update()
+        self.client.post('/api/search', json=temp)
+        self.assertEqual(self.app.api.database.version, 2)
+
+    def test_search_shared_store_worker(self):
+        self.config['shared_store'] = Path(self.root, 'store').as_posix()
+        query = 'SELECT * FROM data WHERE amount > 50'
+        temp = json.dumps({'query': query})
+
+        # worker without app config is not initialized
+        result = self.client.post('/api/search', json=temp).json
+        self.assertRegex(result['message'], 'Database not initialized')
+
+        # worker with app config builds database, which attaches once data
+        # is published by another process
+        self.app.api.config = deepcopy(self.config)
+        result = self.client.post('/api/search', json=temp).json
+        self.assertRegex(result['message'], 'Database not updated')
+        self.assertIsNotNone(self.app.api.database)
+
+        ingest = Database(self.config).update()
+        result = self.client.post('/api/search', json=temp).json['response']
+        self.assertEqual(result, ingest.search(query))
+        self.assertEqual(self.app.api.database.version, ingest.version)
+
+    def test_search_shared_store_prune(self):
+        self.config['shared_store'] = Path(self.root, 'store').as_posix()
+        self.app.api.config = deepcopy(self.config)
+        ingest = Database(self.config).update()
+        self.client.get('/api/read')
+
+        # attached version is pruned by newer publishes
+        with mock.patch.object(Database, 'sync'):
+            ingest.update()
+            ingest.update()
+            path = Path(self.root, 'store', '00000001')
+            self.assertFalse(path.exists())
+
+            result = self.client.get('/api/read').json['response']
+            self.assertEqual(result, ingest.read())
+
+            query = 'SELECT * FROM data WHERE amount > 50'
+            temp = json.dumps({'query': query, 'limit': 1})
+            result = self.client.post('/api/search', json=temp).json
+            self.assertEqual(result['response'], ingest.search(query)[:1])
+        self.assertEqual(self.app.api.database.version, 1)
+
+    def test_search_page(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        query = 'SELECT * FROM data WHERE amount > 50'
+        expected = self.app.api.database.search(query)
+        amounts = sorted([x['amount'] for x in expected], reverse=True)
+        params = json.dumps(dict(query=query, limit=1, order_by=['-amount']))
+        result = self.client.post('/api/search', json=params).json
+        self.assertEqual(result['total'], len(expected))
+        self.assertEqual(result['response'][0]['amount'], amounts[0])
+
+        params = json.dumps(dict(cursor=result['next_cursor']))
+        result = self.client.post('/api/search', json=params).json
+        self.assertEqual(result['response'][0]['amount'], amounts[1])
+
+        # unknown column
+        params = json.dumps(dict(query=query, order_by='foo'))
+        result = self.client.post('/api/search', json=params).json
+        self.assertEqual(result['error'], 'EnforceError')
+
+    def test_search_ndjson(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        query = 'SELECT * FROM data WHERE amount > 50'
+        params = json.dumps(dict(query=query, format='ndjson'))
+        result = self.client.post('/api/search', json=params)
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        self.assertNotIn('X-Next-Cursor', result.headers)
+        result = [json.loads(x) for x in result.get_data(as_text=True).splitlines()]
+        expected = self.app.api.database.search(query)
+        self.assertEqual(result, expected)
+
+    def test_search_arrow(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        query = 'SELECT * FROM data WHERE amount > 50'
+        params = json.dumps(dict(query=query, format='parquet'))
+        with mock.patch.dict(sys.modules, {'pyarrow': None}):
+            result = self.client.post('/api/search', json=params).json
+        self.assertEqual(result['error'], 'RuntimeError')
+        self.assertRegex(result['message'], 'requires pyarrow')
+
+    def test_search_etag(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        params = json.dumps(dict(query='SELECT * FROM data'))
+        result = self.client.post('/api/search', json=params)
+        etag = result.headers['ETag']
+
+        headers = {'If-None-Match': etag}
+        params = json.dumps(dict(query='  SELECT *\nFROM data;'))
+        with mock.patch.object(Database, 'search') as search:
+            result = self.client.post('/api/search', json=params, headers=headers)
+            search.assert_not_called()
+        self.assertEqual(result.status_code, 304)
+
+    def test_search_timeout(self):
+        self.config['query_timeout'] = 0.1
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        query = 'with recursive c(x) as (select 1 union all select x + 1 from c) '
+        query += 'select count(*) from c'
+        result = self.client.post('/api/search', json=json.dumps({'query': query}))
+        self.assertEqual(result.status_code, 504)
+        self.assertEqual(result.json['error'], 'TimeoutError')
+        self.assertRegex(result.json['message'], 'time limit of 0.1 seconds')
+
+    def test_search_cancel(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        running = Event()
+        self.app.api.searches['foo'] = running
+        params = json.dumps(dict(query='SELECT * FROM data', channel='foo'))
+        result = self.client.post('/api/search', json=params)
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(running.is_set())
+        self.assertEqual(self.app.api.searches, {})
+
+        # cancelled searches
+        def search(*args, **kwargs):
+            raise InterruptedError('Query cancelled.')
+
+        with mock.patch.object(Database, '_search_frame', side_effect=search):
+            params = json.dumps(dict(query='SELECT 1', channel='foo'))
+            result = self.client.post('/api/search', json=params)
+        self.assertEqual(result.status_code, 409)
+        self.assertEqual(result.json['error'], 'InterruptedError')
+        self.assertEqual(self.app.api.searches, {})
+
+    def test_search_batch(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        queries = dict(
+            foo='SELECT * FROM data WHERE amount > 50',
+            bar=dict(query='SELECT * FROM data', order_by='-amount', limit=1),
+            baz='SELECT * FROM baz',
+        )
+        params = json.dumps(dict(queries=queries, workers=2))
+        with mock.patch.object(sdt, 'Engine') as engine:
+            result = self.client.post('/api/search/batch', json=params).json
+            engine.assert_not_called()
+        result = result['response']
+
+        database = self.app.api.database
+        self.assertEqual(result['foo']['response'], database.search(queries['foo']))
+        expected = max(x['amount'] for x in database.read())
+        self.assertEqual(result['bar']['response'][0]['amount'], expected)
+        self.assertEqual(result['baz']['error'], 'PandaSQLException')
+
+    def test_search_batch_errors(self):
+        params = json.dumps(dict(queries=['SELECT * FROM data']))
+        result = self.client.post('/api/search/batch', json=params).json
+        self.assertRegex(result['message'], 'Please call initialize.')
+
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        result = self.client.post('/api/search/batch', json=params).json
+        self.assertRegex(result['message'], 'Please call update.')
+
+        self.client.post('/api/update')
+        params = json.dumps(dict(queries='foo'))
+        result = self.client.post('/api/search/batch', json=params).json
+        self.assertRegex(result['message'], 'Please supply valid batch params')
+
+    def test_explain(self):
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        self.client.post('/api/update')
+
+        params = json.dumps({'query': 'SELECT * FROM data WHERE amount > 50'})
+        result = self.client.post('/api/search/explain', json=params).json
+        result = result['response']
+        self.assertEqual(result['predicates'][0]['kind'], 'other')
+        result = [x['stage'] for x in result['stages']]
+        self.assertEqual(result, ['plan', 'execute', 'serialize'])
+
+    def test_explain_errors(self):
+        params = json.dumps({'query': 'SELECT * FROM data'})
+        result = self.client.post('/api/search/explain', json=params).json
+        expected = 'Database not initialized. Please call initialize.'
+        self.assertRegex(result['message'], expected)
+
+        config = json.dumps(self.config)
+        self.client.post('/api/initialize', json=config)
+        result = self.client.post('/api/search/explain', json=params).json
+        self.assertRegex(result['message'], 'Please call update.')
+
+        params = json.dumps({'foo': 'bar'})
+        result = self.client.post('/api/search/explain', json=params).json
+        self.assertRegex(result['message'], 'Please supply valid explain params')
+
     def test_search_no_query(self):
         # init database
         config = json.dumps(self.config)
@@ -1,11 +1,13 @@
-from typing import Any, Dict, List, Tuple, Union  # noqa: F401
+from typing import Any, Dict, List, Optional, Tuple, Union  # noqa: F401
 
 from copy import copy
 from copy import deepcopy
 from pathlib import Path
+import json
 import os
 
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, MATCH, Output, State
+from dash.exceptions import PreventUpdate
 from flask_caching import Cache
 import dash
 from dash import dash_table
@@ -19,6 +21,7 @@ import jsoncomment as jsonc
 
 from shekels.server.api import API
 import shekels.core.config as cfg
+import shekels.core.data_tools as sdt
 import shekels.server.components as svc
 import shekels.server.event_listener as sev
 import shekels.server.server_tools as svt
@@ -37,16 +40,45 @@ def liveness():
 
 
 def readiness():
-    # type: () -> None
+    # type: () -> Dict[str, bool]
     '''
-    Readiness probe for kubernetes.
+    Readiness probe for kubernetes. Data is loaded before caches are warmed
+    up, so the app is ready while warm-up is in progress.
 
     Raises:
         HealthError: If api is not availiable.
+
+    Returns:
+        dict: Whether cache warm-up is in progress, as warming.
     '''
     if not hasattr(APP, 'api'):
         raise HealthError('App is missing API.')
 
+    warm_up = getattr(APP.api, 'warm_up', None)
+    return dict(warming=warm_up is not None and warm_up.is_alive())
+
+
+def ready():
+    # type: () -> flask.Response
+    '''
+    Readiness endpoint. Responds like the healthz endpoints, with the
+    warming status of readiness added to the body.
+
+    Returns:
+        Response: Flask Response instance.
+    '''
+    try:
+        status = 200
+        body = dict(title='OK', **readiness())  # type: Dict[str, Any]
+    except HealthError as error:
+        status = 503
+        body = dict(title=str(error))
+    return flask.Response(
+        response=json.dumps(dict(status=status, **body)),
+        status=status,
+        mimetype='application/problem+json',
+    )
+
 
 def get_app():
     # type: () -> dash.Dash
@@ -59,8 +91,10 @@ def get_app():
     flask_app = flask.Flask('Shekels')
     swg.Swagger(flask_app)
     flask_app.register_blueprint(API)
+    flask_app.after_request(svt.compress_response)
 
-    # healthz endpoints
+    # healthz endpoints, with readiness served by ready
+    flask_app.add_url_rule('/healthz/ready', 'ready', ready)
     flask_app.register_blueprint(healthz, url_prefix="/healthz")
     flask_app.config.update(HEALTHZ={
         "live": liveness,
@@ -141,7 +175,7 @@ def serve_stylesheet(stylesheet):
         Input('upload', 'contents'),
         Input('save-button', 'n_clicks'),
     ],
-    [State('config-table', 'data_previous')]
+    [State('config-table', 'data_previous'), State('session', 'data')]
 )
 def on_event(*inputs):
     # type: (Tuple[Any, ...]) -> Dict[str, Any]
@@ -159,7 +193,9 @@ def on_event(*inputs):
     store = APP.event_listener.store
 
     if event == 'config-table':
-        value = dict(new=value[0], old=inputs[-1][0])
+        value = dict(new=value[0], old=inputs[-2][0])
+    elif event in ['query', 'search-button']:
+        value = dict(query=value, session=inputs[-1])
 
     if event == 'update-button' and store.get('/api/initialize') is None:
         APP.event_listener.emit('init-button', None)
@@ -173,22 +209,66 @@ def on_event(*inputs):
 )
 @APP.cache.memoize(100)
 def on_plots_update(store):
-    # type: (Dict) -> dash_table.DataTable
+    # type: (Dict) -> List[html.Div]
     '''
-    Updates plots with read information from store.
+    Updates plots tab with a placeholder per plot. Placeholders are filled in
+    by on_plot_update.
 
     Args:
         store (dict): Store data.
 
     Returns:
-        list[dcc.Graph]: Plots.
+        list[html.Div]: Plot placeholders.
     '''
     comp = svt.solve_component_state(store)
     if comp is not None:
         return comp
     config = store.get('/config', deepcopy(APP.api.config))
-    plots = config.get('plots', [])
-    return svc.get_plots(store['/api/search']['response'], plots)
+    return svc.get_plot_placeholders(
+        store['/api/search']['response'],
+        config.get('plots', []),
+        color_scheme=config.get('color_scheme', {}),
+        query=store.get('/api/search/query'),
+        version=store.get('/api/search/etag'),
+    )
+
+
+@APP.callback(
+    Output({'type': 'plot-content', 'index': MATCH}, 'children'),
+    [Input({'type': 'plot-spec', 'index': MATCH}, 'data')],
+)
+def on_plot_update(spec):
+    # type: (Optional[Dict]) -> dcc.Graph
+    '''
+    Fills in a single plot placeholder with its plot. Plots are requested in
+    placeholder order, so the topmost plots are rendered first.
+    Only the plot spec is sent by the client. Plot data is read from the
+    server-side cache by version. If it is not cached, the spec's query is
+    searched again.
+
+    Args:
+        spec (dict): Data version, query, plot and color scheme.
+
+    Returns:
+        dcc.Graph: Plot.
+    '''
+    if spec is None:
+        raise PreventUpdate
+    index = dash.callback_context.outputs_list['id']['index']
+    plan = sdt.get_plans([spec['plot']], spec['color_scheme'])[0]
+    try:
+        return svc.render_plot(index, plan, spec['version'])
+    except LookupError:
+        pass
+
+    # data was evicted, or cached by another process
+    if spec['query'] is None:
+        raise PreventUpdate
+    response, etag = svt.post_search(APP.client, spec['query'])
+    if etag is None or not isinstance(response, dict) \
+            or 'response' not in response:
+        raise PreventUpdate
+    return svc.render_plot(index, plan, etag, data=response['response'])
 
 
 @APP.callback(
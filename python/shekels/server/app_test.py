@@ -2,6 +2,7 @@ from pathlib import Path
 from tempfile import TemporaryDirectory
 import json
 import os
+import threading
 import time
 
 from flask_healthz import HealthError
@@ -38,6 +39,55 @@ def test_readiness():
         assert result.args[0] == 'App is missing API.'
     app.APP.api = api
 
+    # warm up
+    event = threading.Event()
+    app.APP.api.warm_up = threading.Thread(target=event.wait)
+    app.APP.api.warm_up.start()
+    assert app.readiness() == dict(warming=True)
+    event.set()
+    app.APP.api.warm_up.join()
+    assert app.readiness() == dict(warming=False)
+    app.APP.api.warm_up = None
+
+
+def test_ready():
+    client = app.APP.server.test_client()
+    result = client.get('/healthz/ready')
+    assert result.status_code == 200
+    assert result.json == dict(status=200, title='OK', warming=False)
+
+    # ready while warming up
+    event = threading.Event()
+    app.APP.api.warm_up = threading.Thread(target=event.wait)
+    app.APP.api.warm_up.start()
+    try:
+        result = client.get('/healthz/ready')
+        assert result.status_code == 200
+        assert result.json == dict(status=200, title='OK', warming=True)
+    finally:
+        event.set()
+        app.APP.api.warm_up.join()
+        app.APP.api.warm_up = None
+
+    api = app.APP.api
+    del app.APP.api
+    try:
+        result = client.get('/healthz/ready')
+        assert result.status_code == 503
+        assert result.json == dict(status=503, title='App is missing API.')
+    finally:
+        app.APP.api = api
+
+
+def test_compression():
+    client = app.APP.server.test_client()
+    headers = {'Accept-Encoding': 'gzip'}
+    result = client.get('/static/style.css', headers=headers)
+    assert result.headers['Content-Encoding'] == 'gzip'
+
+    result = client.get('/static/style.css')
+    assert 'Content-Encoding' not in result.headers
+
 
 @pytest.mark.skipif('SKIP_SLOW_TESTS' in os.environ, reason='slow test')
 def test_get_app(dash_duo):
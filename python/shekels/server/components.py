@@ -1,7 +1,9 @@
-from typing import Any, Dict, List, Optional  # noqa: F401
+from typing import Any, Dict, List, Optional, Tuple  # noqa: F401
 import flask  # noqa: F401
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from copy import copy
+from uuid import uuid4
 
 from lunchbox.enforce import Enforce, EnforceError
 from pandas import DataFrame, DatetimeIndex
@@ -13,18 +15,42 @@ from dash import html
 import lunchbox.tools as lbt
 import rolling_pin.blob_etl as rpb
 
+from shekels.core.cache import LRUCache
+import shekels.core.cache as sch
 import shekels.core.config as cfg
 import shekels.core.data_tools as sdt
 # ------------------------------------------------------------------------------
 
 
+FIGURE_CACHE = LRUCache(max_bytes=256 * 1024**2)
+'''
+Cache of plot figures keyed by data version and plot plan key.
+'''
+
+DATA_CACHE = LRUCache(max_bytes=256 * 1024**2)
+'''
+Cache of plot data and its stage memo keyed by data version.
+'''
+
+PLOT_DATA = None  # type: Optional[DataFrame]
+'''
+Data shared by plots rendered within a process pool worker.
+'''
+
+PLOT_MEMO = None  # type: Optional[dict]
+'''
+Stage memo shared by plots rendered within a process pool worker.
+'''
+
+
 # TODO: refactor components tests to use selnium and be less brittle
 # TODO: add JSON editor component for config
 # APP---------------------------------------------------------------------------
 def get_dash_app(server, storage_type='memory'):
     # type: (flask.Flask, str) -> dash.Dash
     '''
-    Generate Dash Flask app instance.
+    Generate Dash Flask app instance. Its layout includes a session store,
+    which holds a unique id per page load.
 
     Args:
         server (Flask): Flask instance.
@@ -68,7 +94,16 @@ def get_dash_app(server, storage_type='memory'):
         external_stylesheets=['/static/style.css'],
         assets_folder=assets,
     )
-    app.layout = html.Div(id='layout', children=[store, tabs, content])
+
+    # layout is rebuilt on each page load, so each session gets its own id
+    def get_layout():
+        # type: () -> html.Div
+        session = dcc.Store(id='session', data=uuid4().hex)
+        return html.Div(
+            id='layout', children=[store, tabs, content, session]
+        )
+
+    app.layout = get_layout
     app.config['suppress_callback_exceptions'] = True
 
     return app
@@ -350,19 +385,289 @@ def get_datatable(data, color_scheme=cfg.COLOR_SCHEME, editable=False):
     )
 
 
-def get_plots(data, plots):
-    # type: (List[dict], List[dict]) -> List[dcc.Graph]
+def render_figure(plan, data=None, memo=None):
+    # type: (sdt.PlotPlan, Optional[DataFrame], Optional[dict]) -> Optional[Dict]
+    '''
+    Renders the figure of a given plot plan.
+
+    Args:
+        plan (PlotPlan): Plot plan.
+        data (DataFrame, optional): Data to be plotted. Default: None.
+            If None, data given to set_plot_data is used.
+        memo (dict, optional): Stage memo. Default: None.
+            If None, memo given to set_plot_data is used.
+
+    Returns:
+        dict: Plotly figure dictionary or None if plot could not be rendered.
+    '''
+    if data is None:
+        data = PLOT_DATA
+    if memo is None:
+        memo = PLOT_MEMO
+    try:
+        return sdt.execute_plan(data, plan, memo=memo)
+    except (DataError, EnforceError):
+        return None
+
+
+def set_plot_data(data, memo=None):
+    # type: (Optional[DataFrame], Optional[dict]) -> None
+    '''
+    Sets data shared by all plots rendered within a process pool worker.
+
+    Args:
+        data (DataFrame): Data to be plotted.
+        memo (dict, optional): Stage memo. Default: None.
+    '''
+    global PLOT_DATA, PLOT_MEMO
+    PLOT_DATA = data
+    PLOT_MEMO = memo
+
+
+def get_plot_data(data, version=None):
+    # type: (List[dict], Optional[str]) -> Tuple[DataFrame, dict]
+    '''
+    Converts given records into a DataFrame for plotting.
+    DataFrames are cached in DATA_CACHE by data version, together with a stage
+    memo shared by all plots of that version.
+
+    Args:
+        data (list[dict]): List of dicts defining data.
+        version (str, optional): Hash of data. Default: None.
+            If None, version is computed from data.
+
+    Returns:
+        tuple[DataFrame, dict]: Plot data and stage memo.
+    '''
+    if version is None:
+        version = sch.get_hash(data)
+    output = DATA_CACHE.get(version)
+    if output is None:
+        frame = DataFrame(data)
+        if 'date' in frame.columns:
+            frame.date = DatetimeIndex(frame.date)
+        output = (frame, {})
+        DATA_CACHE.set(version, output)
+    return output
+
+
+def resize_plot_data(version, output):
+    # type: (str, Tuple[DataFrame, dict]) -> None
+    '''
+    Recomputes size of plot data cached under given version, so that stage
+    frames added to its memo count towards the byte limit of DATA_CACHE.
+    The memo is measured from a copy, as other threads may be adding stages
+    to it.
+
+    Args:
+        version (str): Hash of data.
+        output (tuple[DataFrame, dict]): Plot data and stage memo.
+    '''
+    if version in DATA_CACHE:
+        frame, memo = output
+        size = sch.get_size((frame, memo.copy()))
+        DATA_CACHE.set(version, output, size=size)
+
+
+def get_plot_element(index, plan, figure):
+    # type: (int, sdt.PlotPlan, Optional[Dict]) -> Any
+    '''
+    Gets a Dash plot element from a given figure.
+
+    Args:
+        index (int): Plot index.
+        plan (PlotPlan): Plot plan.
+        figure (dict): Plotly figure or None if plot could not be rendered.
+
+    Returns:
+        dcc.Graph: Plot or error Div if figure is None.
+    '''
+    min_width = str(plan.min_width) + '%'
+    if figure is not None:
+        return dcc.Graph(
+            id=f'plot-{index:02d}',
+            className='plot',
+            figure=figure,
+            style={'min-width': min_width},
+        )
+    return html.Div(
+        id=f'plot-{index:02d}',
+        className='plot plot-error',
+        style={'min-width': min_width},
+        children=html.Div(
+            className='plot-error-container',
+            children=html.Div(
+                className='plot-error-message',
+                children='no data found'
+            )
+        )
+    )
+
+
+def get_plot_placeholders(
+    data, plots, color_scheme={}, query=None, version=None
+):
+    # type: (List[dict], List[dict], Dict[str, str], Optional[str], Optional[str]) -> List[html.Div]
+    '''
+    Gets placeholders for given plots, which are each filled in by their own
+    pattern-matching callback with render_plot. Each placeholder holds a
+    store, which triggers its callback. The store holds a plot spec of the
+    data version, query, plot and color scheme, but not the data itself,
+    which is cached server-side in DATA_CACHE by version.
+
+    Args:
+        data (list[dict]): List of dicts defining data.
+        plots (list[dict]): List of dicts defining plots.
+        color_scheme (dict[str, str], optional): Color scheme of app. Each
+            plot's own color scheme is applied on top of it. Default: {}.
+        query (str, optional): Query which produced data. Default: None.
+        version (str, optional): Version of data, such as the ETag of its
+            search response. Default: None.
+            If None, version is computed from data.
+
+    Raises:
+        EnforceError: If plots is not a list of dicts.
+        DataError: If any plot is invalid.
+
+    Returns:
+        list[html.Div]: Plot placeholders.
+    '''
+    plans = sdt.get_plans(plots, color_scheme)
+    if version is None:
+        version = sch.get_hash(data)
+    get_plot_data(data, version)
+    output = []
+    for i, plan in enumerate(plans):
+        elem = html.Div(
+            id={'type': 'plot-placeholder', 'index': i},
+            className='plot-placeholder',
+            style={'min-width': str(plan.min_width) + '%'},
+            children=[
+                dcc.Store(
+                    id={'type': 'plot-spec', 'index': i},
+                    data=dict(
+                        version=version,
+                        query=query,
+                        plot=plots[i],
+                        color_scheme=color_scheme,
+                    ),
+                ),
+                dcc.Loading(
+                    type='circle',
+                    children=html.Div(
+                        id={'type': 'plot-content', 'index': i},
+                        className='plot-content',
+                    ),
+                ),
+            ]
+        )
+        output.append(elem)
+    return output
+
+
+def get_plot(data, plots, index, color_scheme={}, version=None):
+    # type: (List[dict], List[dict], int, Dict[str, str], Optional[str]) -> Any
+    '''
+    Gets a single Dash plot of given plots.
+    Figures, plans and data are cached as in get_plots.
+
+    Args:
+        data (list[dict]): List of dicts defining data.
+        plots (list[dict]): List of dicts defining plots.
+        index (int): Index of plot in plots.
+        color_scheme (dict[str, str], optional): Color scheme of app. Each
+            plot's own color scheme is applied on top of it. Default: {}.
+        version (str, optional): Hash of data. Default: None.
+            If None, version is computed from data.
+
+    Raises:
+        EnforceError: If plots is not a list of dicts.
+        EnforceError: If index is out of range.
+        DataError: If any plot is invalid.
+
+    Returns:
+        dcc.Graph: Plot.
+    '''
+    plans = sdt.get_plans(plots, color_scheme)
+    msg = 'Plot index must be less than {b}. {a} >= {b}.'
+    Enforce(index, '<', len(plans), message=msg)
+    # --------------------------------------------------------------------------
+
+    if version is None:
+        version = sch.get_hash(data)
+    return render_plot(index, plans[index], version, data=data)
+
+
+def render_plot(index, plan, version, data=None):
+    # type: (int, sdt.PlotPlan, str, Optional[List[dict]]) -> Any
+    '''
+    Gets a single Dash plot of given plan and data version.
+    Figures are cached in FIGURE_CACHE and data in DATA_CACHE, both by data
+    version.
+
+    Args:
+        index (int): Plot index.
+        plan (PlotPlan): Plot plan.
+        version (str): Hash of data.
+        data (list[dict], optional): List of dicts defining data. Only
+            required if neither figure nor data of version are cached.
+            Default: None.
+
+    Raises:
+        LookupError: If data is None and data of version is not cached.
+
+    Returns:
+        dcc.Graph: Plot.
+    '''
+    key = (version, plan.key)
+    figure = FIGURE_CACHE.get(key, False)
+    if figure is False:
+        output = DATA_CACHE.get(version)
+        if output is None:
+            if data is None:
+                msg = f'Plot data of version {version} is not cached.'
+                raise LookupError(msg)
+            output = get_plot_data(data, version)
+        frame, memo = output
+        figure = render_figure(plan, frame, memo)
+        FIGURE_CACHE.set(key, figure)
+        resize_plot_data(version, output)
+    return get_plot_element(index, plan, figure)
+
+
+def get_plots(
+    data, plots, color_scheme={}, executor='thread', workers=4, version=None
+):
+    # type: (List[dict], List[dict], Dict[str, str], str, int, Optional[str]) -> List[dcc.Graph]
     '''
     Gets a Dash plots using given dicts.
     Assumes dict element has all columns of table as keys.
+    Plots are compiled into plans with data_tools.get_plans.
+    Figures are cached in FIGURE_CACHE, keyed by the data version and the
+    plan key. Plots that fail to render are cached as None.
+    The filter, group and pivot stages of uncached plots are computed first,
+    with stages shared between plots computed only once. Figures are then
+    rendered concurrently with given executor from the shared stage outputs.
 
     Args:
         data (list[dict]): List of dicts defining data.
         plots (list[dict]): List of dicts defining plots.
+        color_scheme (dict[str, str], optional): Color scheme of app. Each
+            plot's own color scheme is applied on top of it. Default: {}.
+        executor (str, optional): Pool used for rendering plots, thread or
+            process. Default: thread.
+        workers (int, optional): Number of pool workers. If 1, plots are
+            rendered in the calling thread. Default: 4.
+        version (str, optional): Version of data, such as the ETag of its
+            search response. Default: None.
+            If None, version is computed from data.
 
     Raises:
         EnforceError: If data is not a list of dicts.
         EnforceError: If plots is not a list of dicts.
+        EnforceError: If executor is not thread or process.
+        EnforceError: If workers is less than 1.
+        DataError: If any plot is invalid.
 
     Returns:
         list[dcc.Graph]: Plots.
@@ -372,49 +677,55 @@ def get_plots(data, plots):
     for item in data:
         Enforce(item, 'instance of', dict, message=msg)
 
-    msg = 'Plots must be a list of dictionaries. Given value: {a}.'
-    Enforce(plots, 'instance of', list, message=msg)
-    for item in plots:
-        Enforce(item, 'instance of', dict, message=msg)
-# --------------------------------------------------------------------------
+    msg = 'Illegal executor. {a} not in [thread, process].'
+    Enforce(executor, 'in', ['thread', 'process'], message=msg)
+    msg = 'Workers must be greater or equal to {b}. {a} < {b}.'
+    Enforce(workers, '>=', 1, message=msg)
+    # --------------------------------------------------------------------------
 
-    data_ = DataFrame(data)
-    if 'date' in data_.columns:
-        data_.date = DatetimeIndex(data_.date)
+    plans = sdt.get_plans(plots, color_scheme)
+    if version is None:
+        version = sch.get_hash(data)
 
-    elems = []
-    for i, x in enumerate(plots):
-        plot = cfg.PlotItem(x)
-        plot.validate()
-        plot = plot.to_primitive()
-        min_width = str(plot['min_width']) + '%'
+    # fetch cached figures
+    keys = [(version, x.key) for x in plans]
+    figures = [FIGURE_CACHE.get(x, False) for x in keys]
 
+    # render uncached figures
+    misses = [i for i, x in enumerate(figures) if x is False]
+    todo = [plans[i] for i in misses]
+    output = get_plot_data(data, version)
+    data_, memo = output
+
+    # compute each distinct stage once, so that the pool only reads the memo
+    for plan in todo:
         try:
-            fig = sdt.get_figure(
-                data_,
-                filters=plot['filters'],
-                group=plot['group'],
-                pivot=plot['pivot'],
-                **plot['figure'],
-            )
-            fig = dcc.Graph(
-                id=f'plot-{i:02d}',
-                className='plot',
-                figure=fig,
-                style={'min-width': min_width},
-            )
-        except (DataError, EnforceError):
-            fig = html.Div(
-                id=f'plot-{i:02d}',
-                className='plot plot-error',
-                style={'min-width': min_width},
-                children=html.Div(
-                    className='plot-error-container',
-                    children=html.Div(
-                        className='plot-error-message',
-                        children='no data found'
-                    )
-                )
-            )
-        elems.append(fig)
-    return elems
+            sdt.execute_stages(data_, plan.stages, memo=memo)
+        except EnforceError:
+            pass
+
+    workers = min(workers, len(todo))
+    if workers <= 1:
+        results = [render_figure(x, data_, memo) for x in todo]
+    elif executor == 'process':
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=set_plot_data,
+            initargs=(data_, memo),
+        ) as pool:
+            results = list(pool.map(render_figure, todo))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(
+                lambda x: render_figure(x, data_, memo), todo
+            ))
+
+    for i, fig in zip(misses, results):
+        FIGURE_CACHE.set(keys[i], fig)
+        figures[i] = fig
+    resize_plot_data(version, output)
+
+    return [
+        get_plot_element(i, plan, fig)
+        for i, (plan, fig) in enumerate(zip(plans, figures))
+    ]
@@ -1,6 +1,10 @@
+from copy import deepcopy
+from threading import Thread
 import unittest
+import unittest.mock as mock
 
 from lunchbox.enforce import EnforceError
+from pandas import DataFrame
 import flask
 
 import shekels.server.components as svc
@@ -10,9 +14,14 @@ import shekels.server.components as svc
 class ComponentsTests(unittest.TestCase):
     def test_get_dash_app(self):
         result = svc.get_dash_app(flask.Flask('foo'))._layout
+        session = result().children[3].data
+        result = result()
         self.assertEqual(result.children[0].id, 'store')
         self.assertEqual(result.children[1].id, 'tabs-container')
         self.assertEqual(result.children[2].id, 'content')
+        self.assertEqual(result.children[3].id, 'session')
+        self.assertRegex(result.children[3].data, '^[0-9a-f]{32}$')
+        self.assertNotEqual(result.children[3].data, session)
 
     def test_get_button(self):
         expected = '10 is not a string.'
@@ -110,6 +119,16 @@ class ComponentsTests(unittest.TestCase):
         with self.assertRaisesRegex(EnforceError, expected):
             svc.get_plots([], ['foo'])
 
+        # executor
+        expected = r'Illegal executor. foo not in \[thread, process\].'
+        with self.assertRaisesRegex(EnforceError, expected):
+            svc.get_plots([], [], executor='foo')
+
+        # workers
+        expected = 'Workers must be greater or equal to 1. 0 < 1.'
+        with self.assertRaisesRegex(EnforceError, expected):
+            svc.get_plots([], [], workers=0)
+
     def test_get_plots(self):
         data = [
             {'date': '2020-04-05T12:00:00', 'name': 'foo', 'amount': 1},
@@ -132,6 +151,316 @@ class ComponentsTests(unittest.TestCase):
         result = svc.get_plots(data, [plot, plot])
         self.assertEqual(len(result), 2)
 
+    def test_get_plots_cache(self):
+        data = [
+            {'date': '2020-04-05T12:00:00', 'name': 'foo', 'amount': 1},
+            {'date': '2020-04-05T12:00:01', 'name': 'bar', 'amount': 2},
+        ]
+        plot = {
+            "pivot": {
+                "columns": ["name"],
+                "values": ["amount"],
+                "index": "date",
+            },
+            "figure": {"kind": "bar", "title": "cache"},
+        }
+        svc.FIGURE_CACHE.clear()
+        hits = svc.FIGURE_CACHE.hits
+        misses = svc.FIGURE_CACHE.misses
+
+        expected = svc.get_plots(data, [plot])[0].figure
+        self.assertEqual(svc.FIGURE_CACHE.misses, misses + 1)
+
+        result = svc.get_plots(data, [plot])[0].figure
+        self.assertEqual(svc.FIGURE_CACHE.hits, hits + 1)
+        self.assertIs(result, expected)
+
+        # new data version
+        data[0]['amount'] = 10
+        svc.get_plots(data, [plot])
+        self.assertEqual(svc.FIGURE_CACHE.misses, misses + 2)
+
+        # new color scheme
+        plot['figure']['color_scheme'] = {'grey1': '#000000'}
+        svc.get_plots(data, [plot])
+        self.assertEqual(svc.FIGURE_CACHE.misses, misses + 3)
+        self.assertEqual(len(svc.FIGURE_CACHE), 3)
+
+    def test_get_plots_executor(self):
+        data = [
+            {'date': '2020-04-05T12:00:00', 'name': 'foo', 'amount': 1},
+            {'date': '2020-04-05T12:00:01', 'name': 'bar', 'amount': 2},
+        ]
+        plots = []
+        for title in ['a', 'b', 'c']:
+            plots.append({
+                "pivot": {
+                    "columns": ["name"],
+                    "values": ["amount"],
+                    "index": "date",
+                },
+                "figure": {"kind": "bar", "title": title},
+            })
+        bad = {
+            "pivot": {
+                "columns": ["not_a_column"],
+                "values": ["amount"],
+                "index": "date",
+            },
+            "figure": {"kind": "bar"},
+        }
+        plots.insert(1, bad)
+
+        for executor, workers in [('thread', 1), ('thread', 4), ('process', 2)]:
+            svc.FIGURE_CACHE.clear()
+            result = svc.get_plots(
+                data, plots, executor=executor, workers=workers
+            )
+            ids = [x.id for x in result]
+            self.assertEqual(ids, ['plot-00', 'plot-01', 'plot-02', 'plot-03'])
+
+            titles = [result[i].figure['layout']['title']['text'] for i in [0, 2, 3]]
+            self.assertEqual(titles, ['a', 'b', 'c'])
+
+            result = result[1].children.children.children
+            self.assertEqual(result, 'no data found')
+
+    def test_get_plots_shared_stages(self):
+        data = [
+            {'date': '2020-04-05T12:00:00', 'name': 'foo', 'amount': 1},
+            {'date': '2020-04-05T12:00:01', 'name': 'bar', 'amount': 2},
+        ]
+        plots = []
+        for kind in ['bar', 'line', 'area']:
+            plots.append({
+                "filters": [
+                    {"column": "amount", "comparator": ">", "value": 0}
+                ],
+                "pivot": {
+                    "columns": ["name"],
+                    "values": ["amount"],
+                    "index": "date",
+                },
+                "figure": {"kind": kind},
+            })
+        svc.FIGURE_CACHE.clear()
+        with mock.patch.object(
+            svc.sdt, 'pivot_data', wraps=svc.sdt.pivot_data
+        ) as pivot:
+            result = svc.get_plots(data, plots)
+            self.assertEqual(pivot.call_count, 1)
+
+        kinds = [x.figure['data'][0]['type'] for x in result]
+        self.assertEqual(kinds, ['bar', 'scatter', 'scatter'])
+
+    def test_render_figure(self):
+        data = svc.DataFrame([{'name': 'foo', 'amount': 1}])
+        plot = {
+            "figure": {"kind": "bar", "x_axis": "name", "y_axis": "amount"},
+        }
+        plan = svc.sdt.compile_plot(plot)
+        result = svc.render_figure(plan, data)
+        self.assertEqual(result['data'][0]['type'], 'bar')
+
+        svc.set_plot_data(data)
+        self.assertEqual(svc.render_figure(plan), result)
+        svc.set_plot_data(None)
+
+        plot['figure']['x_axis'] = 'not_a_column'
+        plan = svc.sdt.compile_plot(plot)
+        self.assertIsNone(svc.render_figure(plan, data))
+
+    def test_get_plot_data(self):
+        data = [
+            {'date': '2020-04-05T12:00:00', 'name': 'foo', 'amount': 1},
+            {'date': '2020-04-05T12:00:01', 'name': 'bar', 'amount': 2},
+        ]
+        svc.DATA_CACHE.clear()
+        frame, memo = svc.get_plot_data(data)
+        self.assertEqual(frame.date.dtype.kind, 'M')
+        self.assertEqual(memo, {})
+
+        result = svc.get_plot_data(data)
+        self.assertIs(result[0], frame)
+        self.assertIs(result[1], memo)
+
+        result = svc.get_plot_data(data, version='foo')[0]
+        self.assertIsNot(result, frame)
+
+    def test_get_plot_placeholders(self):
+        data = [{'name': 'foo', 'amount': 1}]
+        plots = [{"min_width": 50}, {}]
+        result = svc.get_plot_placeholders(data, plots)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0].id, {'type': 'plot-placeholder', 'index': 0})
+        self.assertEqual(result[0].style, {'min-width': '50.0%'})
+        self.assertEqual(result[1].style, {'min-width': '25.0%'})
+
+        store, loading = result[1].children
+        self.assertEqual(store.id, {'type': 'plot-spec', 'index': 1})
+        expected = dict(
+            version=svc.sch.get_hash(data),
+            query=None,
+            plot={},
+            color_scheme={},
+        )
+        self.assertEqual(store.data, expected)
+
+        # data is cached server-side
+        result = svc.get_plot_placeholders(data, plots, query='foo')
+        store = result[0].children[0]
+        self.assertEqual(store.data['query'], 'foo')
+        self.assertIn(store.data['version'], svc.DATA_CACHE)
+        expected = {'type': 'plot-content', 'index': 1}
+        self.assertEqual(loading.children.id, expected)
+
+        # data is keyed by given version, without hashing it
+        with mock.patch.object(svc.sch, 'get_hash', wraps=svc.sch.get_hash) as get_hash:
+            result = svc.get_plot_placeholders(
+                data, plots, query='foo', version='1-abc'
+            )
+            for call in get_hash.call_args_list:
+                self.assertIsNot(call.args[0], data)
+        self.assertEqual(result[0].children[0].data['version'], '1-abc')
+        self.assertEqual(svc.DATA_CACHE.get('1-abc')[0].name.tolist(), ['foo'])
+
+    def test_get_plot(self):
+        data = [
+            {'date': '2020-04-05T12:00:00', 'name': 'foo', 'amount': 1},
+            {'date': '2020-04-05T12:00:01', 'name': 'bar', 'amount': 2},
+        ]
+        good = {
+            "pivot": {
+                "columns": ["name"],
+                "values": ["amount"],
+                "index": "date",
+            },
+            "figure": {"kind": "bar", "title": "single"},
+        }
+        bad = deepcopy(good)
+        bad['pivot']['columns'] = ['not_a_column']
+        plots = [good, bad]
+
+        expected = 'Plot index must be less than 2. 2 >= 2.'
+        with self.assertRaisesRegex(EnforceError, expected):
+            svc.get_plot(data, plots, 2)
+
+        svc.FIGURE_CACHE.clear()
+        result = svc.get_plot(data, plots, 0)
+        self.assertEqual(result.id, 'plot-00')
+        self.assertEqual(result.figure['layout']['title']['text'], 'single')
+
+        # cached
+        misses = svc.FIGURE_CACHE.misses
+        expected = svc.get_plot(data, plots, 0, version=svc.sch.get_hash(data))
+        self.assertIs(expected.figure, result.figure)
+        self.assertEqual(svc.FIGURE_CACHE.misses, misses)
+
+        # same as get_plots
+        expected = svc.get_plots(data, plots)[0].figure
+        self.assertIs(expected, result.figure)
+
+        result = svc.get_plot(data, plots, 1)
+        self.assertEqual(result.id, 'plot-01')
+        result = result.children.children.children
+        self.assertEqual(result, 'no data found')
+
+    def test_render_plot(self):
+        data = [
+            {'date': '2020-04-05T12:00:00', 'name': 'foo', 'amount': 1},
+            {'date': '2020-04-05T12:00:01', 'name': 'bar', 'amount': 2},
+        ]
+        plot = {
+            "pivot": {
+                "columns": ["name"],
+                "values": ["amount"],
+                "index": "date",
+            },
+            "figure": {"kind": "bar", "title": "single"},
+        }
+        plan = svc.sdt.get_plans([plot])[0]
+        svc.FIGURE_CACHE.clear()
+        svc.DATA_CACHE.clear()
+
+        expected = 'Plot data of version foo is not cached.'
+        with self.assertRaisesRegex(LookupError, expected):
+            svc.render_plot(3, plan, 'foo')
+
+        result = svc.render_plot(3, plan, 'foo', data=data)
+        self.assertEqual(result.id, 'plot-03')
+        self.assertEqual(result.figure['layout']['title']['text'], 'single')
+
+        # rendered from cached data
+        svc.FIGURE_CACHE.clear()
+        result = svc.render_plot(3, plan, 'foo')
+        self.assertEqual(result.figure['layout']['title']['text'], 'single')
+
+    def test_resize_plot_data(self):
+        data = [
+            {'date': '2020-04-05T12:00:00', 'name': 'foo', 'amount': 1},
+            {'date': '2020-04-05T12:00:01', 'name': 'bar', 'amount': 2},
+        ]
+        plot = {
+            "pivot": {
+                "columns": ["name"],
+                "values": ["amount"],
+                "index": "date",
+            },
+        }
+        svc.FIGURE_CACHE.clear()
+        svc.DATA_CACHE.clear()
+        frame, memo = svc.get_plot_data(data, 'foo')
+        size = svc.DATA_CACHE.size
+        self.assertEqual(size, svc.sch.get_size((frame, memo)))
+
+        svc.get_plot(data, [plot], 0, version='foo')
+        self.assertGreater(len(memo), 0)
+        self.assertGreater(svc.DATA_CACHE.size, size)
+        self.assertEqual(
+            svc.DATA_CACHE.size, svc.sch.get_size((frame, memo))
+        )
+
+        # evicted data is not re-cached
+        svc.DATA_CACHE.clear()
+        svc.resize_plot_data('foo', (frame, memo))
+        self.assertNotIn('foo', svc.DATA_CACHE)
+
+    def test_resize_plot_data_threads(self):
+        data = [
+            {'date': '2020-04-05T12:00:00', 'name': 'foo', 'amount': 1},
+            {'date': '2020-04-05T12:00:01', 'name': 'bar', 'amount': 2},
+        ]
+        plots = [
+            {"pivot": {"columns": ["name"], "values": ["amount"], "index": "date"}},
+            {"pivot": {"columns": ["date"], "values": ["amount"], "index": "name"}},
+        ]
+        plans = svc.sdt.get_plans(plots)
+        svc.FIGURE_CACHE.clear()
+        svc.DATA_CACHE.clear()
+        output = svc.get_plot_data(data, 'foo')
+        svc.render_plot(0, plans[0], 'foo')
+
+        # another plot adds its stages to the memo while it is measured
+        get_size = svc.sch.get_size
+        threads = []
+
+        def side_effect(item):
+            stage = isinstance(item, DataFrame) and item is not output[0]
+            if stage and threads == []:
+                thread = Thread(
+                    target=svc.render_plot, args=(1, plans[1], 'foo')
+                )
+                threads.append(thread)
+                thread.start()
+                thread.join()
+            return get_size(item)
+
+        size = len(output[1])
+        with mock.patch.object(svc.sch, 'get_size', side_effect=side_effect):
+            svc.resize_plot_data('foo', output)
+        self.assertEqual(len(threads), 1)
+        self.assertGreater(len(output[1]), size)
+
     def test_get_plots_no_data(self):
         data = [
             {'date': '2020-04-05T12:00:00', 'name': 'foo', 'amount': 1},
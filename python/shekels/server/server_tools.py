@@ -1,12 +1,20 @@
-from typing import Any, Dict, Optional  # noqa: F401
+from typing import Any, Dict, Iterator, List, Optional, Tuple  # noqa: F401
+from threading import Event  # noqa: F401
+from werkzeug.datastructures import MIMEAccept  # noqa: F401
 import dash  # noqa: F401
+import pandas as pd  # noqa: F401
 
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+from importlib.util import find_spec
 from pprint import pformat
 import base64
+import gzip
 import json
+import os
 import re
 import traceback
+import zlib
 
 from dash.exceptions import PreventUpdate
 from schematics.exceptions import DataError
@@ -14,10 +22,13 @@ import flask
 import jinja2
 import jsoncomment as jsonc
 import lunchbox.tools as lbt
-import rolling_pin.blob_etl as rpb
 
+from shekels.core.cache import LRUCache
+from shekels.core.database import Database  # noqa: F401
+import shekels.core.cache as sch
 import shekels.core.config as cfg
 import shekels.core.data_tools as sdt
+import shekels.core.planner as spl
 import shekels.server.components as svc
 # ------------------------------------------------------------------------------
 
@@ -25,13 +36,14 @@ import shekels.server.components as svc
 TEMPLATE_DIR = lbt.relative_path(__file__, '../../../templates').as_posix()
 
 
-def error_to_dict(error):
-    # type: (Exception) -> Dict[str, Any]
+def error_to_dict(error, code=500):
+    # type: (Exception, int) -> Dict[str, Any]
     '''
     Convenience function for formatting a given exception as a dictionary.
 
     Args:
         error (Exception): Error to be formatted.
+        code (int, optional): HTTP status code. Default: 500.
 
     Returns:
         Dict[str, Any]: Error dictionary.
@@ -51,26 +63,27 @@ def error_to_dict(error):
         error=error.__class__.__name__,
         args=list(map(str, error.args)),
         message=msg,
-        code=500,
+        code=code,
         traceback=traceback.format_exc(),
     )
 
 
-def error_to_response(error):
-    # type: (Exception) -> flask.Response
+def error_to_response(error, code=500):
+    # type: (Exception, int) -> flask.Response
     '''
     Convenience function for formatting a given exception as a Flask Response.
 
     Args:
         error (Exception): Error to be formatted.
+        code (int, optional): HTTP status code. Default: 500.
 
     Returns:
         flask.Response: Flask response.
     '''
     return flask.Response(
-        response=json.dumps(error_to_dict(error)),
+        response=json.dumps(error_to_dict(error, code=code)),
         mimetype='application/json',
-        status=500,
+        status=code,
     )
 
 
@@ -125,6 +138,594 @@ def parse_json_file_content(raw_content):
     return jsonc.JsonComment().loads(output)
 
 
+def encode_cursor(params):
+    # type: (Dict[str, Any]) -> str
+    '''
+    Encodes given page parameters as an opaque cursor.
+
+    Args:
+        params (dict): Page parameters.
+
+    Returns:
+        str: URL safe base64 encoded cursor.
+    '''
+    output = json.dumps(params, sort_keys=True).encode('utf-8')
+    return base64.urlsafe_b64encode(output).decode('utf-8')
+
+
+def decode_cursor(cursor, version):
+    # type: (str, int) -> Dict[str, Any]
+    '''
+    Decodes given cursor into page parameters.
+
+    Args:
+        cursor (str): Cursor created by encode_cursor.
+        version (int): Current database version.
+
+    Raises:
+        RuntimeError: If cursor is invalid.
+        RuntimeError: If cursor was issued for a different database version.
+
+    Returns:
+        dict: Page parameters.
+    '''
+    try:
+        output = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        cursor_version = output.pop('version')
+    except Exception:
+        raise RuntimeError(f'Invalid cursor: {cursor}.')
+
+    if cursor_version != version:
+        msg = 'Cursor is stale. Database has been updated since it was issued.'
+        raise RuntimeError(msg)
+    return output
+
+
+def get_page_params(params, version):
+    # type: (Dict[str, Any], int) -> Dict[str, Any]
+    '''
+    Parses page parameters from given request parameters.
+
+    Supported parameters:
+
+        * query - SQL query
+        * limit - maximum number of rows
+        * offset - number of rows to skip
+        * order_by - column or list of columns, prefixed with "-" for
+          descending order. Strings may be comma separated.
+        * cursor - cursor returned by previous request, which overrides all
+          other parameters
+
+    Args:
+        params (dict): Request parameters.
+        version (int): Current database version.
+
+    Raises:
+        RuntimeError: If limit or offset is not a non-negative integer.
+        RuntimeError: If order_by is not a string or list of strings.
+
+    Returns:
+        dict: Page parameters with query, limit, offset and order_by keys.
+    '''
+    if params.get('cursor') is not None:
+        return decode_cursor(params['cursor'], version)
+
+    output = dict(
+        query=params.get('query'), limit=None, offset=0, order_by=[]
+    )  # type: Dict[str, Any]
+    for key in ['limit', 'offset']:
+        value = params.get(key)
+        if value is None:
+            continue
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = -1
+        if value < 0:
+            msg = f'{key.capitalize()} must be a non-negative integer. '
+            msg += f'Given value: {params[key]}.'
+            raise RuntimeError(msg)
+        output[key] = value
+
+    order_by = params.get('order_by') or []
+    if isinstance(order_by, str):
+        order_by = [x.strip() for x in order_by.split(',') if x.strip() != '']
+    if not isinstance(order_by, list) \
+            or not all(isinstance(x, str) for x in order_by):
+        msg = 'Order by must be a column or list of columns. '
+        msg += f'Given value: {order_by}.'
+        raise RuntimeError(msg)
+    output['order_by'] = order_by
+    return output
+
+
+def get_page_response(database, params, cancel=None, format_='json'):
+    # type: (Database, Dict[str, Any], Optional[Event], str) -> Dict[str, Any]
+    '''
+    Gets a page of given database according to given page parameters.
+    The response of FRAME_FORMATS is the page as a DataFrame, which is
+    serialized directly. Otherwise, it is a list of records.
+
+    Args:
+        database (Database): Updated database.
+        params (dict): Page parameters, as returned by get_page_params.
+        cancel (Event, optional): Event which cancels query when set.
+            Default: None.
+        format_ (str, optional): Response format. Default: json.
+
+    Returns:
+        dict: Response with response, total and next_cursor keys.
+            next_cursor is None if there are no more rows.
+    '''
+    page = database.page_frame(**params, cancel=cancel)
+    cursor = None
+    limit = params['limit']
+    if limit is not None and params['offset'] + limit < page['total']:
+        temp = deepcopy(params)
+        temp['offset'] += limit
+        temp['version'] = database.version
+        cursor = encode_cursor(temp)
+
+    response = page['frame']
+    if format_ not in FRAME_FORMATS:
+        response = sdt.to_records(response)
+    return dict(response=response, total=page['total'], next_cursor=cursor)
+
+
+RESPONSE_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'columnar': 'application/vnd.shekels.columnar+json',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+'''
+Response formats of /api/read and /api/search and their mimetypes.
+'''
+
+
+FRAME_FORMATS = ['columnar', 'ndjson', 'arrow', 'parquet']
+'''
+Response formats which are serialized directly from a page DataFrame.
+'''
+
+
+def get_response_format(params, accept=None):
+    # type: (Dict[str, Any], Optional[MIMEAccept]) -> str
+    '''
+    Gets response format from given request parameters. If no format
+    parameter is given, the format is negotiated from given Accept header.
+
+    Args:
+        params (dict): Request parameters.
+        accept (MIMEAccept, optional): Request Accept header. Default: None.
+
+    Raises:
+        RuntimeError: If format is not one of RESPONSE_FORMATS.
+
+    Returns:
+        str: Response format. Default: json.
+    '''
+    output = params.get('format')
+    if output is None and accept is not None:
+        lut = {v: k for k, v in RESPONSE_FORMATS.items()}
+        output = lut.get(accept.best_match(list(lut.keys())) or '')
+
+    output = output or 'json'
+    if output not in RESPONSE_FORMATS:
+        msg = f'Invalid response format: {output}. '
+        msg += f'Legal formats: {list(RESPONSE_FORMATS.keys())}.'
+        raise RuntimeError(msg)
+    return output
+
+
+def to_ndjson(data, batch_size=1000):
+    # type: (pd.DataFrame, int) -> Iterator[str]
+    '''
+    Serializes given DataFrame as newline delimited JSON records, in batches.
+    Each batch is converted to records only when it is yielded.
+
+    Args:
+        data (DataFrame): Data.
+        batch_size (int, optional): Number of records per batch. Default: 1000.
+
+    Yields:
+        str: Batch of JSON lines.
+    '''
+    for i in range(0, len(data), batch_size):
+        records = sdt.to_records(data.iloc[i:i + batch_size])
+        yield ''.join(json.dumps(x) + '\n' for x in records)
+
+
+def to_columnar(data):
+    # type: (pd.DataFrame) -> Dict[str, list]
+    '''
+    Converts given DataFrame into a dict of columns, whose values are those
+    of data_tools.to_records. Each column is converted as a whole.
+
+    Args:
+        data (DataFrame): Data.
+
+    Returns:
+        dict: Map of column name to list of values.
+    '''
+    if len(data) == 0:
+        return {}
+
+    data = sdt.serialize_dates(data)
+    output = {}
+    for name, column in data.items():
+        column = column.astype(object)
+        output[name] = column.where(column.notnull(), None).tolist()
+    return output
+
+
+def to_arrow(data, format_='arrow'):
+    # type: (pd.DataFrame, str) -> bytes
+    '''
+    Serializes given DataFrame as an Arrow IPC stream or Parquet file.
+    Requires pyarrow, which is installed with the arrow extra.
+
+    Args:
+        data (DataFrame): Data.
+        format_ (str, optional): Format. Options: arrow, parquet.
+            Default: arrow.
+
+    Raises:
+        RuntimeError: If pyarrow is not installed.
+
+    Returns:
+        bytes: Serialized data.
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        msg = f'The {format_} format requires pyarrow. '
+        msg += 'Please install shekels[arrow].'
+        raise RuntimeError(msg)
+
+    table = pa.Table.from_pandas(data, preserve_index=False)
+
+    sink = pa.BufferOutputStream()
+    if format_ == 'parquet':
+        pq.write_table(table, sink)
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def page_to_response(page, format_='json'):
+    # type: (Dict[str, Any], str) -> flask.Response
+    '''
+    Converts given page response into a Flask response of given format.
+
+    Formats:
+
+        * json - JSON object with response, total and next_cursor keys, where
+          response is a list of records
+        * columnar - JSON object like json, where response is a dict of
+          columns, converted from a page DataFrame
+        * ndjson - streamed newline delimited JSON, one record per line,
+          serialized from a page DataFrame
+        * arrow - Arrow IPC stream
+        * parquet - Parquet file
+
+    The ndjson, arrow and parquet formats send total and next_cursor as
+    X-Total-Count and X-Next-Cursor headers.
+
+    Args:
+        page (dict): Page response, as returned by get_page_response.
+        format_ (str, optional): Response format. Default: json.
+
+    Raises:
+        RuntimeError: If format requires pyarrow, which is not installed.
+
+    Returns:
+        flask.Response: Flask response.
+    '''
+    mimetype = RESPONSE_FORMATS[format_]
+    if format_ in ['json', 'columnar']:
+        if format_ == 'columnar':
+            page = dict(page, response=to_columnar(page['response']))
+        return flask.Response(response=json.dumps(page), mimetype=mimetype)
+
+    headers = {'X-Total-Count': str(page['total'])}
+    if page['next_cursor'] is not None:
+        headers['X-Next-Cursor'] = page['next_cursor']
+
+    response = None  # type: Any
+    if format_ == 'ndjson':
+        response = to_ndjson(page['response'])
+    else:
+        response = to_arrow(page['response'], format_)
+    return flask.Response(
+        response=response, mimetype=mimetype, headers=headers
+    )
+
+
+def get_batch_params(params, version):
+    # type: (Dict[str, Any], int) -> Tuple[Dict[str, Dict[str, Any]], int]
+    '''
+    Parses batch search parameters from given request parameters.
+
+    Queries may be given as a dict of query id to query, or as a list of
+    queries, in which case ids are list indices. Each query may be a SQL
+    string or a dict of page parameters, as accepted by get_page_params.
+
+    Args:
+        params (dict): Request parameters, with queries and optional
+            workers keys.
+        version (int): Current database version.
+
+    Raises:
+        RuntimeError: If queries are not a dict or list.
+        RuntimeError: If a query has no query or cursor.
+        RuntimeError: If workers is not a positive integer.
+
+    Returns:
+        tuple[dict, int]: Map of query id to page parameters, and number of
+            workers, which is capped at the number of queries and CPUs.
+    '''
+    queries = params.get('queries')
+    if isinstance(queries, list):
+        queries = {str(i): x for i, x in enumerate(queries)}
+    if not isinstance(queries, dict):
+        msg = 'Please supply valid batch params in the form '
+        msg += '{"queries": {id: SQL query}}.'
+        raise RuntimeError(msg)
+
+    output = {}
+    for key, query in queries.items():
+        if isinstance(query, str):
+            query = dict(query=query)
+        if not isinstance(query, dict) \
+                or ('query' not in query and 'cursor' not in query):
+            msg = f'Invalid query {key}: {query}. Queries must be SQL strings '
+            msg += 'or dicts with a query or cursor key.'
+            raise RuntimeError(msg)
+        output[str(key)] = get_page_params(query, version)
+
+    workers = params.get('workers', 1)
+    if not isinstance(workers, int) or isinstance(workers, bool) \
+            or workers < 1:
+        msg = f'Workers must be a positive integer. Given value: {workers}.'
+        raise RuntimeError(msg)
+    workers = max(min(workers, len(output), os.cpu_count() or 1), 1)
+    return output, workers
+
+
+def search_batch(database, queries, workers=1):
+    # type: (Database, Dict[str, Dict[str, Any]], int) -> Dict[str, Dict[str, Any]]
+    '''
+    Executes given queries against given database, optionally in parallel.
+    All queries run against the database's loaded table. Errors are returned
+    per query rather than raised.
+
+    Args:
+        database (Database): Updated database.
+        queries (dict): Map of query id to page parameters.
+        workers (int, optional): Number of worker threads. Default: 1.
+
+    Returns:
+        dict: Map of query id to page response or error dict.
+    '''
+    def search(params):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        try:
+            return get_page_response(database, params)
+        except TimeoutError as error:
+            return error_to_dict(error, code=504)
+        except Exception as error:
+            return error_to_dict(error)
+
+    keys = list(queries.keys())
+    if workers <= 1 or len(keys) <= 1:
+        return {k: search(queries[k]) for k in keys}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(search, [queries[k] for k in keys])
+        return dict(zip(keys, results))
+
+
+def read_to_response(database):
+    # type: (Database) -> flask.Response
+    '''
+    Creates a JSON response of all data in given database, equivalent to an
+    unpaged json page response. The data is not re-serialized, it is
+    served from JSON bytes cached by database at update time.
+
+    Args:
+        database (Database): Updated database.
+
+    Raises:
+        RuntimeError: If database has not been updated.
+
+    Returns:
+        flask.Response: Flask response.
+    '''
+    payload = database.read_json()
+    total = database.row_count
+    return flask.Response(
+        response=[
+            b'{"response": ',
+            payload,
+            f', "total": {total}, "next_cursor": null}}'.encode('utf-8'),
+        ],
+        mimetype='application/json',
+    )
+
+
+def get_etag(database, params, format_='json'):
+    # type: (Database, Dict[str, Any], str) -> str
+    '''
+    Creates an ETag for a response of given database, page parameters and
+    format, of the form "<data version>-<hash>". The hash covers the data
+    digest, so ETags are not reused across servers or restarts.
+
+    Args:
+        database (Database): Updated database.
+        params (dict): Page parameters, as returned by get_page_params.
+        format_ (str, optional): Response format. Default: json.
+
+    Returns:
+        str: ETag, without quotes.
+    '''
+    params = dict(params)
+    if params.get('query') is not None:
+        params['query'] = spl.normalize_query(params['query'])
+    hash_ = sch.get_hash([database.digest, params, format_])[:16]
+    return f'{database.version}-{hash_}'
+
+
+def not_modified_response(etag):
+    # type: (str) -> flask.Response
+    '''
+    Creates an empty 304 Not Modified response with given ETag.
+
+    Args:
+        etag (str): ETag, without quotes.
+
+    Returns:
+        flask.Response: Flask response.
+    '''
+    response = flask.Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+COMPRESSION_CACHE = LRUCache(max_bytes=64 * 1024**2)
+'''
+Cache of compressed response bodies keyed by (ETag, encoding).
+'''
+
+COMPRESSIBLE_MIMETYPES = [
+    'application/javascript',
+    'application/json',
+    'application/vnd.apache.arrow.stream',
+    'application/vnd.shekels.columnar+json',
+    'application/x-ndjson',
+    'image/svg+xml',
+]
+'''
+Mimetypes, besides text/*, of responses which are compressed.
+'''
+
+
+def get_encoding(accept_encodings, streamed=False):
+    # type: (Any, bool) -> Optional[str]
+    '''
+    Negotiates content encoding from given Accept-Encoding header.
+    Brotli is only offered if the brotli package is installed, and is
+    preferred over gzip. Streamed responses are only encoded with gzip.
+
+    Args:
+        accept_encodings (Accept): Request Accept-Encoding header.
+        streamed (bool, optional): Whether response is streamed.
+            Default: False.
+
+    Returns:
+        str: br, gzip or None.
+    '''
+    options = ['gzip']
+    if not streamed and find_spec('brotli') is not None:
+        options.insert(0, 'br')
+    return accept_encodings.best_match(options)
+
+
+def compress(data, encoding):
+    # type: (bytes, str) -> bytes
+    '''
+    Compresses given data with given encoding.
+
+    Args:
+        data (bytes): Data.
+        encoding (str): Encoding. Options: br, gzip.
+
+    Returns:
+        bytes: Compressed data.
+    '''
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+
+def compress_stream(iterator):
+    # type: (Iterator[bytes]) -> Iterator[bytes]
+    '''
+    Compresses given stream of bytes with gzip.
+
+    Args:
+        iterator (iterator[bytes]): Stream.
+
+    Yields:
+        bytes: Compressed chunk.
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in iterator:
+        output = compressor.compress(chunk)
+        if output != b'':
+            yield output
+    yield compressor.flush()
+
+
+def compress_response(response, min_size=500):
+    # type: (flask.Response, int) -> flask.Response
+    '''
+    Compresses given response according to Accept-Encoding header of current
+    request. Only successful responses with compressible mimetypes are
+    compressed. Compressed bodies of responses with ETags are cached in
+    COMPRESSION_CACHE. Intended as a Flask after_request hook.
+
+    Args:
+        response (flask.Response): Response.
+        min_size (int, optional): Minimum size of compressed body in bytes.
+            Default: 500.
+
+    Returns:
+        flask.Response: Response.
+    '''
+    mimetype = response.mimetype or ''
+    compressible = mimetype.startswith('text/') or \
+        mimetype in COMPRESSIBLE_MIMETYPES
+    if response.status_code != 200 \
+            or response.direct_passthrough \
+            or 'Content-Encoding' in response.headers \
+            or not compressible:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = get_encoding(
+        flask.request.accept_encodings, streamed=response.is_streamed
+    )
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded())
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        etag, _ = response.get_etag()
+        key = (etag, encoding)
+        output = None
+        if etag is not None:
+            output = COMPRESSION_CACHE.get(key)
+        if output is None:
+            output = compress(data, encoding)
+            if etag is not None:
+                COMPRESSION_CACHE.set(key, output, size=len(output))
+        response.set_data(output)
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
 def update_store(client, store, endpoint, data=None):
     # type (FlaskClient, dict, str, Optional(dict)) -> None
     '''
@@ -143,6 +744,28 @@ def update_store(client, store, endpoint, data=None):
         store[endpoint] = client.post(endpoint).json
 
 
+def post_search(client, query, channel=None):
+    # type: (Any, str, Optional[str]) -> Tuple[Any, Optional[str]]
+    '''
+    Posts given query to /api/search with client. The ETag of the response
+    identifies its data by data version, digest and query, and is used to key
+    plot data and figures.
+
+    Args:
+        client (FlaskClient): Flask client instance.
+        query (str): SQL query.
+        channel (str, optional): Search channel. Default: None.
+
+    Returns:
+        tuple: Response JSON and ETag, which is None for errors.
+    '''
+    data = {'query': query}
+    if channel is not None:
+        data['channel'] = channel
+    response = client.post('/api/search', json=json.dumps(data))
+    return response.json, response.get_etag()[0]
+
+
 def store_key_is_valid(store, key):
     # type: (dict, str) -> bool
     '''
@@ -218,6 +841,46 @@ def solve_component_state(store, config=False):
     return None
 
 
+def warm_cache(database, config):
+    # type: (Database, Dict[str, Any]) -> Dict[str, Optional[str]]
+    '''
+    Warms search, plan, data and figure caches.
+    Executes the default query and all pinned queries of given config, and
+    renders all configured plots of each query's result. Errors are recorded
+    rather than raised.
+
+    Args:
+        database (Database): Updated database.
+        config (dict): Database configuration.
+
+    Returns:
+        dict: Map of query to error name, or None if query was warmed.
+    '''
+    queries = [config['default_query']] + config.get('pinned_queries', [])
+    output = {}  # type: Dict[str, Optional[str]]
+    for query in dict.fromkeys(queries):
+        try:
+            # figures are keyed by the ETag the app receives from /api/search
+            params = get_page_params({'query': query}, database.version)
+            version = get_etag(database, params)
+            svc.get_plots(
+                database.search(query),
+                config.get('plots', []),
+                color_scheme=config.get('color_scheme', {}),
+                executor=config.get(
+                    'plot_executor', cfg.Config.plot_executor.default
+                ),
+                workers=config.get(
+                    'plot_workers', cfg.Config.plot_workers.default
+                ),
+                version=version,
+            )
+            output[query] = None
+        except Exception as error:
+            output[query] = error.__class__.__name__
+    return output
+
+
 # EVENTS------------------------------------------------------------------------
 def config_query_event(value, store, app):
     # type: (str, dict, dash.Dash) -> dict
@@ -244,7 +907,8 @@ def config_query_event(value, store, app):
 def config_edit_event(value, store, app):
     # type: (dict, dict, dash.Dash) -> dict
     '''
-    Saves given edits to store.
+    Saves given edits to store. Flattened configs are cached, so only the
+    edited item changes.
 
     Args:
         value (dict): Config table.
@@ -262,29 +926,42 @@ def config_edit_event(value, store, app):
         ('/config/search', store.get('/config/search', config)),
     ]
     for key, val in items:
-        item = rpb.BlobETL(val).to_flat_dict()
-        if old_key in item:
-            del item[old_key]
-            item[new['key']] = new['value']
-        store[key] = rpb.BlobETL(item).to_dict()
+        store[key] = sdt.edit_flat_dict(val, old_key, new['key'], new['value'])
     return store
 
 
 def data_query_event(value, store, app):
-    # type: (str, dict, dash.Dash) -> dict
+    # type: (Dict[str, str], dict, dash.Dash) -> dict
     '''
-    Updates given store given a data query.
+    Updates given store given a data query. Searches are made on a channel
+    per session, so that each search cancels the previous one of the same
+    session only.
 
     Args:
-        value (str): SQL query.
+        value (dict): Dict with query and session keys, where query is a SQL
+            query and session is the session id.
         store (dict): Dash store.
         app (dash.Dash): Dash app.
 
+    Raises:
+        PreventUpdate: If search was cancelled by a newer search.
+
     Returns:
         dict: Modified store.
     '''
-    update_store(app.client, store, '/api/search', data={'query': value})
-    store['/api/search/query'] = value
+    query = value['query']
+    response, etag = post_search(
+        app.client, query, channel=f'dash-search-{value["session"]}'
+    )
+
+    # superseded searches are cancelled, and their results discarded
+    if isinstance(response, dict) \
+            and response.get('error') == 'InterruptedError':
+        raise PreventUpdate
+
+    store['/api/search'] = response
+    store['/api/search/query'] = query
+    store['/api/search/etag'] = etag
     return store
 
 
@@ -323,12 +1000,11 @@ def update_event(value, store, app):
         dict: Modified store.
     '''
     update_store(app.client, store, '/api/update')
-    update_store(
-        app.client,
-        store,
-        '/api/search',
-        data={'query': app.api.config['default_query']}
+    query = app.api.config['default_query']
+    store['/api/search'], store['/api/search/etag'] = post_search(
+        app.client, query
     )
+    store['/api/search/query'] = query
     return store
 
 
@@ -1,17 +1,27 @@
+from importlib.util import find_spec
 from pathlib import Path
 from tempfile import TemporaryDirectory
 import base64
+import gzip
 import json
 import re
+import sys
 import unittest
+import unittest.mock as mock
 
 from dash.exceptions import PreventUpdate
+from werkzeug.datastructures import Accept, MIMEAccept
 import dash
 import flask
 import jsoncomment as jsonc
 import lunchbox.tools as lbt
+import numpy as np
+import pandas as pd
 
+from shekels.core.database import Database
 import shekels.core.config as cfg
+import shekels.core.data_tools as sdt
+import shekels.server.components as svc
 import shekels.server.server_tools as svt
 # ------------------------------------------------------------------------------
 
@@ -37,6 +47,11 @@ class ServerToolsTests(unittest.TestCase):
         self.assertEqual(result.json['message'], 'TypeError(\n    foo\n)')
         self.assertEqual(result.json['code'], 500)
 
+    def test_error_to_response_code(self):
+        result = svt.error_to_response(TimeoutError('foo'), code=504)
+        self.assertEqual(result.status_code, 504)
+        self.assertEqual(result.json['code'], 504)
+
     def test_error_to_response_dict(self):
         arg = {
             'bars': {
@@ -141,6 +156,389 @@ ewogICAgImZvbyI6ICJiYXIiCiAgICAvLyAicGl6emEiOiAidGFjbyIKfQo = '''
         app.register_error_handler(500, handler)
         return app.test_client()
 
+    def test_encode_decode_cursor(self):
+        params = dict(query='foo', limit=2, offset=4, order_by=[], version=3)
+        cursor = svt.encode_cursor(params)
+        self.assertIsInstance(cursor, str)
+        self.assertNotRegex(cursor, '[+/]')
+
+        result = svt.decode_cursor(cursor, 3)
+        expected = dict(query='foo', limit=2, offset=4, order_by=[])
+        self.assertEqual(result, expected)
+
+        expected = 'Cursor is stale. Database has been updated since it was issued.'
+        with self.assertRaisesRegex(RuntimeError, expected):
+            svt.decode_cursor(cursor, 4)
+
+        expected = 'Invalid cursor: foo.'
+        with self.assertRaisesRegex(RuntimeError, expected):
+            svt.decode_cursor('foo', 3)
+
+    def test_get_page_params(self):
+        result = svt.get_page_params({}, 1)
+        expected = dict(query=None, limit=None, offset=0, order_by=[])
+        self.assertEqual(result, expected)
+
+        params = dict(query='foo', limit='2', offset=3, order_by='a, -b,')
+        result = svt.get_page_params(params, 1)
+        expected = dict(query='foo', limit=2, offset=3, order_by=['a', '-b'])
+        self.assertEqual(result, expected)
+
+        params = dict(order_by=['a'])
+        result = svt.get_page_params(params, 1)['order_by']
+        self.assertEqual(result, ['a'])
+
+        cursor = svt.encode_cursor(dict(
+            query='foo', limit=2, offset=4, order_by=[], version=1
+        ))
+        result = svt.get_page_params(dict(cursor=cursor, limit=10), 1)
+        self.assertEqual(result['limit'], 2)
+        self.assertEqual(result['offset'], 4)
+
+    def test_get_page_params_errors(self):
+        expected = 'Limit must be a non-negative integer. Given value: -1.'
+        with self.assertRaisesRegex(RuntimeError, expected):
+            svt.get_page_params(dict(limit=-1), 1)
+
+        expected = 'Offset must be a non-negative integer. Given value: foo.'
+        with self.assertRaisesRegex(RuntimeError, expected):
+            svt.get_page_params(dict(offset='foo'), 1)
+
+        expected = 'Order by must be a column or list of columns.'
+        with self.assertRaisesRegex(RuntimeError, expected):
+            svt.get_page_params(dict(order_by=[1]), 1)
+
+    def test_get_page_response(self):
+        with open(CONFIG_PATH) as f:
+            config = jsonc.JsonComment().load(f)
+        database = Database(config).update()
+        params = svt.get_page_params(dict(limit=10, offset=0), 1)
+        result = svt.get_page_response(database, params)
+        self.assertEqual(result['response'], database.read()[:10])
+        total = result['total']
+        self.assertEqual(total, len(database.read()))
+
+        records = result['response']
+        while result['next_cursor'] is not None:
+            params = svt.get_page_params(
+                dict(cursor=result['next_cursor']), 1
+            )
+            result = svt.get_page_response(database, params)
+            records.extend(result['response'])
+        self.assertEqual(records, database.read())
+
+        params = svt.get_page_params({}, 1)
+        result = svt.get_page_response(database, params)
+        self.assertIsNone(result['next_cursor'])
+
+        # streamed formats get a DataFrame
+        params = svt.get_page_params(dict(limit=10, offset=5), 1)
+        result = svt.get_page_response(database, params, format_='ndjson')
+        self.assertIsInstance(result['response'], pd.DataFrame)
+        self.assertEqual(
+            sdt.to_records(result['response']), database.read()[5:15]
+        )
+
+    def test_get_response_format(self):
+        self.assertEqual(svt.get_response_format({}), 'json')
+        self.assertEqual(svt.get_response_format(dict(format='ndjson')), 'ndjson')
+
+        # content negotiation
+        accept = MIMEAccept([('application/vnd.apache.parquet', 1)])
+        self.assertEqual(svt.get_response_format({}, accept), 'parquet')
+        self.assertEqual(
+            svt.get_response_format(dict(format='arrow'), accept), 'arrow'
+        )
+        accept = MIMEAccept([('*/*', 1)])
+        self.assertEqual(svt.get_response_format({}, accept), 'json')
+        accept = MIMEAccept([('text/html', 1)])
+        self.assertEqual(svt.get_response_format({}, accept), 'json')
+
+        expected = r'Invalid response format: foo\. Legal formats: \[.*\]\.'
+        with self.assertRaisesRegex(RuntimeError, expected):
+            svt.get_response_format(dict(format='foo'))
+
+    def test_to_ndjson(self):
+        data = pd.DataFrame(dict(a=range(5), b=None))
+        result = svt.to_ndjson(data, batch_size=2)
+        with mock.patch.object(
+            sdt, 'to_records', wraps=sdt.to_records
+        ) as to_records:
+            next(result)
+            self.assertEqual(to_records.call_count, 1)
+            self.assertEqual(len(to_records.call_args.args[0]), 2)
+            result = list(result)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[1], '{"a": 4, "b": null}\n')
+
+        result = list(svt.to_ndjson(data, batch_size=2))
+        self.assertEqual(result[0], '{"a": 0, "b": null}\n{"a": 1, "b": null}\n')
+        result = ''.join(result).splitlines()
+        result = [json.loads(x) for x in result]
+        self.assertEqual(result, sdt.to_records(data))
+
+        self.assertEqual(list(svt.to_ndjson(pd.DataFrame())), [])
+
+    def test_to_ndjson_dates(self):
+        data = pd.DataFrame()
+        data['date'] = pd.to_datetime(['2020-01-01', None])
+        result = list(svt.to_ndjson(data))
+        self.assertEqual(result, ['{"date": "2020-01-01T00:00:00"}\n{"date": null}\n'])
+
+    def test_to_columnar(self):
+        data = pd.DataFrame(dict(a=[1, 2], b=['x', None], c=[1.5, np.nan]))
+        data['date'] = pd.to_datetime(['2020-01-01', None])
+        result = svt.to_columnar(data)
+        expected = dict(
+            a=[1, 2],
+            b=['x', None],
+            c=[1.5, None],
+            date=['2020-01-01T00:00:00', None],
+        )
+        self.assertEqual(result, expected)
+        self.assertIs(type(result['a'][0]), int)
+
+        # values equal those of records
+        records = sdt.to_records(data)
+        for key, val in result.items():
+            self.assertEqual(val, [x[key] for x in records])
+
+        self.assertEqual(svt.to_columnar(data.head(0)), {})
+
+    def test_to_arrow_no_pyarrow(self):
+        with mock.patch.dict(sys.modules, {'pyarrow': None}):
+            expected = r'The parquet format requires pyarrow\. '
+            expected += r'Please install shekels\[arrow\]\.'
+            with self.assertRaisesRegex(RuntimeError, expected):
+                svt.to_arrow(pd.DataFrame(dict(a=[1])), 'parquet')
+
+    @unittest.skipIf(find_spec('pyarrow') is None, 'pyarrow not installed')
+    def test_to_arrow(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        data = pd.DataFrame()
+        data['date'] = pd.to_datetime(['2020-01-01', None])
+        data['amount'] = [1.5, None]
+        data['category'] = ['food', 'rent']
+        data.index = [3, 7]
+        result = svt.to_arrow(data)
+        result = pa.ipc.open_stream(result).read_all()
+        self.assertEqual(result.num_rows, 2)
+        self.assertEqual(result.schema.names, ['date', 'amount', 'category'])
+        self.assertEqual(result.schema.field('date').type, pa.timestamp('ns'))
+        self.assertEqual(result.column('amount').to_pylist(), [1.5, None])
+
+        result = svt.to_arrow(data, 'parquet')
+        result = pq.read_table(pa.BufferReader(result))
+        self.assertEqual(result.column('category').to_pylist(), ['food', 'rent'])
+
+    def test_page_to_response_columnar(self):
+        page = dict(
+            response=pd.DataFrame(dict(a=[1, 2])), total=4, next_cursor='foo'
+        )
+        app = flask.Flask('test')
+        with app.app_context():
+            result = svt.page_to_response(page, 'columnar')
+            self.assertEqual(
+                result.mimetype, 'application/vnd.shekels.columnar+json'
+            )
+            expected = dict(response=dict(a=[1, 2]), total=4, next_cursor='foo')
+            self.assertEqual(json.loads(result.get_data()), expected)
+
+    def test_page_to_response(self):
+        page = dict(response=[dict(a=1), dict(a=2)], total=4, next_cursor='foo')
+        app = flask.Flask('test')
+        with app.app_context():
+            result = svt.page_to_response(page)
+            self.assertEqual(result.mimetype, 'application/json')
+            self.assertEqual(result.json, page)
+
+            page['response'] = pd.DataFrame(page['response'])
+            result = svt.page_to_response(page, 'ndjson')
+            self.assertEqual(result.mimetype, 'application/x-ndjson')
+            self.assertTrue(result.is_streamed)
+            self.assertEqual(result.headers['X-Total-Count'], '4')
+            self.assertEqual(result.headers['X-Next-Cursor'], 'foo')
+            self.assertEqual(result.get_data(as_text=True), '{"a": 1}\n{"a": 2}\n')
+
+            page['next_cursor'] = None
+            result = svt.page_to_response(page, 'ndjson')
+            self.assertNotIn('X-Next-Cursor', result.headers)
+
+    def test_get_batch_params(self):
+        params = dict(queries=dict(a='select 1', b=dict(query='select 2', limit=1)))
+        queries, workers = svt.get_batch_params(params, 1)
+        self.assertEqual(workers, 1)
+        self.assertEqual(
+            queries['a'], dict(query='select 1', limit=None, offset=0, order_by=[])
+        )
+        self.assertEqual(queries['b']['limit'], 1)
+
+        params = dict(queries=['select 1', 'select 2'], workers=2)
+        queries, workers = svt.get_batch_params(params, 1)
+        self.assertEqual(list(queries.keys()), ['0', '1'])
+        with mock.patch('os.cpu_count', return_value=4):
+            queries, workers = svt.get_batch_params(params, 1)
+        self.assertEqual(workers, 2)
+
+        # workers are capped at number of queries and CPUs
+        params = dict(queries=['select 1'] * 3, workers=10**6)
+        with mock.patch('os.cpu_count', return_value=2):
+            _, workers = svt.get_batch_params(params, 1)
+        self.assertEqual(workers, 2)
+        with mock.patch('os.cpu_count', return_value=None):
+            _, workers = svt.get_batch_params(params, 1)
+        self.assertEqual(workers, 1)
+        with mock.patch('os.cpu_count', return_value=8):
+            _, workers = svt.get_batch_params(params, 1)
+            self.assertEqual(workers, 3)
+            _, workers = svt.get_batch_params(dict(queries=[], workers=4), 1)
+            self.assertEqual(workers, 1)
+
+    def test_get_batch_params_errors(self):
+        expected = 'Please supply valid batch params in the form '
+        expected += r'\{"queries": \{id: SQL query\}\}\.'
+        with self.assertRaisesRegex(RuntimeError, expected):
+            svt.get_batch_params(dict(queries='select 1'), 1)
+
+        expected = 'Invalid query a: .*Queries must be SQL strings'
+        with self.assertRaisesRegex(RuntimeError, expected):
+            svt.get_batch_params(dict(queries=dict(a=dict(limit=1))), 1)
+
+        expected = 'Workers must be a positive integer. Given value: 0.'
+        with self.assertRaisesRegex(RuntimeError, expected):
+            svt.get_batch_params(dict(queries=[], workers=0), 1)
+
+    def test_search_batch(self):
+        with open(CONFIG_PATH) as f:
+            config = jsonc.JsonComment().load(f)
+        database = Database(config).update()
+        params = dict(queries=dict(
+            all='select * from data',
+            big=dict(query='select * from data where amount > 100', limit=2),
+            bad='select * from foo',
+        ))
+        queries, _ = svt.get_batch_params(params, 1)
+        for workers in [1, 3]:
+            result = svt.search_batch(database, queries, workers=workers)
+            self.assertEqual(list(result.keys()), ['all', 'big', 'bad'])
+            expected = database.search('select * from data')
+            self.assertEqual(result['all']['response'], expected)
+            self.assertEqual(len(result['big']['response']), 2)
+            self.assertIsNotNone(result['big']['next_cursor'])
+            self.assertEqual(result['bad']['error'], 'PandaSQLException')
+            self.assertEqual(result['bad']['code'], 500)
+
+        with mock.patch.object(
+            database, '_search_frame', side_effect=TimeoutError('foo')
+        ):
+            result = svt.search_batch(database, queries)
+            self.assertEqual(result['big']['error'], 'TimeoutError')
+            self.assertEqual(result['big']['code'], 504)
+
+    def test_get_etag(self):
+        with open(CONFIG_PATH) as f:
+            config = jsonc.JsonComment().load(f)
+        database = Database(config).update()
+        params = svt.get_page_params(dict(query='select * from data'), 1)
+        result = svt.get_etag(database, params)
+        self.assertRegex(result, '^1-[a-f0-9]{16}$')
+
+        # query is normalized
+        temp = dict(params, query=' select *\n from data; ')
+        self.assertEqual(svt.get_etag(database, temp), result)
+
+        self.assertNotEqual(svt.get_etag(database, params, 'ndjson'), result)
+        temp = dict(params, limit=10)
+        self.assertNotEqual(svt.get_etag(database, temp), result)
+
+        database.update()
+        self.assertRegex(svt.get_etag(database, params), '^2-')
+
+    def test_not_modified_response(self):
+        result = svt.not_modified_response('1-abc')
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.headers['ETag'], '"1-abc"')
+        self.assertEqual(result.get_data(), b'')
+
+    def test_get_encoding(self):
+        accept = Accept([('gzip', 1), ('deflate', 1)])
+        self.assertEqual(svt.get_encoding(accept), 'gzip')
+        self.assertIsNone(svt.get_encoding(Accept([('deflate', 1)])))
+        self.assertIsNone(svt.get_encoding(Accept([])))
+
+        with mock.patch.object(svt, 'find_spec', return_value=True):
+            accept = Accept([('gzip', 1), ('br', 1)])
+            self.assertEqual(svt.get_encoding(accept), 'br')
+            self.assertEqual(svt.get_encoding(accept, streamed=True), 'gzip')
+
+    def test_compress(self):
+        data = b'foo bar ' * 100
+        result = svt.compress(data, 'gzip')
+        self.assertLess(len(result), len(data))
+        self.assertEqual(gzip.decompress(result), data)
+
+        result = b''.join(svt.compress_stream(iter([data, b'', data])))
+        self.assertEqual(gzip.decompress(result), data + data)
+
+    def test_compress_response(self):
+        app = flask.Flask('test')
+        data = json.dumps(dict(foo=['bar'] * 200))
+        headers = {'Accept-Encoding': 'gzip'}
+        with app.test_request_context(headers=headers):
+            response = flask.Response(data, mimetype='application/json')
+            result = svt.compress_response(response)
+            self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', result.headers['Vary'])
+            self.assertEqual(gzip.decompress(result.get_data()).decode(), data)
+
+            # small responses
+            response = flask.Response('{}', mimetype='application/json')
+            result = svt.compress_response(response)
+            self.assertNotIn('Content-Encoding', result.headers)
+
+            # binary responses
+            response = flask.Response(data, mimetype='application/vnd.apache.parquet')
+            result = svt.compress_response(response)
+            self.assertNotIn('Content-Encoding', result.headers)
+
+            # errors
+            response = flask.Response(data, mimetype='text/html', status=500)
+            result = svt.compress_response(response)
+            self.assertNotIn('Content-Encoding', result.headers)
+
+            # streamed responses
+            response = flask.Response(
+                (x for x in [data, data]), mimetype='application/x-ndjson'
+            )
+            result = svt.compress_response(response)
+            self.assertEqual(result.headers['Content-Encoding'], 'gzip')
+            result = gzip.decompress(result.get_data()).decode()
+            self.assertEqual(result, data + data)
+
+        with app.test_request_context():
+            response = flask.Response(data, mimetype='application/json')
+            result = svt.compress_response(response)
+            self.assertNotIn('Content-Encoding', result.headers)
+            self.assertEqual(result.get_data(as_text=True), data)
+
+    def test_compress_response_cache(self):
+        app = flask.Flask('test')
+        data = json.dumps(dict(foo=['bar'] * 200))
+        headers = {'Accept-Encoding': 'gzip'}
+        svt.COMPRESSION_CACHE.clear()
+        with app.test_request_context(headers=headers):
+            with mock.patch.object(svt, 'compress', wraps=svt.compress) as compress:
+                for _ in range(2):
+                    response = flask.Response(data, mimetype='application/json')
+                    response.set_etag('1-abc')
+                    result = svt.compress_response(response)
+                    self.assertEqual(
+                        gzip.decompress(result.get_data()).decode(), data
+                    )
+                self.assertEqual(compress.call_count, 1)
+
     def test_update_store(self):
         client = self.get_client()
         store = {}
@@ -247,16 +645,59 @@ ewogICAgImZvbyI6ICJiYXIiCiAgICAvLyAicGl6emEiOiAidGFjbyIKfQo = '''
                     )
 
                 if endpoint == '/api/search':
-                    return flask.Response(
+                    response = flask.Response(
                         response=json_.dumps([{'foo': 'bar'}]),
                         mimetype='application/json'
                     )
+                    response.set_etag('1-abc')
+                    return response
 
         app = dash.Dash(name='test')
         app.api = Api()
         app.client = Client()
         return app
 
+    def test_warm_cache(self):
+        with open(CONFIG_PATH) as f:
+            config = jsonc.JsonComment().load(f)
+        config['pinned_queries'] = [
+            config['default_query'],
+            'select * from data where amount > 100',
+            'select * from bad_table',
+        ]
+        database = Database(config).update()
+        config = database.config
+
+        svc.FIGURE_CACHE.clear()
+        result = svt.warm_cache(database, config)
+        expected = {
+            config['default_query']: None,
+            'select * from data where amount > 100': None,
+            'select * from bad_table': 'PandaSQLException',
+        }
+        self.assertEqual(result, expected)
+        self.assertEqual(len(svc.FIGURE_CACHE), 2 * len(config['plots']))
+
+        # figures are cached for app requests, by search ETag
+        query = config['default_query']
+        params = svt.get_page_params(dict(query=query), database.version)
+        version = svt.get_etag(database, params)
+        records = database.search(query)
+        hits = svc.FIGURE_CACHE.hits
+        with mock.patch.object(
+            svc.sch, 'get_hash', wraps=svc.sch.get_hash
+        ) as get_hash:
+            svc.get_plots(
+                records,
+                config['plots'],
+                color_scheme=config['color_scheme'],
+                version=version,
+            )
+            # data is not hashed
+            for call in get_hash.call_args_list:
+                self.assertIsNot(call.args[0], records)
+        self.assertEqual(svc.FIGURE_CACHE.hits, hits + len(config['plots']))
+
     def test_config_query_event(self):
         class Api:
             config = {
@@ -314,14 +755,42 @@ ewogICAgImZvbyI6ICJiYXIiCiAgICAvLyAicGl6emEiOiAidGFjbyIKfQo = '''
         app = self.get_app()
 
         # query
-        value = "select * from config where key == 'foo'"
+        query = "select * from config where key == 'foo'"
+        value = dict(query=query, session='abc')
         result = svt.data_query_event(value, store, app)
         expected = {
             '/api/search': [{'foo': 'bar'}],
-            '/api/search/query': value,
+            '/api/search/query': query,
+            '/api/search/etag': '1-abc',
         }
         self.assertEqual(result, expected)
 
+    def test_post_search(self):
+        app = self.get_app()
+        result = svt.post_search(app.client, 'select * from data')
+        self.assertEqual(result, ([{'foo': 'bar'}], '1-abc'))
+
+        app.client = mock.Mock()
+        app.client.post.return_value = svt.error_to_response(ValueError('foo'))
+        response, etag = svt.post_search(app.client, 'foo', channel='bar')
+        self.assertEqual(response['error'], 'ValueError')
+        self.assertIsNone(etag)
+        params = json.loads(app.client.post.call_args.kwargs['json'])
+        self.assertEqual(params, dict(query='foo', channel='bar'))
+
+    def test_data_query_event_cancelled(self):
+        app = self.get_app()
+        app.client = mock.Mock()
+        app.client.post.return_value = svt.error_to_response(
+            InterruptedError('Query cancelled.'), code=409
+        )
+        with self.assertRaises(PreventUpdate):
+            value = dict(query='select * from data', session='abc')
+            svt.data_query_event(value, {}, app)
+
+        params = json.loads(app.client.post.call_args.kwargs['json'])
+        self.assertEqual(params['channel'], 'dash-search-abc')
+
     def test_init_event(self):
         class Api:
             config = {
@@ -371,7 +840,9 @@ ewogICAgImZvbyI6ICJiYXIiCiAgICAvLyAicGl6emEiOiAidGFjbyIKfQo = '''
                     'foo': 'bar', 'taco': 'pizza'
                 }
             },
-            '/api/search': [{'foo': 'bar'}]
+            '/api/search': [{'foo': 'bar'}],
+            '/api/search/query': 'select * from data',
+            '/api/search/etag': '1-abc',
         }
         self.assertEqual(result, expected)
 